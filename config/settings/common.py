@@ -340,8 +340,43 @@ SOCIALHOME_TOS_JURISDICTION = env("SOCIALHOME_TOS_JURISDICTION", default=None)
 SOCIALHOME_STREAMS_PRECACHE_SIZE = env.int("SOCIALHOME_STREAMS_PRECACHE_SIZE", default=100)
 SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS = env.int("SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS", default=90)
 SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE = env.int("SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE", default=0)
+# Items to keep in the public, local and tag timelines cached once for all users
+SOCIALHOME_STREAMS_SHARED_TIMELINE_SIZE = env.int("SOCIALHOME_STREAMS_SHARED_TIMELINE_SIZE", default=500)
+# Local followers from which content of a profile is merged in to followed streams when read, instead of being added
+# to each of them. 0 to always add to each followed stream.
+SOCIALHOME_STREAMS_FAN_OUT_ON_READ_FOLLOWERS = env.int("SOCIALHOME_STREAMS_FAN_OUT_ON_READ_FOLLOWERS", default=1000)
+
+# Redis maintenance
+# Most Redis operations per second for maintenance jobs going through keys, 0 to not limit
+SOCIALHOME_REDIS_MAINTENANCE_OPS = env.int("SOCIALHOME_REDIS_MAINTENANCE_OPS", default=5000)
+
+# Federation delivery
+# Deliveries to a single remote host to run at the same time
+SOCIALHOME_DELIVERY_HOST_CONCURRENCY = env.int("SOCIALHOME_DELIVERY_HOST_CONCURRENCY", default=2)
+# Times to try a delivery to a remote host before giving up
+SOCIALHOME_DELIVERY_MAX_ATTEMPTS = env.int("SOCIALHOME_DELIVERY_MAX_ATTEMPTS", default=6)
+# Failed deliveries in a row after which deliveries to a remote host are paused
+SOCIALHOME_DELIVERY_CIRCUIT_THRESHOLD = env.int("SOCIALHOME_DELIVERY_CIRCUIT_THRESHOLD", default=5)
+# Seconds to pause deliveries to a failing remote host
+SOCIALHOME_DELIVERY_CIRCUIT_TIMEOUT = env.int("SOCIALHOME_DELIVERY_CIRCUIT_TIMEOUT", default=1800)
+
+# Federation inbound
+# Queue received payloads for the consume_inbound_payloads command instead of a background job each
+SOCIALHOME_INBOUND_BATCHING = env.bool("SOCIALHOME_INBOUND_BATCHING", default=False)
+# Most received payloads to process together
+SOCIALHOME_INBOUND_BATCH_SIZE = env.int("SOCIALHOME_INBOUND_BATCH_SIZE", default=50)
+# Most seconds to wait for a batch of received payloads to fill up
+SOCIALHOME_INBOUND_BATCH_WAIT = env.float("SOCIALHOME_INBOUND_BATCH_WAIT", default=1.0)
+# Queued received payloads after which new ones are refused with 429
+SOCIALHOME_INBOUND_MAX_BACKLOG = env.int("SOCIALHOME_INBOUND_MAX_BACKLOG", default=10000)
+# Seconds to remember received payloads to drop duplicates of, 0 to not drop duplicates
+SOCIALHOME_INBOUND_DEDUP_TTL = env.int("SOCIALHOME_INBOUND_DEDUP_TTL", default=3600)
 
 # Content
+# Process saved content (mentions, tags, previews, rendering, streams and federation) in a background job
+SOCIALHOME_CONTENT_PIPELINE_ASYNC = env.bool("SOCIALHOME_CONTENT_PIPELINE_ASYNC", default=True)
+# Seconds to cache the viewer independent serialized representation of content for streams
+SOCIALHOME_CONTENT_SERIALIZED_CACHE_TIMEOUT = env.int("SOCIALHOME_CONTENT_SERIALIZED_CACHE_TIMEOUT", default=3600)
 # These attributes on tags are kept on save for untrusted users
 SOCIALHOME_CONTENT_SAFE_ATTRS = {
     'a': ['class', 'href', 'title', 'target'],
@@ -81,6 +81,8 @@ RQ_QUEUES["default"]["ASYNC"] = False
 # Disable generating RSA keys automatically, otherwise tests become slow
 SOCIALHOME_GENERATE_USER_RSA_KEYS_ON_SAVE = False
 SOCIALHOME_HTTPS = False
+# Process saved content inline, since test transactions are never committed
+SOCIALHOME_CONTENT_PIPELINE_ASYNC = False
 
 # HAYSTACK
 # --------
@@ -1,3 +1,5 @@
+import sys
+
 from django.apps import AppConfig
 
 
@@ -8,3 +10,8 @@ class ContentConfig(AppConfig):
     def ready(self):
         """Import our signals."""
         import socialhome.content.signals
+
+        # The RQ worker forks a work horse for each job, so build the oEmbed providers index before that
+        if "rqworker" in sys.argv:
+            from socialhome.content.previews import get_pyembed
+            get_pyembed().discoverer.index
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content', '0037_fill_content_root_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oembedcache',
+            name='failed',
+            field=models.BooleanField(default=False, help_text='No oEmbed could be fetched.', verbose_name='Failed'),
+        ),
+        migrations.AddField(
+            model_name='opengraphcache',
+            name='failed',
+            field=models.BooleanField(default=False, help_text='No preview could be fetched.', verbose_name='Failed'),
+        ),
+    ]
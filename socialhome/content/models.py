@@ -1,5 +1,6 @@
 import datetime
 import re
+from collections import Counter
 from uuid import uuid4
 
 import arrow
@@ -7,8 +8,10 @@ import bleach
 from commonmark import commonmark
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import F
 from django.db.models.aggregates import Max
 from django.template.defaultfilters import truncatechars
 from django.template.loader import render_to_string
@@ -34,6 +37,7 @@ class OpenGraphCache(models.Model):
     title = models.CharField(_("Title"), max_length=256, blank=True)
     description = models.TextField(_("Description"), blank=True)
     image = models.URLField(_("Image URL"), blank=True)
+    failed = models.BooleanField(_("Failed"), default=False, help_text=_("No preview could be fetched."))
     modified = AutoLastModifiedField(_("Modified"), db_index=True)
 
     def __str__(self):
@@ -45,6 +49,7 @@ class OpenGraphCache(models.Model):
 class OEmbedCache(models.Model):
     url = models.URLField(_("URL"), unique=True)
     oembed = models.TextField(_("OEmbed HTML content"))
+    failed = models.BooleanField(_("Failed"), default=False, help_text=_("No oEmbed could be fetched."))
     modified = AutoLastModifiedField(_("Modified"), db_index=True)
 
     def __str__(self):
@@ -189,17 +194,37 @@ class Content(models.Model):
                 Content.objects.filter(id=self.id).update(
                     local=self.local, reply_count=self.reply_count, shares_count=self.shares_count,
                 )
+                self.clear_serialized_cache()
 
-    def cache_related_object_data(self):
-        """Update parent/shared_of cached data, for example share count"""
-        if self.share_of:
-            self.share_of.cache_data(commit=True)
-        if self.parent:
-            self.parent.cache_data(commit=True)
-            if self.parent.share_of:
-                self.parent.share_of.cache_data(commit=True)
-        if self.root_parent:
-            self.root_parent.cache_data(commit=True)
+    def clear_serialized_cache(self):
+        """Clear the cached viewer independent serialized representation of this content."""
+        cache.delete(self.get_serialized_cache_key(self.id))
+
+    @staticmethod
+    def get_serialized_cache_key(content_id: int) -> str:
+        return f"sh:content:serialized:{content_id}"
+
+    def update_related_counts(self, delta: int):
+        """Increment or decrement the cached reply and share counts of related content.
+
+        Counts the same things as ``cache_data`` does, without recounting. Any drift is fixed by the
+        ``reconcile_content_counts`` task.
+        """
+        counts = Counter()
+        if self.content_type == ContentType.SHARE and self.share_of_id:
+            counts[(self.share_of_id, "shares_count")] += delta
+        elif self.content_type == ContentType.REPLY:
+            if self.root_parent_id:
+                counts[(self.root_parent_id, "reply_count")] += delta
+            if self.parent and self.parent.content_type == ContentType.SHARE and self.parent.share_of_id:
+                counts[(self.parent.share_of_id, "reply_count")] += delta
+        for (content_id, field), change in counts.items():
+            qs = Content.objects.filter(id=content_id)
+            if change < 0:
+                # Don't go below zero if the counts have drifted
+                qs = qs.filter(**{f"{field}__gte": -change})
+            qs.update(**{field: F(field) + change})
+        cache.delete_many([self.get_serialized_cache_key(content_id) for content_id, _field in counts])
 
     def create_activity(self, activity_type: ActivityType) -> Activity:
         """
@@ -316,9 +341,11 @@ class Content(models.Model):
         if not self.fid and not self.guid:
             raise ValueError("Content must have either a fid or a guid")
 
+        adding = self._state.adding
         self.fix_local_uploads()
         super().save(*args, **kwargs)
-        self.cache_related_object_data()
+        if adding:
+            self.update_related_counts(1)
 
     def save_tags(self, tags):
         """Save given tag relations."""
@@ -411,9 +438,13 @@ class Content(models.Model):
         # TODO use only id
         return ("%s_%s" % (self.id, self.uuid))
 
-    def render(self):
-        """Pre-render text to Content.rendered."""
-        text = self.get_and_linkify_tags()
+    def render(self, text: str = None):
+        """Pre-render text to Content.rendered.
+
+        :param text: Text with tags already linkified, if available.
+        """
+        if text is None:
+            text = self.get_and_linkify_tags()
         rendered = commonmark(text, ignore_html_blocks=True).strip()
         rendered = process_text_links(rendered)
         if self.show_preview:
@@ -1,10 +1,21 @@
 import datetime
+import json
+import logging
 import os
 import re
 import string
 import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from itertools import product
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
-from django.db import DataError
+import requests
+from django.core.cache import cache
+from django.db import DataError, models
 from django.db import IntegrityError
 from django.db import transaction
 from django.template.defaultfilters import truncatechars
@@ -13,144 +24,389 @@ from opengraph import OpenGraph
 from pyembed import core as pyembedcore  # Ugh, but pyembed itself doesn't have a __file__ attr
 from pyembed.core import PyEmbed, PyEmbedError
 from pyembed.core.consumer import PyEmbedConsumerError
-from pyembed.core.discovery import (
-    UrlDiscoverer, PyEmbedDiscoveryError, ChainingDiscoverer, FileDiscoverer, StaticDiscoveryEndpoint,
-    StaticDiscoverer
-)
+from pyembed.core.discovery import FORMATS, PyEmbedDiscoverer, PyEmbedDiscoveryError, StaticDiscoveryEndpoint
+from pyembed.core.parse import parse_oembed
 
 from socialhome.content.models import Content, OEmbedCache, OpenGraphCache
 from socialhome.content.utils import safe_text, find_urls_in_text
 
+logger = logging.getLogger("socialhome")
+
+
+# How long to use a fetched preview before fetching it again
+PREVIEW_CACHE_TTL = datetime.timedelta(days=7)
+# How long to wait before trying again to fetch a preview for an URL that failed
+PREVIEW_FAILURE_CACHE_TTL = datetime.timedelta(days=1)
+# Seconds to wait for the previews of a content to be fetched
+PREVIEW_FETCH_TIMEOUT = 10
+PREVIEW_FETCH_WORKERS = 8
+# Seconds to wait for a preview host to connect and to send data, so that a hung fetch frees its worker
+PREVIEW_REQUEST_TIMEOUT = 5
+
 
 def fetch_content_preview(content):
     """Fetch a preview or oEmbed for a content.
 
     Will first try to fetch oEmbed for each found url.
     If not available, generate a preview from the OG tags.
+
+    :returns: The oEmbed or OpenGraph preview, if found.
     """
     if not content.show_preview:
         return
     urls = find_urls_in_text(content.text)
     if not urls:
         return
-    preview_done = fetch_oembed_preview(content, urls)
-    if not preview_done:
-        fetch_og_preview(content, urls)
+    return fetch_oembed_preview(content, urls) or fetch_og_preview(content, urls)
+
+
+@lru_cache(maxsize=None)
+def get_preview_executor() -> ThreadPoolExecutor:
+    """Get the process wide thread pool used to fetch previews.
+
+    Threads don't survive a fork, so each RQ work horse starts its own threads, as they are needed.
+    """
+    return ThreadPoolExecutor(max_workers=PREVIEW_FETCH_WORKERS, thread_name_prefix="previews")
+
+
+def fetch_concurrently(func: Callable[[str], Any], urls: List[str]) -> Dict[str, Any]:
+    """Call ``func`` for each url in a thread pool.
+
+    Each url has until ``PREVIEW_FETCH_TIMEOUT`` to complete, so a slow host doesn't hold back the others.
+    Running fetches can't be cancelled, so ``func`` should time out its requests with ``PREVIEW_REQUEST_TIMEOUT``.
+
+    A single url is fetched in the calling thread, which saves starting a thread in the RQ work horse.
+
+    :returns: Result for each url that completed, ``None`` if it failed. Urls that timed out are left out, as
+        they may not have been tried at all while the pool was busy.
+    """
+    if not urls:
+        return {}
+    if len(urls) == 1:
+        try:
+            return {urls[0]: func(urls[0])}
+        except Exception as ex:
+            logger.debug("fetch_concurrently - fetching %s failed: %s", urls[0], ex)
+            return {urls[0]: None}
+    futures = {url: get_preview_executor().submit(func, url) for url in urls}
+    wait(futures.values(), timeout=PREVIEW_FETCH_TIMEOUT)
+    results = {}
+    for url, future in futures.items():
+        if not future.done():
+            logger.info("fetch_concurrently - fetching %s timed out", url)
+            future.cancel()
+        elif future.exception():
+            logger.debug("fetch_concurrently - fetching %s failed: %s", url, future.exception())
+            results[url] = None
+        else:
+            results[url] = future.result()
+    return results
+
+
+def get_cached_previews(model, urls: List[str]) -> Tuple[Optional[models.Model], List[str]]:
+    """Check the cache for the urls, in order.
+
+    :returns: The first fresh cached preview, if found, and the urls before it that need to be fetched.
+    """
+    cached = {item.url: item for item in model.objects.filter(url__in=urls)}
+    to_fetch = []
+    for url in urls:
+        item = cached.get(url)
+        if item and item.failed and item.modified >= now() - PREVIEW_FAILURE_CACHE_TTL:
+            continue
+        if item and not item.failed and item.modified >= now() - PREVIEW_CACHE_TTL:
+            return item, to_fetch
+        to_fetch.append(url)
+    return None, to_fetch
+
+
+def cache_preview_failure(model, url: str):
+    """Record that fetching a preview for the url failed, so it isn't tried again for a while.
+
+    Existing successful previews are left as they are.
+    """
+    try:
+        with transaction.atomic():
+            item, created = model.objects.get_or_create(url=url, defaults={"failed": True})
+    except (DataError, IntegrityError):
+        return
+    if not created and item.failed:
+        item.save(update_fields=["modified"])
+
+
+def get_opengraph(url: str) -> Optional[Dict[str, str]]:
+    """Fetch the OpenGraph tags of an url."""
+    try:
+        og = OpenGraph(url=url, parser="lxml", timeout=PREVIEW_REQUEST_TIMEOUT)
+    except AttributeError:
+        return None
+    if not og or ("title" not in og and "site_name" not in og and "description" not in og and "image" not in og):
+        return None
+    return {
+        "title": og.title if "title" in og else og.site_name if "site_name" in og else "",
+        "description": og.description if "description" in og else "",
+        "image": og.image if "image" in og else "",
+    }
 
 
 def fetch_og_preview(content, urls):
     """Fetch first opengraph entry for a list of urls."""
-    for url in urls:
-        # See first if recently cached already
-        if OpenGraphCache.objects.filter(url=url, modified__gte=now() - datetime.timedelta(days=7)).exists():
-            opengraph = OpenGraphCache.objects.get(url=url)
-            Content.objects.filter(id=content.id).update(opengraph=opengraph)
-            return opengraph
-        try:
-            og = OpenGraph(url=url, parser="lxml")
-        except AttributeError:
+    opengraph, to_fetch = get_cached_previews(OpenGraphCache, urls)
+    fetched = fetch_concurrently(get_opengraph, to_fetch)
+    for url in to_fetch:
+        if url not in fetched:
+            # Timed out, try again next time
             continue
-        if not og or ("title" not in og and "site_name" not in og and "description" not in og and "image" not in og):
+        og = fetched[url]
+        if not og:
+            cache_preview_failure(OpenGraphCache, url)
             continue
+        values = {
+            "title": truncatechars(safe_text(og["title"]), 120),
+            "description": truncatechars(safe_text(og["description"]), 500),
+            "image": safe_text(og["image"]),
+            "failed": False,
+        }
         try:
-            title = og.title if "title" in og else og.site_name if "site_name" in og else ""
-            description = og.description if "description" in og else ""
-            image = og.image if "image" in og else ""
-            try:
-                with transaction.atomic():
-                    opengraph = OpenGraphCache.objects.create(
-                        url=url,
-                        title=truncatechars(safe_text(title), 120),
-                        description=truncatechars(safe_text(description), 500),
-                        image=safe_text(image),
-                    )
-            except DataError:
-                continue
+            with transaction.atomic():
+                opengraph = OpenGraphCache.objects.create(url=url, **values)
+        except DataError:
+            continue
         except IntegrityError:
-            # Some other process got ahead of us
+            # Already cached, but stale or failed
+            OpenGraphCache.objects.filter(url=url).update(modified=now(), **values)
             opengraph = OpenGraphCache.objects.get(url=url)
-            Content.objects.filter(id=content.id).update(opengraph=opengraph)
-            return opengraph
-        Content.objects.filter(id=content.id).update(opengraph=opengraph)
-        return opengraph
-    return False
-
-
-class OEmbedDiscoverer(ChainingDiscoverer):
-    """DefaultDiscoverer without the auto discovery."""
-    def __init__(self):
-        super().__init__([
-            FileDiscoverer(os.path.join(
-                os.path.dirname(pyembedcore.__file__), "config", "providers.json"
-            )),
-            UrlDiscoverer('http://oembed.com/providers.json'),
-            StaticDiscoverer(endpoints=[
-                StaticDiscoveryEndpoint({
-                    "schemes": [
-                        "https://twitter.com/"
-                    ],
-                    "url": "https://publish.twitter.com/oembed",
-                }),
-                StaticDiscoveryEndpoint({
-                    "schemes": [
-                        "https://www.nextplatform.com/*"
-                    ],
-                    "url": "https://www.nextplatform.com/wp-json/oembed/1.0/embed",
-                })
-            ])
-        ])
+        break
+    else:
+        if not opengraph:
+            return False
+    Content.objects.filter(id=content.id).update(opengraph=opengraph)
+    return opengraph
+
+
+OEMBED_PROVIDERS_FILE = os.path.join(os.path.dirname(pyembedcore.__file__), "config", "providers.json")
+OEMBED_PROVIDERS_URL = "http://oembed.com/providers.json"
+# Seconds to cache the providers list from oembed.com for all processes, or to wait after failing to fetch it
+OEMBED_PROVIDERS_CACHE_KEY = "sh:content:oembed_providers"
+OEMBED_PROVIDERS_CACHE_TIMEOUT = 60 * 60 * 24
+OEMBED_PROVIDERS_FAILURE_CACHE_TIMEOUT = 60 * 60
+# Providers not in the providers lists
+OEMBED_EXTRA_PROVIDERS = [
+    {
+        "provider_name": "Twitter",
+        "endpoints": [{
+            "schemes": [
+                "https://twitter.com/"
+            ],
+            "url": "https://publish.twitter.com/oembed",
+        }],
+    },
+    {
+        "provider_name": "The Next Platform",
+        "endpoints": [{
+            "schemes": [
+                "https://www.nextplatform.com/*"
+            ],
+            "url": "https://www.nextplatform.com/wp-json/oembed/1.0/embed",
+        }],
+    },
+]
+
+
+def fetch_remote_oembed_providers() -> List[Dict]:
+    """Fetch the providers list from oembed.com, cached in the Django cache so that it's shared by processes."""
+    providers = cache.get(OEMBED_PROVIDERS_CACHE_KEY)
+    if providers is not None:
+        return providers
+    try:
+        response = requests.get(OEMBED_PROVIDERS_URL, timeout=PREVIEW_FETCH_TIMEOUT)
+        response.raise_for_status()
+        providers = response.json()
+        timeout = OEMBED_PROVIDERS_CACHE_TIMEOUT
+    except (requests.RequestException, ValueError) as ex:
+        logger.warning("fetch_remote_oembed_providers - failed to fetch %s: %s", OEMBED_PROVIDERS_URL, ex)
+        providers = []
+        timeout = OEMBED_PROVIDERS_FAILURE_CACHE_TIMEOUT
+    cache.set(OEMBED_PROVIDERS_CACHE_KEY, providers, timeout)
+    return providers
+
+
+def load_oembed_providers(fetch_remote: bool = True) -> List[Dict]:
+    """Load the known oEmbed providers.
+
+    The providers file shipped with PyEmbed comes first, then the providers list from oembed.com, if it can be
+    fetched, and finally our extra providers.
+    """
+    with open(OEMBED_PROVIDERS_FILE) as f:
+        providers = json.load(f)
+    if fetch_remote:
+        providers += fetch_remote_oembed_providers()
+    return providers + OEMBED_EXTRA_PROVIDERS
+
+
+class OEmbedProviderIndex:
+    """oEmbed provider endpoints indexed by the hosts in their schemes.
+
+    Finding the endpoints for an url is a dict lookup for the url host and its parent domains, after which
+    only the endpoints found need their schemes matched.
+    """
+    def __init__(self, providers: List[Dict]):
+        self.endpoints = []
+        # Positions of endpoints in self.endpoints by exact host, by domain for "*." schemes, and others
+        self.hosts = defaultdict(set)
+        self.domains = defaultdict(set)
+        self.unindexed = set()
+        seen = set()
+        for provider in providers:
+            for endpoint in provider.get("endpoints", []):
+                if "schemes" not in endpoint or "url" not in endpoint:
+                    continue
+                key = (endpoint["url"], tuple(endpoint["schemes"]), tuple(endpoint.get("formats") or ()))
+                if key in seen:
+                    continue
+                seen.add(key)
+                position = len(self.endpoints)
+                self.endpoints.append(StaticDiscoveryEndpoint(endpoint))
+                for scheme in endpoint["schemes"]:
+                    host = urlsplit(scheme).netloc.split(":")[0].lower()
+                    if host.startswith("*.") and "*" not in host[2:]:
+                        self.domains[host[2:]].add(position)
+                    elif host and "*" not in host:
+                        self.hosts[host].add(position)
+                    else:
+                        self.unindexed.add(position)
+
+    def get_endpoints(self, url: str) -> List[StaticDiscoveryEndpoint]:
+        """Get the endpoints which may match the url, in provider order."""
+        host = urlsplit(url).hostname or ""
+        positions = set(self.unindexed)
+        positions.update(self.hosts.get(host, ()))
+        labels = host.split(".")
+        for i in range(len(labels)):
+            positions.update(self.domains.get(".".join(labels[i:]), ()))
+        return [self.endpoints[position] for position in sorted(positions)]
+
+
+class OEmbedDiscoverer(PyEmbedDiscoverer):
+    """Discoverer using a compiled index of the known providers, without the auto discovery.
+
+    :param providers: Providers to use. By default loaded with ``load_oembed_providers`` on first use.
+    """
+    def __init__(self, providers: List[Dict] = None):
+        self._index = OEmbedProviderIndex(providers) if providers is not None else None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self) -> OEmbedProviderIndex:
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = OEmbedProviderIndex(load_oembed_providers())
+        return self._index
+
+    def get_oembed_urls(self, url, oembed_format=None):
+        if oembed_format and oembed_format not in FORMATS:
+            raise PyEmbedDiscoveryError("Invalid format %s specified (must be json or xml)" % oembed_format)
+        formats = [oembed_format] if oembed_format else FORMATS
+        seen = set()
+        for endpoint, endpoint_format in product(self.index.get_endpoints(url), formats):
+            if endpoint.matches(url, endpoint_format):
+                oembed_url = endpoint.build_oembed_url(url, endpoint_format)
+                if oembed_url not in seen:
+                    seen.add(oembed_url)
+                    yield oembed_url
+
+
+class OEmbedConsumer(PyEmbed):
+    """PyEmbed fetching the oEmbed responses with ``PREVIEW_REQUEST_TIMEOUT``.
+
+    The endpoints for the url are tried in turn until one returns a valid response.
+    """
+    def embed(self, url, **params):
+        for oembed_url in self.discoverer.get_oembed_urls(url):
+            try:
+                response = requests.get(oembed_url, params=params, timeout=PREVIEW_REQUEST_TIMEOUT)
+            except requests.RequestException as ex:
+                raise PyEmbedError(ex)
+            if not response.ok:
+                logger.debug("OEmbedConsumer.embed - failed to get %s (status code %s)", oembed_url,
+                             response.status_code)
+                continue
+            content_type = response.headers.get("content-type", "").split(";")[0]
+            try:
+                return self.renderer.render(url, parse_oembed(response.text, content_type))
+            except (PyEmbedError, ValueError) as ex:
+                logger.debug("OEmbedConsumer.embed - invalid response from %s: %s", oembed_url, ex)
+        raise PyEmbedConsumerError("No valid oEmbed responses for %s" % url)
+
+
+@lru_cache(maxsize=None)
+def get_pyembed() -> OEmbedConsumer:
+    """Get the process wide oEmbed consumer, so that the providers are loaded only once.
+
+    The RQ worker loads the providers before forking the work horses, see ``ContentConfig.ready``.
+    """
+    return OEmbedConsumer(discoverer=OEmbedDiscoverer())
+
+
+def get_oembed(url: str) -> Optional[str]:
+    """Fetch the oEmbed HTML of an url, adjusted for our layout."""
+    options = {}
+    if url.startswith("https://twitter.com/"):
+        # This probably has little effect since we fetch these on the backend...
+        # But, DNT is always good to communicate if possible :)
+        options = {"dnt": "true", "omit_script": "true"}
+    try:
+        oembed = get_pyembed().embed(url, **options)
+    except (PyEmbedError, PyEmbedDiscoveryError, PyEmbedConsumerError, ValueError):
+        return None
+    if not oembed:
+        return None
+    # Keep width and height for some sites embedded videos
+    video_sites = ["youtube.com", "youtu.be", "vimeo.com", "kickstarter.com"]
+    if not any(site in oembed for site in video_sites):
+        # Keep height if width = 100%
+        if not re.search(r'\s+width="100%"', oembed):
+            oembed = re.sub(r'\s+height="[0-9]+"', " ", oembed)
+        # Ensure width is 100% not fixed
+        oembed = re.sub(r'\s+width="[0-9]+"', ' width="100%"', oembed)
+    # Wordpress sites use a random token and message events to identify the right iframe in order
+    # to set the rendered height. For this to work within a masonry grid, the parent script
+    # must already be loaded. Since in that context the parent script which updates the iframe
+    # tag with the token is not called, we add it here.
+    if "wp-embedded-content" in oembed:
+        oembed = re.sub(r'<script.*</script>', '', oembed, flags=re.S)
+        oembed = re.sub(r'<blockquote.*</blockquote>', '', oembed)
+        ltr = string.ascii_lowercase + string.digits
+        secret = ''.join(random.choice(ltr) for i in range(10))
+        oembed = re.sub(r'(<iframe.*src=".*?)"', '\g<1>#?secret='+secret+'" data-secret="'+secret+'"', oembed)
+    return oembed
 
 
 def fetch_oembed_preview(content, urls):
     """Fetch first oembed content for a list of urls."""
-    for url in urls:
-        # See first if recently cached already
-        if OEmbedCache.objects.filter(url=url, modified__gte=now()-datetime.timedelta(days=7)).exists():
-            oembed = OEmbedCache.objects.get(url=url)
-            Content.objects.filter(id=content.id).update(oembed=oembed)
-            return oembed
-        # Fetch oembed
-        options = {}
-        if url.startswith("https://twitter.com/"):
-            if len(url.split('/')) < 5:
-                # Skip, not enough sections to be a tweet
-                # We don't want to oembed profile streams
-                continue
-            # This probably has little effect since we fetch these on the backend...
-            # But, DNT is always good to communicate if possible :)
-            options = {"dnt": "true", "omit_script": "true"}
-        try:
-            oembed = PyEmbed(discoverer=OEmbedDiscoverer()).embed(url, **options)
-        except (PyEmbedError, PyEmbedDiscoveryError, PyEmbedConsumerError, ValueError):
+    # Skip twitter urls without enough sections to be a tweet, we don't want to oembed profile streams
+    urls = [url for url in urls if not url.startswith("https://twitter.com/") or len(url.split('/')) >= 5]
+    oembed, to_fetch = get_cached_previews(OEmbedCache, urls)
+    fetched = fetch_concurrently(get_oembed, to_fetch)
+    for url in to_fetch:
+        if url not in fetched:
+            # Timed out, try again next time
             continue
-        if not oembed:
+        html = fetched[url]
+        if not html:
+            cache_preview_failure(OEmbedCache, url)
             continue
-        # Keep width and height for some sites embedded videos
-        video_sites = ["youtube.com", "youtu.be", "vimeo.com", "kickstarter.com"]
-        if not any(site in oembed for site in video_sites):
-            # Keep height if width = 100%
-            if not re.search(r'\s+width="100%"', oembed):
-                oembed = re.sub(r'\s+height="[0-9]+"', " ", oembed)
-            # Ensure width is 100% not fixed
-            oembed = re.sub(r'\s+width="[0-9]+"', ' width="100%"', oembed)
-        # Wordpress sites use a random token and message events to identify the right iframe in order
-        # to set the rendered height. For this to work within a masonry grid, the parent script
-        # must already be loaded. Since in that context the parent script which updates the iframe
-        # tag with the token is not called, we add it here.
-        if "wp-embedded-content" in oembed:
-            oembed = re.sub(r'<script.*</script>', '', oembed, flags=re.S)
-            oembed = re.sub(r'<blockquote.*</blockquote>', '', oembed)
-            ltr = string.ascii_lowercase + string.digits
-            secret = ''.join(random.choice(ltr) for i in range(10))
-            oembed = re.sub(r'(<iframe.*src=".*?)"', '\g<1>#?secret='+secret+'" data-secret="'+secret+'"', oembed)
         try:
             with transaction.atomic():
-                oembed = OEmbedCache.objects.create(url=url, oembed=oembed)
+                oembed = OEmbedCache.objects.create(url=url, oembed=html)
         except IntegrityError:
-            # Some other process got ahead of us
+            # Already cached, but stale or failed
+            OEmbedCache.objects.filter(url=url).update(oembed=html, failed=False, modified=now())
             oembed = OEmbedCache.objects.get(url=url)
-            Content.objects.filter(id=content.id).update(oembed=oembed)
-            return oembed
-        Content.objects.filter(id=content.id).update(oembed=oembed)
-        return oembed
-    return False
+        break
+    else:
+        if not oembed:
+            return False
+    Content.objects.filter(id=content.id).update(oembed=oembed)
+    return oembed
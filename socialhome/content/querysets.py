@@ -1,4 +1,4 @@
-from typing import Dict, Tuple, TYPE_CHECKING, Any
+from typing import Dict, Tuple, TYPE_CHECKING, Any, Iterable, Set
 
 from django.db import models
 from django.db.models import Q, F, OuterRef, Subquery, Case, When, ObjectDoesNotExist
@@ -43,6 +43,15 @@ class ContentQuerySet(models.QuerySet):
             Q(fid=value) | Q(guid=value)
         ).filter(**params)
 
+    def fed_in(self, values: Iterable[str], **params) -> models.QuerySet:
+        """
+        Get Content by many federated IDs.
+        """
+        values = list(values)
+        return self.filter(
+            Q(fid__in=values) | Q(guid__in=values)
+        ).filter(**params)
+
     def fed_update_or_create(
         self, fid: str, values: Dict[str, Any], extra_lookups: Dict = None
     ) -> Tuple['Content', bool]:
@@ -91,6 +100,12 @@ class ContentQuerySet(models.QuerySet):
         )
         return qs.visible_for_user(user)
 
+    def get_shared_ids(self, content_ids: Iterable[int], profile_id: int) -> Set[int]:
+        """Get the ID's of the given content that the profile has shared."""
+        return set(
+            self.filter(share_of_id__in=content_ids, author_id=profile_id).values_list("share_of_id", flat=True),
+        )
+
     def limited(self, user, single_id: int = None):
         qs = self.top_level()
         if single_id:
@@ -1,12 +1,16 @@
 import re
-from typing import Dict, Any, Set, List
+from collections import OrderedDict
+from typing import Dict, Any, Set, List, Iterable
 
-from django.db.models import Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Manager, Q
 from django.utils.translation import ngettext as _
 from enumfields.drf import EnumField
 from federation.utils.text import validate_handle
 from rest_framework import serializers
-from rest_framework.fields import SerializerMethodField, BooleanField
+from rest_framework.fields import SerializerMethodField, BooleanField, SkipField
+from rest_framework.relations import PKOnlyObject
 
 from socialhome.content.enums import ContentType
 from socialhome.content.models import Content, Tag
@@ -47,6 +51,31 @@ class RecipientsField(serializers.Field):
         return list(value)
 
 
+class ContentListSerializer(serializers.ListSerializer):
+    """List serializer for Content.
+
+    If the ``cache_fragments`` context flag is set, the viewer independent part of each item is cached and only
+    the viewer dependent fields are serialized per request.
+    """
+    def to_representation(self, data) -> List[Dict[str, Any]]:
+        if not self.context.get("cache_fragments"):
+            return super().to_representation(data)
+        items = list(data.all() if isinstance(data, Manager) else data)
+        keys = {item.id: Content.get_serialized_cache_key(item.id) for item in items}
+        cached = cache.get_many(keys.values())
+        to_cache = {}
+        result = []
+        for item in items:
+            fragment = cached.get(keys[item.id])
+            if fragment is None:
+                fragment = self.child.to_fragment(item)
+                to_cache[keys[item.id]] = fragment
+            result.append(self.child.to_viewer_representation(item, fragment))
+        if to_cache:
+            cache.set_many(to_cache, timeout=settings.SOCIALHOME_CONTENT_SERIALIZED_CACHE_TIMEOUT)
+        return result
+
+
 class ContentSerializer(serializers.ModelSerializer):
     author = LimitedProfileSerializer(read_only=True)
     content_type = EnumField(ContentType, ints_as_names=True, read_only=True)
@@ -59,8 +88,21 @@ class ContentSerializer(serializers.ModelSerializer):
     through_author = SerializerMethodField()
     visibility = EnumField(Visibility, lenient=True, ints_as_names=True, required=False)
 
+    # Fields which depend on the viewer or the time of the request, and are never cached. The author is
+    # serialized per request too, since saving the profile doesn't clear the cached content.
+    viewer_fields = (
+        "author",
+        "humanized_timestamp",
+        "recipients",
+        "through",
+        "through_author",
+        "user_has_shared",
+        "user_is_author",
+    )
+
     class Meta:
         model = Content
+        list_serializer_class = ContentListSerializer
         fields = (
             "author",
             "content_type",
@@ -125,6 +167,7 @@ class ContentSerializer(serializers.ModelSerializer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.cache_through_authors()
+        self.cache_user_has_shared()
 
     def cache_through_authors(self):
         """
@@ -140,6 +183,18 @@ class ContentSerializer(serializers.ModelSerializer):
         throughs = Content.objects.visible_for_user(request.user).select_related("author").filter(id__in=list(ids))
         self.context["throughs_authors"] = {through_to_id.get(c.id, c.id): c.author for c in throughs}
 
+    def cache_user_has_shared(self):
+        """
+        If we have 'throughs', find out with one query which of them the user has shared.
+        """
+        request = self.context.get("request")
+        if not self.context.get("throughs") or not request or not hasattr(request.user, "profile"):
+            self.context["user_has_shared"] = {}
+            return
+        ids = set(self.context["throughs"].keys())
+        shared_ids = Content.objects.get_shared_ids(ids, request.user.profile.id)
+        self.context["user_has_shared"] = {id: id in shared_ids for id in ids}
+
     def get_through(self, obj):
         """Through is generally required only for serializing content for streams."""
         throughs = self.context.get("throughs")
@@ -170,7 +225,12 @@ class ContentSerializer(serializers.ModelSerializer):
         request = self.context.get("request")
         if not request:
             return False
-        return Content.has_shared(obj.id, request.user.profile.id) if hasattr(request.user, "profile") else False
+        if not hasattr(request.user, "profile"):
+            return False
+        user_has_shared = self.context.get("user_has_shared", {})
+        if obj.id in user_has_shared:
+            return user_has_shared[obj.id]
+        return Content.has_shared(obj.id, request.user.profile.id)
 
     def validate_parent(self, value):
         # Validate parent cannot be changed
@@ -191,6 +251,36 @@ class ContentSerializer(serializers.ModelSerializer):
 
         return result
 
+    def serialize_fields(self, instance: Content, fields: Iterable[serializers.Field]) -> Dict[str, Any]:
+        """Serialize the given fields, the same way as ``Serializer.to_representation`` does."""
+        result = OrderedDict()
+        for field in fields:
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            result[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+        return result
+
+    def to_fragment(self, instance: Content) -> Dict[str, Any]:
+        """Serialize the fields that are the same for all viewers."""
+        return self.serialize_fields(
+            instance, [field for field in self._readable_fields if field.field_name not in self.viewer_fields],
+        )
+
+    def to_viewer_representation(self, instance: Content, fragment: Dict[str, Any]) -> Dict[str, Any]:
+        """Combine a cached fragment with the viewer dependent fields."""
+        user_is_author = self.get_user_is_author(instance)
+        viewer_fields = [
+            field for field in self._readable_fields
+            if field.field_name in self.viewer_fields and (user_is_author or field.field_name != "recipients")
+        ]
+        result = dict(fragment, **self.serialize_fields(instance, viewer_fields))
+        if not user_is_author:
+            result["recipients"] = ""
+        return result
+
     def save(self, **kwargs: Dict):
         """
         Set possible recipients after save.
@@ -1,6 +1,9 @@
 import logging
+import time
+from typing import Dict, Iterable
 
 import django_rq
+from django.conf import settings
 from django.db import transaction
 from django.db.models.signals import post_save, m2m_changed, pre_delete
 from django.dispatch import receiver
@@ -13,31 +16,155 @@ from socialhome.content.previews import fetch_content_preview
 from socialhome.enums import Visibility
 from socialhome.federate.tasks import send_content, send_content_retraction, send_reply, send_share
 from socialhome.notifications.tasks import send_reply_notifications, send_share_notification, send_mention_notification
-from socialhome.streams.streams import update_streams_with_content
+from socialhome.streams.streams import (
+    update_streams_with_content, update_shared_timelines, remove_from_shared_timelines,
+)
 from socialhome.users.models import Profile
+from socialhome.utils import get_redis_connection
 
 logger = logging.getLogger("socialhome")
 
 
+# Stages of processing saved content, in order
+CONTENT_PIPELINE_STAGES = ("mentions", "tags", "preview", "render", "streams", "federation")
+# Stages run during the save when processing in a job, so that the content is rendered right away. The job
+# renders again if a preview was found.
+CONTENT_PIPELINE_INLINE_STAGES = ("mentions", "tags", "render")
+CONTENT_PIPELINE_JOB_STAGES = ("preview", "render", "streams", "federation")
+# Seconds to remember that a processing job is queued for a content, in case the job gets lost
+CONTENT_PIPELINE_PENDING_TIMEOUT = 3600
+
+
+def get_pipeline_pending_key(content_id: int) -> str:
+    return f"sh:content:pipeline:{content_id}"
+
+
 @receiver(post_save, sender=Content)
 def content_post_save(instance, **kwargs):
-    # TODO remove extract mentions from here when we have UI for creating mentions
-    if instance.local:
-        instance.extract_mentions()
-    fetch_preview(instance)
-    render_content(instance)
     created = kwargs.get("created")
+    instance.clear_serialized_cache()
     if created:
         if instance.content_type == ContentType.REPLY:
             transaction.on_commit(lambda: django_rq.enqueue(send_reply_notifications, instance.id))
         elif instance.content_type == ContentType.SHARE and instance.share_of.local:
             transaction.on_commit(lambda: django_rq.enqueue(send_share_notification, instance.id))
-        transaction.on_commit(lambda: update_streams_with_content(instance))
-    if instance.federate and instance.local:
+    if settings.SOCIALHOME_CONTENT_PIPELINE_ASYNC:
+        run_content_pipeline(instance, created, CONTENT_PIPELINE_INLINE_STAGES)
+        queue_content_pipeline(instance, created)
+    else:
+        run_content_pipeline(instance, created, CONTENT_PIPELINE_STAGES)
+
+
+def queue_content_pipeline(instance: Content, created: bool):
+    """Queue processing of saved content as one job, once the transaction has been committed.
+
+    Saves committed while a job for the content is queued but not started yet don't queue another one, since the
+    job loads the content when it starts. So several saves within a transaction are processed by one job.
+    """
+    content_id = instance.id
+
+    def enqueue():
+        if get_redis_connection().set(
+            get_pipeline_pending_key(content_id), 1, nx=True, ex=CONTENT_PIPELINE_PENDING_TIMEOUT,
+        ):
+            django_rq.enqueue(process_content, content_id, created)
+
+    transaction.on_commit(enqueue)
+
+
+def process_content(content_id: int, created: bool) -> Dict[str, float]:
+    """Job to run the content processing stages that are slow or can wait for saved content."""
+    # Saves from now on need another job
+    get_redis_connection().delete(get_pipeline_pending_key(content_id))
+    try:
+        content = Content.objects.select_related("author__user", "parent", "share_of").get(id=content_id)
+    except Content.DoesNotExist:
+        logger.warning("process_content - content %s not found", content_id)
+        return {}
+    return run_content_pipeline(content, created, CONTENT_PIPELINE_JOB_STAGES)
+
+
+def run_content_pipeline(content: Content, created: bool, stages: Iterable[str]) -> Dict[str, float]:
+    """Run the given content processing stages in order.
+
+    A failing stage is logged and doesn't stop the following stages.
+
+    :returns: Dictionary of stage durations in seconds.
+    """
+    context = {"created": created}
+    timings = {}
+    for stage in stages:
+        start = time.perf_counter()
+        try:
+            CONTENT_PIPELINE_STAGE_FUNCTIONS[stage](content, context)
+        except Exception as ex:
+            logger.exception("run_content_pipeline - stage %s failed for %s: %s", stage, content, ex)
+        timings[stage] = time.perf_counter() - start
+    logger.debug(
+        "run_content_pipeline - %s: %s", content.id,
+        ", ".join("%s %.3fs" % (stage, duration) for stage, duration in timings.items()),
+    )
+    return timings
+
+
+def pipeline_mentions(content: Content, context: Dict):
+    # TODO remove extract mentions from here when we have UI for creating mentions
+    if content.local:
+        content.extract_mentions()
+
+
+def pipeline_tags(content: Content, context: Dict):
+    context["text"] = content.get_and_linkify_tags()
+
+
+def pipeline_preview(content: Content, context: Dict):
+    context["preview"] = fetch_preview(content)
+
+
+def pipeline_render(content: Content, context: Dict):
+    if "preview" in context and not context["preview"] and "text" not in context:
+        # Already rendered during the save and there's no new preview to add
+        return
+    render_content(content, text=context.get("text"))
+    content.clear_serialized_cache()
+
+
+def pipeline_streams(content: Content, context: Dict):
+    if context["created"]:
+        # Runs immediately if not in a transaction, like when processing in a job
+        transaction.on_commit(lambda: update_streams_with_content(content))
+    else:
+        transaction.on_commit(lambda: update_shared_timelines(content))
+
+
+def pipeline_federation(content: Content, context: Dict):
+    if content.federate and content.local:
         # Get an activity to be used when federating
-        activity_type = ActivityType.CREATE if created else ActivityType.UPDATE
-        activity = instance.create_activity(activity_type)
-        transaction.on_commit(lambda: federate_content(instance, activity=activity))
+        activity_type = ActivityType.CREATE if context["created"] else ActivityType.UPDATE
+        activity = content.create_activity(activity_type)
+        transaction.on_commit(lambda: federate_content(content, activity=activity))
+
+
+CONTENT_PIPELINE_STAGE_FUNCTIONS = {
+    "mentions": pipeline_mentions,
+    "tags": pipeline_tags,
+    "preview": pipeline_preview,
+    "render": pipeline_render,
+    "streams": pipeline_streams,
+    "federation": pipeline_federation,
+}
+
+
+@receiver(pre_delete, sender=Content)
+def content_pre_delete(instance, **kwargs):
+    """Decrement the reply and share counts of related content."""
+    instance.update_related_counts(-1)
+
+
+@receiver(pre_delete, sender=Content)
+def content_pre_delete_shared_timelines(instance, **kwargs):
+    """Remove deleted content from the shared stream timelines."""
+    remove_from_shared_timelines(instance)
 
 
 @receiver(pre_delete, sender=Content)
@@ -53,10 +180,15 @@ def federate_content_retraction(instance, **kwargs):
 
 
 def fetch_preview(content):
+    """Fetch a preview for the content.
+
+    :returns: True if a preview was found
+    """
     try:
-        fetch_content_preview(content)
+        return bool(fetch_content_preview(content))
     except Exception as ex:
         logger.exception("Failed to fetch content preview for %s: %s", content, ex)
+        return False
 
 
 def on_commit_mentioned(action, pks, instance):
@@ -107,10 +239,10 @@ def content_limited_visibilities_change(sender, instance, action, pk_set, **kwar
         transaction.on_commit(lambda: on_commit_limited_visibilities(action, pk_set, instance))
 
 
-def render_content(content):
+def render_content(content, text: str = None):
     content.refresh_from_db()
     try:
-        content.render()
+        content.render(text=text)
     except Exception as ex:
         logger.exception("Failed to render text for %s: %s", content, ex)
 
@@ -0,0 +1,57 @@
+import logging
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db.models import F, Func, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+logger = logging.getLogger("socialhome")
+
+
+def count_subquery(qs):
+    """Count rows of a queryset filtered by an ``OuterRef``, as a subquery."""
+    return Coalesce(Subquery(qs.order_by().annotate(count=Func(F("id"), function="COUNT")).values("count")), Value(0))
+
+
+def reconcile_content_counts(batch_size: int = 5000):
+    """
+    Recount the incrementally maintained reply and share counts and fix any that have drifted.
+
+    Uses the same definitions as ``Content.cache_data``.
+    """
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.content.models import Content
+    qs = Content.objects.annotate(
+        actual_reply_count=count_subquery(
+            Content.objects.filter(root_parent_id=OuterRef("id")),
+        ) + count_subquery(
+            Content.objects.filter(parent__share_of_id=OuterRef("id")),
+        ),
+        actual_shares_count=count_subquery(Content.objects.filter(share_of_id=OuterRef("id"))),
+    )
+    fixed = 0
+    last_id = 0
+    while True:
+        ids = list(Content.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        drifted = qs.filter(id__gte=ids[0], id__lte=last_id).exclude(
+            reply_count=F("actual_reply_count"), shares_count=F("actual_shares_count"),
+        ).values_list("id", "actual_reply_count", "actual_shares_count")
+        for content_id, reply_count, shares_count in drifted:
+            Content.objects.filter(id=content_id).update(reply_count=reply_count, shares_count=shares_count)
+            cache.delete(Content.get_serialized_cache_key(content_id))
+            fixed += 1
+    logger.info("reconcile_content_counts - fixed counts of %s content", fixed)
+    return fixed
+
+
+def content_tasks(scheduler):
+    # Fix drifted reply and share counts
+    scheduler.schedule(
+        scheduled_time=datetime.utcnow(),
+        func=reconcile_content_counts,
+        interval=60*60*24,  # every 24 hours
+        timeout=60*60*2,  # 2 hours
+    )
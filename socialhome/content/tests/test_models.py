@@ -2,6 +2,7 @@ import datetime
 from unittest.mock import Mock
 
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.template.defaultfilters import truncatechars
 from django.template.loader import render_to_string
@@ -66,6 +67,37 @@ class TestContentModel(SocialhomeTestCase):
             pass
         self.site_content.refresh_from_db()
 
+    def test_cache_data__commit_clears_serialized_cache(self):
+        key = Content.get_serialized_cache_key(self.public_content.id)
+        cache.set(key, {"id": self.public_content.id})
+        self.public_content.cache_data()
+        self.assertIsNotNone(cache.get(key))
+        self.public_content.cache_data(commit=True)
+        self.assertIsNone(cache.get(key))
+
+    def test_update_related_counts(self):
+        content = ContentFactory(visibility=Visibility.PUBLIC)
+        share = ContentFactory(share_of=content, visibility=Visibility.PUBLIC)
+        reply = ContentFactory(parent=content)
+        ContentFactory(parent=reply)
+        content.refresh_from_db()
+        self.assertEqual((content.reply_count, content.shares_count), (2, 1))
+        ContentFactory(parent=share)
+        content.refresh_from_db()
+        # Replies to shares are counted both as children and as replies to shares, like in cache_data
+        self.assertEqual(content.reply_count, 4)
+
+        share.delete()
+        content.refresh_from_db()
+        self.assertEqual((content.reply_count, content.shares_count), (2, 0))
+        reply.delete()
+        content.refresh_from_db()
+        self.assertEqual(content.reply_count, 0)
+        # Never goes below zero
+        ContentFactory(parent=content).update_related_counts(-2)
+        content.refresh_from_db()
+        self.assertEqual(content.reply_count, 1)
+
     def test_create(self):
         content = ContentFactory()
         assert content.uuid
@@ -1,17 +1,30 @@
 import datetime
+import logging
+import os
+import time
+from unittest import skipUnless
 from unittest.mock import patch
 
+import pytest
+import requests
+from django.core.cache import cache
 from django.db import DataError
 from freezegun import freeze_time
 from pyembed.core import PyEmbedError
 from pyembed.core.consumer import PyEmbedConsumerError
-from pyembed.core.discovery import PyEmbedDiscoveryError
+from pyembed.core.discovery import ChainingDiscoverer, FileDiscoverer, PyEmbedDiscoveryError, StaticDiscoverer
 
 from socialhome.content.models import OpenGraphCache, OEmbedCache
-from socialhome.content.previews import fetch_content_preview, fetch_og_preview, OEmbedDiscoverer, fetch_oembed_preview
+from socialhome.content.previews import (
+    fetch_content_preview, fetch_og_preview, OEmbedDiscoverer, fetch_oembed_preview, fetch_concurrently, get_pyembed,
+    load_oembed_providers, OEMBED_PROVIDERS_FILE, OEMBED_EXTRA_PROVIDERS, OEmbedProviderIndex, OEmbedConsumer,
+    PREVIEW_REQUEST_TIMEOUT, OEMBED_PROVIDERS_CACHE_KEY,
+)
 from socialhome.content.tests.factories import ContentFactory, OpenGraphCacheFactory, OEmbedCacheFactory
 from socialhome.tests.utils import SocialhomeTestCase
 
+logger = logging.getLogger("socialhome")
+
 
 class MockOpenGraph(dict):
     @property
@@ -43,12 +56,12 @@ class TestFetchOgPreview(SocialhomeTestCase):
         with freeze_time(datetime.date.today() - datetime.timedelta(days=8)):
             OpenGraphCacheFactory(url=self.urls[0])
         fetch_og_preview(self.content, self.urls)
-        og.assert_called_once_with(url=self.urls[0], parser="lxml")
+        og.assert_called_once_with(url=self.urls[0], parser="lxml", timeout=PREVIEW_REQUEST_TIMEOUT)
 
     @patch("socialhome.content.previews.OpenGraph")
     def test_opengraph_fetch_called(self, og):
         fetch_og_preview(self.content, self.urls)
-        og.assert_called_once_with(url=self.urls[0], parser="lxml")
+        og.assert_called_once_with(url=self.urls[0], parser="lxml", timeout=PREVIEW_REQUEST_TIMEOUT)
 
     @patch("socialhome.content.previews.OpenGraph")
     def test_opengraph_ignored_if_not_enough_attributes(self, og):
@@ -83,6 +96,60 @@ class TestFetchOgPreview(SocialhomeTestCase):
         result = fetch_og_preview(self.content, self.urls)
         self.assertEqual(opengraph, result)
 
+    @patch("socialhome.content.previews.OpenGraph", return_value={})
+    def test_failure_is_cached(self, og):
+        self.assertFalse(fetch_og_preview(self.content, self.urls))
+        self.assertTrue(OpenGraphCache.objects.get(url=self.urls[0]).failed)
+        self.assertFalse(fetch_og_preview(self.content, self.urls))
+        self.assertEqual(og.call_count, 1)
+        # Tried again once the failure has expired
+        with freeze_time(datetime.datetime.now() + datetime.timedelta(days=2)):
+            og.return_value = MockOpenGraph({"title": "foo"})
+            opengraph = fetch_og_preview(self.content, self.urls)
+        self.assertEqual(og.call_count, 2)
+        self.assertEqual(opengraph.title, "foo")
+        self.assertFalse(opengraph.failed)
+
+    @patch("socialhome.content.previews.fetch_concurrently", return_value={})
+    def test_timeout_is_not_cached(self, mock_fetch):
+        self.assertFalse(fetch_og_preview(self.content, self.urls))
+        self.assertFalse(OpenGraphCache.objects.filter(url=self.urls[0]).exists())
+
+    @patch("socialhome.content.previews.OpenGraph")
+    def test_first_url_with_preview_is_used(self, og):
+        og.side_effect = lambda url, **kwargs: MockOpenGraph({"title": url}) if url != "https://example.com/1" else {}
+        urls = ["https://example.com/1", "https://example.com/2", "https://example.com/3"]
+        opengraph = fetch_og_preview(self.content, urls)
+        self.assertEqual(opengraph.title, "https://example.com/2")
+        self.assertEqual(og.call_count, 3)
+
+
+class TestFetchConcurrently(SocialhomeTestCase):
+    def test_returns_results(self):
+        self.assertEqual(fetch_concurrently(str.upper, ["a", "b"]), {"a": "A", "b": "B"})
+        self.assertEqual(fetch_concurrently(str.upper, []), {})
+
+    def test_failures_are_none(self):
+        def func(url):
+            if url == "b":
+                raise Exception("b failed")
+            return url
+        self.assertEqual(fetch_concurrently(func, ["a", "b"]), {"a": "a", "b": None})
+        self.assertEqual(fetch_concurrently(func, ["b"]), {"b": None})
+
+    @patch("socialhome.content.previews.get_preview_executor")
+    def test_single_url_is_fetched_without_pool(self, mock_executor):
+        self.assertEqual(fetch_concurrently(str.upper, ["a"]), {"a": "A"})
+        self.assertFalse(mock_executor.called)
+
+    @patch("socialhome.content.previews.PREVIEW_FETCH_TIMEOUT", new=0.1)
+    def test_timeouts_are_left_out(self):
+        def func(url):
+            if url == "slow":
+                time.sleep(0.5)
+            return url
+        self.assertEqual(fetch_concurrently(func, ["fast", "slow"]), {"fast": "fast"})
+
 
 class TestFetchContentPreview(SocialhomeTestCase):
     @classmethod
@@ -103,7 +170,7 @@ class TestFetchContentPreview(SocialhomeTestCase):
     @patch("socialhome.content.previews.fetch_oembed_preview", return_value="fooo", autospec=True)
     @patch("socialhome.content.previews.fetch_og_preview", autospec=True)
     def test_fetch_oembed_preview_called(self, fetch_og, fetch_oembed, find_urls):
-        fetch_content_preview(self.content)
+        self.assertEqual(fetch_content_preview(self.content), "fooo")
         fetch_oembed.assert_called_once_with(self.content, ["example.com"])
         self.assertTrue(fetch_og.called is False)
 
@@ -125,10 +192,141 @@ class TestFetchContentPreview(SocialhomeTestCase):
         assert not find_urls.called
 
 
+# Links seen in content, with and without a known oEmbed provider
+OEMBED_LINKS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "http://m.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://vimeo.com/76979871",
+    "https://player.vimeo.com/video/76979871",
+    "https://twitter.com/jasonrobinson/status/1029054340658819072",
+    "https://www.flickr.com/photos/jaywink/8547215396/",
+    "https://flic.kr/p/e1RJJa",
+    "https://soundcloud.com/forss/flickermood",
+    "https://www.instagram.com/p/BmXYc8tnEWC/",
+    "https://www.slideshare.net/haraldf/business-quotes-for-2011",
+    "https://www.dailymotion.com/video/x6ogg1z",
+    "https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC",
+    "https://www.kickstarter.com/projects/1115020221/the-collider",
+    "https://www.nextplatform.com/2018/08/13/some-article/",
+    "https://gist.github.com/jaywink/1d1a0ab2fbd6f8bb0f56cfbd0f3fd1b4",
+    "https://socialhome.network/content/123456/",
+    "https://git.feneas.org/socialhome/socialhome",
+    "https://github.com/jaywink/socialhome",
+    "https://en.wikipedia.org/wiki/Oembed",
+    "https://example.com",
+    "http://localhost:8000/streams/public/",
+    "ftp://example.com/file.txt",
+    "not an url",
+]
+
+
+def get_legacy_oembed_discoverer():
+    """The discoverer chain used before the provider index."""
+    return ChainingDiscoverer([
+        FileDiscoverer(OEMBED_PROVIDERS_FILE),
+        StaticDiscoverer(StaticDiscoverer._build_endpoints_from_providers(OEMBED_EXTRA_PROVIDERS)),
+    ])
+
+
 class TestOEmbedDiscoverer:
     def test_oembed_discoverer_inits(self):
         OEmbedDiscoverer()
 
+    def test_get_pyembed_is_reused(self):
+        assert get_pyembed() is get_pyembed()
+
+    @patch("socialhome.content.previews.load_oembed_providers", return_value=OEMBED_EXTRA_PROVIDERS)
+    def test_providers_are_loaded_once_on_first_use(self, mock_load):
+        discoverer = OEmbedDiscoverer()
+        assert mock_load.call_count == 0
+        list(discoverer.get_oembed_urls("https://twitter.com/foo"))
+        list(discoverer.get_oembed_urls("https://twitter.com/bar"))
+        assert mock_load.call_count == 1
+
+    def test_matches_legacy_discoverer(self):
+        legacy = get_legacy_oembed_discoverer()
+        discoverer = OEmbedDiscoverer(providers=load_oembed_providers(fetch_remote=False))
+        for url in OEMBED_LINKS:
+            for oembed_format in (None, "json", "xml"):
+                assert list(discoverer.get_oembed_urls(url, oembed_format)) == \
+                    list(legacy.get_oembed_urls(url, oembed_format)), url
+
+    def test_invalid_format_raises(self):
+        discoverer = OEmbedDiscoverer(providers=OEMBED_EXTRA_PROVIDERS)
+        with pytest.raises(PyEmbedDiscoveryError):
+            list(discoverer.get_oembed_urls("https://twitter.com/foo", "yaml"))
+
+
+class TestLoadOEmbedProviders:
+    def setup_method(self):
+        cache.delete(OEMBED_PROVIDERS_CACHE_KEY)
+
+    @patch("socialhome.content.previews.requests.get")
+    def test_remote_providers_are_added(self, mock_get):
+        mock_get.return_value.json.return_value = [{"provider_name": "Remote", "endpoints": []}]
+        providers = load_oembed_providers()
+        assert providers[-len(OEMBED_EXTRA_PROVIDERS) - 1]["provider_name"] == "Remote"
+        assert providers[-len(OEMBED_EXTRA_PROVIDERS):] == OEMBED_EXTRA_PROVIDERS
+
+    @patch("socialhome.content.previews.requests.get")
+    def test_remote_providers_are_cached(self, mock_get):
+        mock_get.return_value.json.return_value = [{"provider_name": "Remote", "endpoints": []}]
+        assert load_oembed_providers() == load_oembed_providers()
+        assert mock_get.call_count == 1
+
+    @patch("socialhome.content.previews.requests.get", side_effect=requests.ConnectionError)
+    def test_remote_failure_is_skipped(self, mock_get):
+        assert load_oembed_providers() == load_oembed_providers(fetch_remote=False)
+        # Not tried again for a while
+        load_oembed_providers()
+        assert mock_get.call_count == 1
+
+
+class TestOEmbedProviderIndex:
+    def setup_method(self):
+        self.index = OEmbedProviderIndex([
+            {"endpoints": [{"schemes": ["https://www.example.com/*"], "url": "https://example.com/oembed"}]},
+            {"endpoints": [{"schemes": ["http://*.example.org/*"], "url": "https://example.org/oembed"}]},
+            {"endpoints": [{"schemes": ["http://www.*.net/*"], "url": "https://example.net/oembed"}]},
+            {"endpoints": [{"url": "https://noschemes.com/oembed"}]},
+            {"endpoints": [{"schemes": ["https://www.example.com/*"], "url": "https://example.com/oembed"}]},
+        ])
+
+    def test_duplicate_and_incomplete_endpoints_are_skipped(self):
+        assert len(self.index.endpoints) == 3
+
+    def test_get_endpoints(self):
+        example_com, example_org, example_net = self.index.endpoints
+        assert self.index.get_endpoints("https://www.example.com/foo") == [example_com, example_net]
+        assert self.index.get_endpoints("https://foo.bar.example.org/foo") == [example_org, example_net]
+        assert self.index.get_endpoints("https://example.org/foo") == [example_org, example_net]
+        assert self.index.get_endpoints("https://example.com/foo") == [example_net]
+
+
+@skipUnless(os.environ.get("SOCIALHOME_BENCHMARKS"), "Set SOCIALHOME_BENCHMARKS=1 to run benchmarks")
+class TestOEmbedDiscovererBenchmark:
+    """Compare finding oEmbed urls with the chained discoverers to the provider index."""
+    rounds = 200
+
+    def timeit(self, discoverer):
+        start = time.perf_counter()
+        for _i in range(self.rounds):
+            for url in OEMBED_LINKS:
+                list(discoverer.get_oembed_urls(url))
+        return (time.perf_counter() - start) / (self.rounds * len(OEMBED_LINKS))
+
+    def test_benchmark(self):
+        legacy = get_legacy_oembed_discoverer()
+        discoverer = OEmbedDiscoverer(providers=load_oembed_providers(fetch_remote=False))
+        legacy_duration = self.timeit(legacy)
+        duration = self.timeit(discoverer)
+        logger.info(
+            "%s providers, per url: chained discoverers %.1f µs, provider index %.1f µs",
+            len(load_oembed_providers(fetch_remote=False)), legacy_duration * 1000000, duration * 1000000,
+        )
+
 
 class TestFetchOEmbedPreview(SocialhomeTestCase):
     @classmethod
@@ -137,7 +335,7 @@ class TestFetchOEmbedPreview(SocialhomeTestCase):
         cls.content = ContentFactory()
         cls.urls = ["https://example.com"]
 
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value="")
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="")
     def test_adds_dnt_flag_to_twitter_oembed(self, embed):
         fetch_oembed_preview(self.content, ["https://twitter.com/foobar/12345"])
         embed.assert_called_once_with("https://twitter.com/foobar/12345", dnt="true", omit_script="true")
@@ -148,52 +346,92 @@ class TestFetchOEmbedPreview(SocialhomeTestCase):
         self.content.refresh_from_db()
         self.assertEqual(self.content.oembed, result)
 
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value="")
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="")
     def test_cache_updated_if_previous_found_older_than_7_days(self, embed):
         with freeze_time(datetime.date.today() - datetime.timedelta(days=8)):
             OEmbedCacheFactory(url=self.urls[0])
         fetch_oembed_preview(self.content, self.urls)
         embed.assert_called_once_with(self.urls[0])
 
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value="")
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="")
     def test_pyembed_called(self, embed):
         fetch_oembed_preview(self.content, self.urls)
         embed.assert_called_once_with(self.urls[0])
 
     def test_pyembed_errors_swallowed(self):
         for error in [PyEmbedError, PyEmbedDiscoveryError, PyEmbedConsumerError, ValueError]:
-            with patch("socialhome.content.previews.PyEmbed.embed", side_effect=error):
+            with patch("socialhome.content.previews.OEmbedConsumer.embed", side_effect=error):
                 result = fetch_oembed_preview(self.content, self.urls)
                 self.assertFalse(result)
 
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value="")
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="")
     def test_skips_twitter_profile_stream_oembeds(self, embed):
         fetch_oembed_preview(self.content, ["https://twitter.com/foobar"])
         self.assertFalse(embed.called)
         self.content.refresh_from_db()
         self.assertIsNone(self.content.oembed)
 
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value="")
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="")
     def test_empty_oembed_skipped(self, embed):
         result = fetch_oembed_preview(self.content, self.urls)
         embed.assert_called_once_with(self.urls[0])
         self.assertFalse(result)
 
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value='foo width="50" height="100" bar')
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value='foo width="50" height="100" bar')
     def test_oembed_width_corrected(self, embed):
         result = fetch_oembed_preview(self.content, self.urls)
         self.assertEqual(result.oembed, 'foo width="100%"  bar')
 
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value="foobar")
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="foobar")
     def test_oembed_cache_created(self, embed):
         result = fetch_oembed_preview(self.content, self.urls)
         self.assertEqual(result.oembed, "foobar")
         self.content.refresh_from_db()
         self.assertEqual(self.content.oembed, result)
 
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="")
+    def test_failure_is_cached(self, embed):
+        self.assertFalse(fetch_oembed_preview(self.content, self.urls))
+        self.assertTrue(OEmbedCache.objects.get(url=self.urls[0]).failed)
+        self.assertFalse(fetch_oembed_preview(self.content, self.urls))
+        embed.assert_called_once_with(self.urls[0])
+
+    @patch("socialhome.content.previews.fetch_concurrently", return_value={})
+    def test_timeout_is_not_cached(self, mock_fetch):
+        self.assertFalse(fetch_oembed_preview(self.content, self.urls))
+        self.assertFalse(OEmbedCache.objects.filter(url=self.urls[0]).exists())
+
     @patch("socialhome.content.previews.OEmbedCache.objects.filter", return_value=OEmbedCache.objects.none())
-    @patch("socialhome.content.previews.PyEmbed.embed", return_value="foobar")
+    @patch("socialhome.content.previews.OEmbedConsumer.embed", return_value="foobar")
     def test_integrityerror_updates_with_found_cache(self, embed, filter):
         oembed = OEmbedCacheFactory(url=self.urls[0])
         result = fetch_oembed_preview(self.content, self.urls)
         self.assertEqual(result, oembed)
+
+
+class TestOEmbedConsumer:
+    def setup_method(self):
+        self.consumer = OEmbedConsumer(discoverer=OEmbedDiscoverer(providers=[{
+            "provider_name": "Example",
+            "endpoints": [{"schemes": ["https://example.com/*"], "url": "https://example.com/oembed"}],
+        }]))
+
+    @patch("socialhome.content.previews.requests.get")
+    def test_fetches_with_timeout(self, mock_get):
+        mock_get.return_value.ok = True
+        mock_get.return_value.headers = {"content-type": "application/json; charset=utf-8"}
+        mock_get.return_value.text = '{"type": "rich", "version": "1.0", "html": "<p>foo</p>"}'
+        assert self.consumer.embed("https://example.com/foo", dnt="true") == "<p>foo</p>"
+        assert mock_get.call_count == 1
+        assert mock_get.call_args[1] == {"params": {"dnt": "true"}, "timeout": PREVIEW_REQUEST_TIMEOUT}
+
+    @patch("socialhome.content.previews.requests.get", side_effect=requests.Timeout)
+    def test_timeout_raises(self, mock_get):
+        with pytest.raises(PyEmbedError):
+            self.consumer.embed("https://example.com/foo")
+
+    @patch("socialhome.content.previews.requests.get")
+    def test_invalid_responses_raise(self, mock_get):
+        mock_get.return_value.ok = False
+        with pytest.raises(PyEmbedConsumerError):
+            self.consumer.embed("https://example.com/foo")
@@ -417,6 +417,15 @@ class TestContentQuerySetShares(SocialhomeTestCase):
         )
         self.assertEqual(contents, set())
 
+    def test_get_shared_ids(self):
+        ids = [self.public_content.id, self.limited_content.id, self.site_content.id, self.self_content.id]
+        with self.assertNumQueries(1):
+            shared_ids = Content.objects.get_shared_ids(ids, self.other_user.profile.id)
+        self.assertEqual(shared_ids, {self.public_content.id, self.limited_content.id, self.site_content.id})
+        shared_ids = Content.objects.get_shared_ids([self.public_content.id], self.other_user.profile.id)
+        self.assertEqual(shared_ids, {self.public_content.id})
+        self.assertEqual(Content.objects.get_shared_ids(ids, self.profile.id), set())
+
     def test_shares(self):
         contents = set(Content.objects.shares(self.public_content.id, self.anonymous_user))
         self.assertEqual(contents, {self.public_share, self.public_share2})
@@ -2,6 +2,7 @@ from unittest.mock import Mock
 
 import pytest
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from rest_framework import serializers
 
 from socialhome.content.models import Content
@@ -200,6 +201,54 @@ class ContentSerializerTestCase(SocialhomeTestCase):
         )
         self.assertSetEqual(actual, expected)
 
+    def test_serialize__cache_fragments(self):
+        items = [self.content, self.limited_content2, self.share]
+        cache.delete_many([Content.get_serialized_cache_key(item.id) for item in items])
+        context = {"request": Mock(user=self.user), "throughs": {self.content.id: self.share.id}}
+        expected = [dict(data) for data in ContentSerializer(items, many=True, context=context).data]
+        context = dict(context, cache_fragments=True)
+        self.assertEqual(ContentSerializer(items, many=True, context=context).data, expected)
+        self.assertIsNotNone(cache.get(Content.get_serialized_cache_key(self.content.id)))
+        # Served from cache
+        with self.assertNumQueries(0):
+            data = ContentSerializer([self.content], many=True, context={
+                "cache_fragments": True, "request": Mock(user=AnonymousUser()),
+            }).data
+        self.assertFalse(data[0]["user_is_author"])
+        self.assertEqual(data[0]["through"], self.content.id)
+        self.assertEqual(data[0]["through_author"], {})
+        self.assertFalse(data[0]["author"]["user_following"])
+
+    def test_serialize__cache_fragments__viewer_fields_are_not_cached(self):
+        items = [self.limited_content2]
+        cache.delete(Content.get_serialized_cache_key(self.limited_content2.id))
+        data = ContentSerializer(items, many=True, context={
+            "cache_fragments": True, "request": Mock(user=self.user),
+        }).data
+        self.assertTrue(data[0]["user_is_author"])
+        data = ContentSerializer(items, many=True, context={
+            "cache_fragments": True, "request": Mock(user=PublicUserFactory()),
+        }).data
+        self.assertFalse(data[0]["user_is_author"])
+        self.assertEqual(data[0]["recipients"], "")
+
+    def test_serialize__cache_fragments__cleared_on_save(self):
+        content = PublicContentFactory()
+        ContentSerializer([content], many=True, context={"cache_fragments": True}).data
+        content.text = "Updated text"
+        content.save()
+        data = ContentSerializer([content], many=True, context={"cache_fragments": True}).data
+        self.assertEqual(data[0]["text"], "Updated text")
+
+    def test_serialize__cache_fragments__author_is_not_cached(self):
+        content = PublicContentFactory()
+        ContentSerializer([content], many=True, context={"cache_fragments": True}).data
+        content.author.name = "Updated name"
+        content.author.save()
+        content = Content.objects.select_related("author").get(id=content.id)
+        data = ContentSerializer([content], many=True, context={"cache_fragments": True}).data
+        self.assertEqual(data[0]["author"]["name"], "Updated name")
+
     def test_serializes_through(self):
         serializer = ContentSerializer(self.content)
         self.assertEqual(serializer.data["through"], self.content.id)
@@ -256,6 +305,18 @@ class ContentSerializerTestCase(SocialhomeTestCase):
         serializer = ContentSerializer(context={"request": Mock(user=self.user)})
         self.assertTrue(serializer.get_user_has_shared(self.content))
 
+    def test_user_has_shared__uses_throughs(self):
+        self.content.share(self.profile)
+        # One for through authors, one for shares
+        with self.assertNumQueries(2):
+            serializer = ContentSerializer(context={
+                "request": Mock(user=self.user), "throughs": {self.content.id: self.content.id, self.reply.id: 1},
+            })
+        self.assertEqual(serializer.context["user_has_shared"], {self.content.id: True, self.reply.id: False})
+        with self.assertNumQueries(0):
+            self.assertTrue(serializer.get_user_has_shared(self.content))
+            self.assertFalse(serializer.get_user_has_shared(self.reply))
+
     def test_tags_if_no_tag(self):
         self.content.tags.clear()
         serializer = ContentSerializer(self.content, context={"request": Mock(user=self.user)})
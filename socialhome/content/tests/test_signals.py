@@ -1,10 +1,16 @@
 from unittest import mock
 from unittest.mock import patch, Mock, call
 
+from django.db import transaction
+from django.test import override_settings
 from federation.entities.activitypub.enums import ActivityType
 
 from socialhome.content.enums import ContentType
 from socialhome.content.models import Tag
+from socialhome.content.signals import (
+    CONTENT_PIPELINE_STAGES, CONTENT_PIPELINE_STAGE_FUNCTIONS, CONTENT_PIPELINE_JOB_STAGES, process_content,
+    run_content_pipeline, get_pipeline_pending_key,
+)
 from socialhome.content.tests.factories import ContentFactory
 from socialhome.enums import Visibility
 from socialhome.federate.tasks import send_content, send_reply, send_share
@@ -12,6 +18,7 @@ from socialhome.notifications.tasks import send_reply_notifications, send_share_
 from socialhome.streams.streams import update_streams_with_content
 from socialhome.tests.utils import SocialhomeTestCase, SocialhomeTransactionTestCase
 from socialhome.users.tests.factories import UserFactory, PublicUserFactory, ProfileFactory
+from socialhome.utils import get_redis_connection
 
 
 class TestContentMentionsChange(SocialhomeTransactionTestCase):
@@ -64,6 +71,99 @@ class TestContentPostSave(SocialhomeTransactionTestCase):
         content.save()
         self.assertFalse(mock_update.called)
 
+    @patch("socialhome.content.signals.update_shared_timelines")
+    def test_calls_update_shared_timelines_on_update(self, mock_update):
+        content = ContentFactory()
+        self.assertFalse(mock_update.called)
+        content.text = "update!"
+        content.save()
+        mock_update.assert_called_once_with(content)
+
+    @override_settings(SOCIALHOME_CONTENT_PIPELINE_ASYNC=True)
+    @patch("socialhome.content.signals.django_rq.enqueue", autospec=True)
+    def test_queues_one_job_per_transaction(self, mock_enqueue):
+        with transaction.atomic():
+            content = ContentFactory()
+            content.text = "**update!**"
+            content.save()
+            self.assertFalse(mock_enqueue.called)
+        # Rendered already during the save
+        self.assertEqual(content.rendered, "<p><strong>update!</strong></p>")
+        mock_enqueue.assert_called_once_with(process_content, content.id, True)
+        # Not queued again until the job has started
+        content.save()
+        self.assertEqual(mock_enqueue.call_count, 1)
+        with patch("socialhome.content.signals.run_content_pipeline"):
+            process_content(content.id, True)
+        content.save()
+        self.assertEqual(mock_enqueue.call_args_list[1:], [call(process_content, content.id, False)])
+
+    @override_settings(SOCIALHOME_CONTENT_PIPELINE_ASYNC=True)
+    @patch("socialhome.content.signals.django_rq.enqueue", autospec=True)
+    def test_queues_again_after_rollback(self, mock_enqueue):
+        content = ContentFactory()
+        get_redis_connection().delete(get_pipeline_pending_key(content.id))
+        mock_enqueue.reset_mock()
+        with self.assertRaises(ValueError), transaction.atomic():
+            content.save()
+            raise ValueError
+        self.assertFalse(mock_enqueue.called)
+        content.save()
+        mock_enqueue.assert_called_once_with(process_content, content.id, False)
+
+    @override_settings(SOCIALHOME_CONTENT_PIPELINE_ASYNC=True)
+    @patch("socialhome.content.signals.django_rq.enqueue", autospec=True)
+    def test_queues_again_after_savepoint_rollback(self, mock_enqueue):
+        content = ContentFactory()
+        get_redis_connection().delete(get_pipeline_pending_key(content.id))
+        mock_enqueue.reset_mock()
+        with transaction.atomic():
+            with self.assertRaises(ValueError), transaction.atomic():
+                content.save()
+                raise ValueError
+            content.save()
+        mock_enqueue.assert_called_once_with(process_content, content.id, False)
+
+
+class TestContentPipeline(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.content = ContentFactory(text="#foobar")
+
+    def test_run_content_pipeline(self):
+        timings = run_content_pipeline(self.content, False, CONTENT_PIPELINE_STAGES)
+        self.assertEqual(list(timings.keys()), list(CONTENT_PIPELINE_STAGES))
+        self.assertEqual(set(self.content.tags.values_list("name", flat=True)), {"foobar"})
+        self.assertIn('href="/streams/tag/foobar/"', self.content.rendered)
+
+    @patch("socialhome.content.signals.logger.exception")
+    def test_run_content_pipeline__continues_after_failing_stage(self, mock_logger):
+        with patch.dict(CONTENT_PIPELINE_STAGE_FUNCTIONS, {"mentions": Mock(side_effect=Exception), "tags": Mock()}):
+            timings = run_content_pipeline(self.content, False, ("mentions", "tags"))
+            CONTENT_PIPELINE_STAGE_FUNCTIONS["tags"].assert_called_once_with(self.content, {"created": False})
+        self.assertEqual(len(timings), 2)
+        self.assertTrue(mock_logger.called)
+
+    @patch("socialhome.content.signals.run_content_pipeline", return_value={})
+    def test_process_content(self, mock_run):
+        process_content(self.content.id, True)
+        mock_run.assert_called_once_with(self.content, True, CONTENT_PIPELINE_JOB_STAGES)
+
+    @patch("socialhome.content.signals.fetch_content_preview", return_value=None)
+    @patch("socialhome.content.signals.render_content")
+    def test_job_renders_only_if_preview_found(self, mock_render, mock_fetch):
+        run_content_pipeline(self.content, False, ("preview", "render"))
+        self.assertFalse(mock_render.called)
+        mock_fetch.return_value = Mock()
+        run_content_pipeline(self.content, False, ("preview", "render"))
+        mock_render.assert_called_once_with(self.content, text=None)
+
+    @patch("socialhome.content.signals.run_content_pipeline", return_value={})
+    def test_process_content__content_not_found(self, mock_run):
+        self.assertEqual(process_content(-1, True), {})
+        self.assertFalse(mock_run.called)
+
 
 class TestNotifyListeners(SocialhomeTestCase):
     @classmethod
@@ -318,7 +418,7 @@ class TestRenderContent(SocialhomeTestCase):
         content = ContentFactory()
         content.render = Mock()
         content.save()
-        content.render.assert_called_once_with()
+        content.render.assert_called_once_with(text=content.get_and_linkify_tags())
 
     @patch("socialhome.content.signals.logger.exception")
     def test_render_content_exception_logger_called(self, logger):
@@ -0,0 +1,41 @@
+from unittest.mock import Mock
+
+from socialhome.content.models import Content
+from socialhome.content.tasks import content_tasks, reconcile_content_counts
+from socialhome.content.tests.factories import PublicContentFactory
+from socialhome.tests.utils import SocialhomeTestCase
+
+
+def test_content_tasks():
+    mock_scheduler = Mock()
+    content_tasks(mock_scheduler)
+    _args, kwargs = mock_scheduler.schedule.call_args_list[0]
+    assert kwargs["func"] == reconcile_content_counts
+
+
+class TestReconcileContentCounts(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.content = PublicContentFactory()
+        cls.share = PublicContentFactory(share_of=cls.content)
+        cls.reply = PublicContentFactory(parent=cls.content)
+        cls.reply2 = PublicContentFactory(parent=cls.reply)
+        cls.share_reply = PublicContentFactory(parent=cls.share)
+        cls.other_content = PublicContentFactory()
+
+    def assert_counts_match_recount(self):
+        for content in Content.objects.all():
+            reply_count, shares_count = content.reply_count, content.shares_count
+            content.cache_data()
+            self.assertEqual((reply_count, shares_count), (content.reply_count, content.shares_count))
+
+    def test_counts_are_maintained_incrementally(self):
+        self.assert_counts_match_recount()
+        self.assertEqual(reconcile_content_counts(), 0)
+
+    def test_fixes_drifted_counts(self):
+        Content.objects.filter(id=self.content.id).update(reply_count=100, shares_count=0)
+        Content.objects.filter(id=self.other_content.id).update(reply_count=2)
+        self.assertEqual(reconcile_content_counts(batch_size=2), 2)
+        self.assert_counts_match_recount()
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class FederateConfig(AppConfig):
     name = "socialhome.federate"
     verbose_name = "Federate"
+
+    def ready(self):
+        """Record the results of outbound sends for the delivery queue."""
+        from socialhome.federate.delivery import install_send_document_recorder
+        install_send_document_recorder()
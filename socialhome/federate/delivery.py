@@ -0,0 +1,305 @@
+import logging
+import pickle
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import django_rq
+from django.conf import settings
+from federation import outbound
+from federation.outbound import handle_send
+from federation.utils.network import send_document
+
+from socialhome.users.utils import with_private_key
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
+
+# Seconds to wait before the first retry of a failed delivery, doubled on each attempt
+DELIVERY_BACKOFF = 60
+# Seconds to wait before trying again when all delivery slots of a host are in use
+DELIVERY_BUSY_DELAY = 5
+# Times a delivery is put back because all delivery slots of the host are in use, before giving up
+DELIVERY_MAX_BUSY_RESCHEDULES = 60
+# Seconds after which a delivery slot is freed even if the job holding it died
+DELIVERY_SLOT_TIMEOUT = 600
+# Most pending deliveries to queue per run of ``queue_due_deliveries``
+DUE_DELIVERIES_BATCH_SIZE = 1000
+
+# Deliveries waiting for a retry, a free slot or a paused host. Kept in Redis rather than as scheduler jobs, so
+# they survive restarts of the scheduler. IDs scored by due time, with the delivery arguments by ID.
+PENDING_DELIVERIES_KEY = "sh:delivery:pending"
+PENDING_DELIVERIES_DATA_KEY = "sh:delivery:pending:data"
+
+# Take a delivery slot of a host unless all are in use. Slots are held in a sorted set by the time they were
+# taken, so that slots of jobs that died without releasing them expire one by one.
+# KEYS: slots key. ARGV: time now, slot timeout, concurrency, slot holder.
+ACQUIRE_SLOT_SCRIPT = """
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1] - ARGV[2])
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], ARGV[1], ARGV[4])
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+return 1
+"""
+
+# Claim the pending deliveries that are due, removing them.
+# KEYS: pending key, pending data key. ARGV: time now, most to claim.
+CLAIM_DUE_DELIVERIES_SCRIPT = """
+local ids = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+local result = {}
+for _, id in ipairs(ids) do
+    local data = redis.call("HGET", KEYS[2], id)
+    if data then
+        result[#result + 1] = data
+    end
+    redis.call("ZREM", KEYS[1], id)
+    redis.call("HDEL", KEYS[2], id)
+end
+return result
+"""
+
+_deliveries = threading.local()
+
+
+def get_delivery_host(endpoint: str) -> str:
+    return urlsplit(endpoint or "").netloc.lower()
+
+
+def get_host_key(host: str) -> str:
+    return f"sh:delivery:host:{host}"
+
+
+def get_circuit_key(host: str) -> str:
+    return f"sh:delivery:circuit:{host}"
+
+
+def get_slots_key(host: str) -> str:
+    return f"sh:delivery:slots:{host}"
+
+
+def record_send_document(url, data, *args, **kwargs):
+    """Send a document with ``send_document``, recording the result for the running delivery job.
+
+    ``handle_send`` doesn't return the results of the sends it does, so this is installed in its place in
+    ``federation.outbound``. See ``FederateConfig.ready``.
+    """
+    start = time.perf_counter()
+    status, error = send_document(url, data, *args, **kwargs)
+    results = getattr(_deliveries, "results", None)
+    if results is not None:
+        results.append((url, status, error, time.perf_counter() - start))
+    return status, error
+
+
+def install_send_document_recorder():
+    outbound.send_document = record_send_document
+
+
+def is_failed_send(status: Optional[int], error: Optional[Exception]) -> bool:
+    """Whether a send should be retried. Other client errors won't get better by retrying."""
+    return bool(error) or not status or status == 429 or status >= 500
+
+
+def queue_send(entity, author_user, recipients: List[Dict], parent_user=None, payload_logger=None) -> None:
+    """Queue sending an entity, one delivery job per remote host.
+
+    A slow or dead server then only holds up the deliveries to itself. See ``deliver_to_host``.
+    Takes the same arguments as ``federation.outbound.handle_send``.
+    """
+    by_host = defaultdict(list)
+    for recipient in recipients:
+        by_host[get_delivery_host(recipient["endpoint"])].append(recipient)
+    r = get_redis_connection()
+    for host, host_recipients in by_host.items():
+        with r.pipeline() as pipe:
+            pipe.sadd("sh:delivery:hosts", host)
+            pipe.hincrby(get_host_key(host), "depth", 1)
+            pipe.execute()
+        django_rq.enqueue(
+            deliver_to_host, host, entity, author_user, host_recipients, parent_user=parent_user,
+            payload_logger=payload_logger, queued_at=time.time(),
+        )
+
+
+def schedule_delivery(delay: int, host: str, entity, author_user, recipients: List[Dict], **kwargs) -> None:
+    """Store a delivery to be queued in ``delay`` seconds by ``queue_due_deliveries``."""
+    delivery_id = uuid.uuid4().hex
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        pipe.hset(
+            PENDING_DELIVERIES_DATA_KEY, delivery_id, pickle.dumps((host, entity, author_user, recipients, kwargs)),
+        )
+        pipe.zadd(PENDING_DELIVERIES_KEY, {delivery_id: time.time() + delay})
+        pipe.execute()
+
+
+def queue_due_deliveries(batch_size: int = DUE_DELIVERIES_BATCH_SIZE) -> int:
+    """Queue the pending deliveries that are due, see ``schedule_delivery``.
+
+    :returns: Count of deliveries queued
+    """
+    r = get_redis_connection()
+    script = r.register_script(CLAIM_DUE_DELIVERIES_SCRIPT)
+    queued = 0
+    while True:
+        items = script(keys=[PENDING_DELIVERIES_KEY, PENDING_DELIVERIES_DATA_KEY], args=[time.time(), batch_size])
+        for item in items:
+            host, entity, author_user, recipients, kwargs = pickle.loads(item)
+            django_rq.enqueue(deliver_to_host, host, entity, author_user, recipients, **kwargs)
+        queued += len(items)
+        if len(items) < batch_size:
+            break
+    if queued:
+        logger.debug("queue_due_deliveries - queued %s deliveries", queued)
+    return queued
+
+
+def acquire_slot(host: str) -> Optional[str]:
+    """Take a delivery slot of a host, see ``ACQUIRE_SLOT_SCRIPT``.
+
+    :returns: The slot holder to release the slot with, or None if all slots are in use.
+    """
+    holder = uuid.uuid4().hex
+    script = get_redis_connection().register_script(ACQUIRE_SLOT_SCRIPT)
+    acquired = script(
+        keys=[get_slots_key(host)],
+        args=[time.time(), DELIVERY_SLOT_TIMEOUT, settings.SOCIALHOME_DELIVERY_HOST_CONCURRENCY, holder],
+    )
+    return holder if acquired else None
+
+
+def release_slot(host: str, holder: str) -> None:
+    get_redis_connection().zrem(get_slots_key(host), holder)
+
+
+def record_results(host: str, results: List[Tuple], queued_at: float = None) -> bool:
+    """Record the results of a delivery to a host and open its circuit if it keeps failing.
+
+    :returns: True if any send failed
+    """
+    failed = [result for result in results if is_failed_send(result[1], result[2])]
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        pipe.hincrby(get_host_key(host), "sent", len(results) - len(failed))
+        pipe.hincrby(get_host_key(host), "failed", len(failed))
+        if results:
+            pipe.hincrbyfloat(get_host_key(host), "latency_total", sum(result[3] for result in results))
+            pipe.hincrby(get_host_key(host), "latency_count", len(results))
+        if queued_at:
+            pipe.hset(get_host_key(host), "queue_latency", time.time() - queued_at)
+        if failed:
+            pipe.hincrby(get_host_key(host), "consecutive_failures", 1)
+        else:
+            pipe.hset(get_host_key(host), "consecutive_failures", 0)
+        values = pipe.execute()
+    if failed and values[-1] >= settings.SOCIALHOME_DELIVERY_CIRCUIT_THRESHOLD:
+        logger.warning("record_results - %s failed %s times in a row, pausing deliveries", host, values[-1])
+        r.set(get_circuit_key(host), 1, ex=settings.SOCIALHOME_DELIVERY_CIRCUIT_TIMEOUT)
+    return bool(failed)
+
+
+def deliver_to_host(
+    host: str, entity, author_user, recipients: List[Dict], parent_user=None, payload_logger=None, attempt: int = 1,
+    queued_at: float = None, busy: int = 0,
+) -> None:
+    """Deliver an entity to the recipients on one remote host.
+
+    Deliveries to a host are limited to ``SOCIALHOME_DELIVERY_HOST_CONCURRENCY`` at a time. Failed sends are
+    retried with exponential backoff and a host that keeps failing is paused for a while.
+
+    :param busy: Times the delivery has been put back since the last attempt, because the host was busy.
+    """
+    kwargs = {"parent_user": parent_user, "payload_logger": payload_logger, "queued_at": queued_at}
+    r = get_redis_connection()
+    circuit_ttl = r.ttl(get_circuit_key(host))
+    if circuit_ttl and circuit_ttl > 0:
+        logger.debug("deliver_to_host - deliveries to %s paused for %s seconds", host, circuit_ttl)
+        schedule_delivery(circuit_ttl, host, entity, author_user, recipients, attempt=attempt, **kwargs)
+        return
+    holder = acquire_slot(host)
+    if not holder:
+        if busy >= DELIVERY_MAX_BUSY_RESCHEDULES:
+            logger.warning("deliver_to_host - giving up delivering to %s, busy %s times in a row", host, busy)
+            with r.pipeline() as pipe:
+                pipe.hincrby(get_host_key(host), "failed", len(recipients))
+                pipe.hincrby(get_host_key(host), "depth", -1)
+                pipe.execute()
+            return
+        schedule_delivery(
+            DELIVERY_BUSY_DELAY, host, entity, author_user, recipients, attempt=attempt, busy=busy + 1, **kwargs,
+        )
+        return
+    _deliveries.results = []
+    try:
+        handle_send(
+            entity, with_private_key(author_user), recipients,
+            parent_user=with_private_key(parent_user) if parent_user else None, payload_logger=payload_logger,
+        )
+        results = _deliveries.results
+    except Exception:
+        # Not retried, as the same entity would fail again
+        logger.exception("deliver_to_host - failed to send to %s", host)
+        with r.pipeline() as pipe:
+            pipe.hincrby(get_host_key(host), "failed", len(recipients))
+            pipe.hincrby(get_host_key(host), "depth", -1)
+            pipe.execute()
+        raise
+    finally:
+        _deliveries.results = None
+        release_slot(host, holder)
+    if not record_results(host, results, queued_at):
+        r.hincrby(get_host_key(host), "depth", -1)
+        return
+    if attempt >= settings.SOCIALHOME_DELIVERY_MAX_ATTEMPTS:
+        logger.warning("deliver_to_host - giving up delivering to %s after %s attempts", host, attempt)
+        r.hincrby(get_host_key(host), "depth", -1)
+        return
+    failed_urls = {url for url, status, error, _duration in results if is_failed_send(status, error)}
+    # Matrix sends go to other urls than the recipient endpoint, retry all recipients for those
+    retry_recipients = [recipient for recipient in recipients if recipient["endpoint"] in failed_urls] or recipients
+    schedule_delivery(
+        DELIVERY_BACKOFF * 2 ** (attempt - 1), host, entity, author_user, retry_recipients, attempt=attempt + 1,
+        **kwargs,
+    )
+
+
+def get_delivery_stats() -> Dict[str, Dict]:
+    """Get queue depth, latency and health of deliveries per remote host."""
+    r = get_redis_connection()
+    hosts = sorted(host.decode("utf-8") for host in r.smembers("sh:delivery:hosts"))
+    with r.pipeline() as pipe:
+        for host in hosts:
+            pipe.hgetall(get_host_key(host))
+            pipe.zcount(get_slots_key(host), time.time() - DELIVERY_SLOT_TIMEOUT, "+inf")
+            pipe.ttl(get_circuit_key(host))
+        values = pipe.execute()
+    stats = {}
+    for i, host in enumerate(hosts):
+        data, slots, circuit_ttl = values[i * 3:i * 3 + 3]
+        data = {key.decode("utf-8"): float(value) for key, value in data.items()}
+        latency_count = data.get("latency_count", 0)
+        stats[host] = {
+            "depth": int(data.get("depth", 0)),
+            "active": int(slots or 0),
+            "sent": int(data.get("sent", 0)),
+            "failed": int(data.get("failed", 0)),
+            "latency": data["latency_total"] / latency_count if latency_count else None,
+            "queue_latency": data.get("queue_latency"),
+            "paused_for": max(circuit_ttl, 0),
+        }
+    return stats
+
+
+def delivery_tasks(scheduler):
+    # Queue the deliveries due for a retry
+    scheduler.schedule(
+        scheduled_time=datetime.utcnow(),
+        func=queue_due_deliveries,
+        interval=60,  # every minute
+    )
@@ -0,0 +1,162 @@
+import logging
+import pickle
+import time
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections
+from federation.types import RequestType
+
+from socialhome.federate.tasks import get_received_entities
+from socialhome.federate.utils.tasks import process_entities
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
+
+INBOUND_QUEUE_KEY = "sh:inbound:queue"
+# Payloads popped by the consumer, kept until their batch has been processed
+INBOUND_PROCESSING_KEY = "sh:inbound:processing"
+# Seconds a remote server is asked to wait before sending again when the inbound backlog is full
+INBOUND_RETRY_AFTER = 60
+
+# Both lists have the newest payload on the left.
+# Pop the ARGV[1] oldest payloads from the queue KEYS[1] and keep them in the processing list KEYS[2].
+# Returns the payloads, oldest first.
+POP_PAYLOADS_SCRIPT = """
+local items = redis.call("LRANGE", KEYS[1], -tonumber(ARGV[1]), -1)
+if #items == 0 then
+    return {}
+end
+redis.call("LTRIM", KEYS[1], 0, -#items - 1)
+local popped = {}
+for i = #items, 1, -1 do
+    redis.call("LPUSH", KEYS[2], items[i])
+    popped[#popped + 1] = items[i]
+end
+return popped
+"""
+
+# Put the payloads of the processing list KEYS[2] back to be popped first from the queue KEYS[1].
+# Returns the number of payloads put back.
+REQUEUE_PAYLOADS_SCRIPT = """
+local items = redis.call("LRANGE", KEYS[2], 0, -1)
+for i = 1, #items do
+    redis.call("RPUSH", KEYS[1], items[i])
+end
+redis.call("DEL", KEYS[2])
+return #items
+"""
+
+
+def push_payload(request: RequestType, uuid: str = None) -> int:
+    """Push a received payload to the inbound queue for ``consume_payloads``.
+
+    :returns: Length of the queue after the push
+    """
+    return get_redis_connection().lpush(INBOUND_QUEUE_KEY, pickle.dumps((request, uuid)))
+
+
+def get_backlog() -> int:
+    return get_redis_connection().llen(INBOUND_QUEUE_KEY)
+
+
+def is_backlogged() -> bool:
+    """Whether received payloads should be refused until the consumer catches up."""
+    if not settings.SOCIALHOME_INBOUND_BATCHING:
+        return False
+    return get_backlog() >= settings.SOCIALHOME_INBOUND_MAX_BACKLOG
+
+
+def pop_payloads(batch_size: int, wait: float) -> List[Tuple[RequestType, Optional[str]]]:
+    """Pop a batch of received payloads from the inbound queue.
+
+    Returns once ``batch_size`` payloads have been popped or ``wait`` seconds have passed, whichever comes first.
+    The popped payloads are kept in a processing list until ``finish_payloads`` is called, so that a batch
+    is not lost if the consumer stops while processing it.
+    """
+    r = get_redis_connection()
+    pop = r.register_script(POP_PAYLOADS_SCRIPT)
+    deadline = time.monotonic() + wait
+    items = []
+    while len(items) < batch_size:
+        items.extend(pop(keys=[INBOUND_QUEUE_KEY, INBOUND_PROCESSING_KEY], args=[batch_size - len(items)]))
+        remaining = deadline - time.monotonic()
+        if len(items) >= batch_size or remaining <= 0:
+            break
+        # Block until more arrives, BRPOPLPUSH only takes whole seconds
+        item = r.brpoplpush(INBOUND_QUEUE_KEY, INBOUND_PROCESSING_KEY, timeout=max(int(remaining), 1))
+        if not item:
+            break
+        items.append(item)
+    payloads = []
+    for item in items:
+        try:
+            payloads.append(pickle.loads(item))
+        except Exception as ex:
+            logger.warning("pop_payloads - skipping payload that could not be loaded: %s", ex)
+    return payloads
+
+
+def finish_payloads():
+    """Forget the popped payloads once their batch has been processed."""
+    get_redis_connection().delete(INBOUND_PROCESSING_KEY)
+
+
+def requeue_payloads() -> int:
+    """Put payloads left over from a batch that was not processed back to the front of the inbound queue.
+
+    :returns: Number of payloads put back
+    """
+    r = get_redis_connection()
+    requeue = r.register_script(REQUEUE_PAYLOADS_SCRIPT)
+    return requeue(keys=[INBOUND_QUEUE_KEY, INBOUND_PROCESSING_KEY])
+
+
+def receive_payloads(payloads: List[Tuple[RequestType, Optional[str]]]) -> int:
+    """Verify a batch of received payloads and process the entities in them together.
+
+    :returns: Number of entities processed
+    """
+    entities = []
+    for request, uuid in payloads:
+        try:
+            entities.extend(get_received_entities(request, uuid=uuid))
+        except Exception as ex:
+            logger.exception("receive_payloads - failed to verify payload: %s", ex)
+    if entities:
+        process_entities(entities)
+    return len(entities)
+
+
+def consume_payloads(batch_size: int = None, wait: float = None, max_batches: int = None) -> int:
+    """Process received payloads from the inbound queue in batches until stopped.
+
+    :param batch_size: Most payloads to process together, defaults to ``SOCIALHOME_INBOUND_BATCH_SIZE``
+    :param wait: Most seconds to wait for a batch to fill up, defaults to ``SOCIALHOME_INBOUND_BATCH_WAIT``
+    :param max_batches: Stop after this many batches, runs forever by default
+    :returns: Number of payloads processed
+    """
+    batch_size = batch_size or settings.SOCIALHOME_INBOUND_BATCH_SIZE
+    wait = wait if wait is not None else settings.SOCIALHOME_INBOUND_BATCH_WAIT
+    requeued = requeue_payloads()
+    if requeued:
+        logger.info("consume_payloads - %s payloads left over from the last run put back into the queue", requeued)
+    batches = processed = 0
+    while max_batches is None or batches < max_batches:
+        payloads = pop_payloads(batch_size, wait)
+        batches += 1
+        if not payloads:
+            # Nothing popped, or only payloads that could not be loaded
+            finish_payloads()
+            continue
+        # The consumer lives long, don't hold on to connections the database has closed
+        close_old_connections()
+        start = time.perf_counter()
+        entities = receive_payloads(payloads)
+        finish_payloads()
+        processed += len(payloads)
+        logger.info(
+            "consume_payloads - processed %s entities from %s payloads in %.2f s, %s payloads waiting",
+            entities, len(payloads), time.perf_counter() - start, get_backlog(),
+        )
+    return processed
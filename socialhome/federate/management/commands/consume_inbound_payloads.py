@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from socialhome.federate.inbound import consume_payloads
+
+
+class Command(BaseCommand):
+    help = "Process received federation payloads queued with SOCIALHOME_INBOUND_BATCHING, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Most payloads to process together")
+        parser.add_argument("--wait", type=float, help="Most seconds to wait for a batch to fill up")
+        parser.add_argument("--max-batches", type=int, help="Stop after this many batches")
+
+    def handle(self, *args, **options):
+        processed = consume_payloads(
+            batch_size=options["batch_size"], wait=options["wait"], max_batches=options["max_batches"],
+        )
+        self.stdout.write("Processed %s payloads." % processed)
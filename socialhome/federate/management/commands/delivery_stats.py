@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from socialhome.federate.delivery import get_delivery_stats
+
+
+class Command(BaseCommand):
+    help = "Show the outbound delivery queue depth, latency and health per remote host."
+
+    def handle(self, *args, **options):
+        stats = get_delivery_stats()
+        if not stats:
+            self.stdout.write("No deliveries recorded.")
+            return
+        self.stdout.write(
+            "%-40s %6s %6s %8s %8s %10s %10s %8s" % (
+                "Host", "Queued", "Active", "Sent", "Failed", "Send ms", "Queue s", "Paused",
+            ),
+        )
+        for host, host_stats in stats.items():
+            latency = host_stats["latency"]
+            queue_latency = host_stats["queue_latency"]
+            self.stdout.write(
+                "%-40s %6s %6s %8s %8s %10s %10s %8s" % (
+                    host[:40], host_stats["depth"], host_stats["active"], host_stats["sent"], host_stats["failed"],
+                    "%.0f" % (latency * 1000) if latency is not None else "-",
+                    "%.1f" % queue_latency if queue_latency is not None else "-",
+                    "%ss" % host_stats["paused_for"] if host_stats["paused_for"] else "-",
+                ),
+            )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from socialhome.federate.inbound import get_backlog
+from socialhome.federate.utils import get_duplicate_counts
+
+
+class Command(BaseCommand):
+    help = "Show the received payloads waiting to be processed and the duplicates dropped."
+
+    def handle(self, *args, **options):
+        counts = get_duplicate_counts()
+        self.stdout.write("Waiting in the inbound queue: %s" % get_backlog())
+        self.stdout.write("Duplicates dropped by body: %s" % counts.get("body", 0))
+        self.stdout.write("Duplicates dropped by entity: %s" % counts.get("entity", 0))
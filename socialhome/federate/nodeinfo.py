@@ -0,0 +1,113 @@
+import datetime
+import json
+import logging
+from hashlib import sha256
+from typing import Dict, Tuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Q
+from django.utils.timezone import now
+from federation.hostmeta.generators import NodeInfo, generate_nodeinfo2_document
+
+from socialhome import __version__ as version
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
+
+NODEINFO_DOCUMENTS = ("nodeinfo", "nodeinfo2")
+# Seconds a rendered document is served before it is rendered again on request, if the scheduled refresh
+# hasn't replaced it already
+NODEINFO_CACHE_TIMEOUT = 60 * 60
+# Seconds between scheduled refreshes of the rendered documents
+NODEINFO_REFRESH_INTERVAL = 60 * 15
+
+
+def get_nodeinfo_key(name: str) -> str:
+    return f"sh:federate:nodeinfo:{name}"
+
+
+def get_usage_statistics() -> Dict:
+    """Count users and local content for the NodeInfo documents, with a query each."""
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.content.enums import ContentType
+    from socialhome.content.models import Content
+    from socialhome.users.models import User
+    users = User.objects.aggregate(
+        total=Count("id"),
+        activeHalfyear=Count("id", filter=Q(last_login__gte=now() - datetime.timedelta(days=180))),
+        activeMonth=Count("id", filter=Q(last_login__gte=now() - datetime.timedelta(days=30))),
+        activeWeek=Count("id", filter=Q(last_login__gte=now() - datetime.timedelta(days=7))),
+    )
+    content = Content.objects.filter(local=True).aggregate(
+        localPosts=Count("id", filter=Q(content_type=ContentType.CONTENT)),
+        localComments=Count("id", filter=Q(content_type=ContentType.REPLY)),
+    )
+    return {"users": users, **content}
+
+
+def render_nodeinfo(statistics: Dict = None) -> str:
+    from django.contrib.sites.models import Site
+    usage = {"users": {}}
+    if statistics:
+        usage = {
+            "users": {key: statistics["users"][key] for key in ("total", "activeHalfyear", "activeMonth")},
+            "localPosts": statistics["localPosts"],
+            "localComments": statistics["localComments"],
+        }
+    nodeinfo = NodeInfo(
+        software={"name": "socialhome", "version": version},
+        protocols={"inbound": ["diaspora"], "outbound": ["diaspora"]},
+        services={"inbound": [], "outbound": []},
+        open_registrations=settings.ACCOUNT_ALLOW_REGISTRATION,
+        usage=usage,
+        metadata={"nodeName": Site.objects.get_current().name},
+    )
+    return json.dumps(nodeinfo.doc, cls=DjangoJSONEncoder)
+
+
+def render_nodeinfo2(statistics: Dict = None) -> str:
+    from socialhome.federate.utils.generic import get_nodeinfo2_data  # Circulars
+    return json.dumps(generate_nodeinfo2_document(**get_nodeinfo2_data(statistics)), cls=DjangoJSONEncoder)
+
+
+def store_nodeinfo_document(name: str, body: str) -> Tuple[str, str]:
+    etag = '"%s"' % sha256(body.encode("utf-8")).hexdigest()[:32]
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        pipe.hset(get_nodeinfo_key(name), mapping={"body": body, "etag": etag})
+        pipe.expire(get_nodeinfo_key(name), NODEINFO_CACHE_TIMEOUT)
+        pipe.execute()
+    return body, etag
+
+
+def refresh_nodeinfo_documents() -> None:
+    """Count the statistics and render the NodeInfo documents served to other servers."""
+    statistics = get_usage_statistics() if settings.SOCIALHOME_STATISTICS else None
+    store_nodeinfo_document("nodeinfo", render_nodeinfo(statistics))
+    store_nodeinfo_document("nodeinfo2", render_nodeinfo2(statistics))
+
+
+def get_nodeinfo_document(name: str) -> Tuple[str, str]:
+    """Get a rendered NodeInfo document and its ETag, rendering it if it's not cached.
+
+    :param name: One of ``NODEINFO_DOCUMENTS``
+    :returns: Body and ETag
+    """
+    cached = get_redis_connection().hmget(get_nodeinfo_key(name), "body", "etag")
+    if all(cached):
+        return cached[0].decode("utf-8"), cached[1].decode("utf-8")
+    logger.debug("get_nodeinfo_document - rendering %s", name)
+    statistics = get_usage_statistics() if settings.SOCIALHOME_STATISTICS else None
+    render = render_nodeinfo if name == "nodeinfo" else render_nodeinfo2
+    return store_nodeinfo_document(name, render(statistics))
+
+
+def nodeinfo_tasks(scheduler):
+    # Refresh the statistics in the NodeInfo documents
+    scheduler.schedule(
+        scheduled_time=datetime.datetime.utcnow(),
+        func=refresh_nodeinfo_documents,
+        interval=NODEINFO_REFRESH_INTERVAL,
+        timeout=60*5,  # 5 minutes
+    )
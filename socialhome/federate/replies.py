@@ -0,0 +1,119 @@
+import json
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import List
+from urllib.parse import urlsplit
+
+import django_rq
+from federation.fetchers import retrieve_remote_content
+
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
+
+REPLIES_DUE_KEY = "sh:replies:due"
+REPLIES_STATE_KEY = "sh:replies:state"
+# Seconds after receiving a remote content before its reply collection is first refreshed
+REPLIES_FIRST_DELAY = 90
+# Shortest and longest seconds between refreshes of a reply collection
+REPLIES_MIN_INTERVAL = 15 * 60
+REPLIES_MAX_INTERVAL = 24 * 60 * 60
+# Seconds after receiving a remote content to keep refreshing its reply collection
+REPLIES_TRACK_FOR = 5 * 24 * 60 * 60
+# Most reply collections to queue refreshes for in one run of refresh_reply_collections
+REPLIES_REFRESH_BATCH = 500
+
+
+def track_replies(fid: str) -> None:
+    """Refresh the reply collection of a remote content periodically for a while.
+
+    Only the fid is stored. The content is fetched again to get its reply collection when a refresh is due.
+    Refreshes happen more often while new replies keep showing up, see ``reschedule_replies``.
+    """
+    now = time.time()
+    state = {"interval": REPLIES_MIN_INTERVAL, "until": now + REPLIES_TRACK_FOR}
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        pipe.hset(REPLIES_STATE_KEY, fid, json.dumps(state))
+        pipe.zadd(REPLIES_DUE_KEY, {fid: now + REPLIES_FIRST_DELAY})
+        pipe.execute()
+
+
+def untrack_replies(fid: str) -> None:
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        pipe.zrem(REPLIES_DUE_KEY, fid)
+        pipe.hdel(REPLIES_STATE_KEY, fid)
+        pipe.execute()
+
+
+def reschedule_replies(fid: str, fetched: int) -> None:
+    """Schedule the next refresh of a reply collection.
+
+    :param fid: Fid of the content
+    :param fetched: Number of new replies found by the last refresh. Collections with new replies are refreshed
+        again soon, the interval of others doubles up to ``REPLIES_MAX_INTERVAL``.
+    """
+    r = get_redis_connection()
+    state = r.hget(REPLIES_STATE_KEY, fid)
+    now = time.time()
+    if not state:
+        r.zrem(REPLIES_DUE_KEY, fid)
+        return
+    state = json.loads(state)
+    if state["until"] <= now:
+        untrack_replies(fid)
+        return
+    state["interval"] = REPLIES_MIN_INTERVAL if fetched else min(state["interval"] * 2, REPLIES_MAX_INTERVAL)
+    with r.pipeline() as pipe:
+        pipe.hset(REPLIES_STATE_KEY, fid, json.dumps(state))
+        pipe.zadd(REPLIES_DUE_KEY, {fid: now + state["interval"]})
+        pipe.execute()
+
+
+def refresh_reply_collections(limit: int = REPLIES_REFRESH_BATCH) -> int:
+    """Queue refreshes of the reply collections that are due, one job per remote host.
+
+    :returns: Number of reply collections queued for a refresh
+    """
+    now = time.time()
+    r = get_redis_connection()
+    fids = [fid.decode("utf-8") for fid in r.zrangebyscore(REPLIES_DUE_KEY, "-inf", now, start=0, num=limit)]
+    if not fids:
+        return 0
+    # Don't pick these up again before the jobs have had time to run
+    r.zadd(REPLIES_DUE_KEY, {fid: now + REPLIES_MIN_INTERVAL for fid in fids})
+    by_host = defaultdict(list)
+    for fid in fids:
+        by_host[urlsplit(fid).netloc.lower()].append(fid)
+    for host, host_fids in by_host.items():
+        django_rq.enqueue(refresh_host_replies, host, host_fids)
+    logger.info("refresh_reply_collections - queued %s reply collections on %s hosts", len(fids), len(by_host))
+    return len(fids)
+
+
+def refresh_host_replies(host: str, fids: List[str]) -> None:
+    """Refresh the reply collections of remote content on one host."""
+    from socialhome.federate.utils.tasks import process_replies  # Circulars
+    for fid in fids:
+        fetched = 0
+        try:
+            entity = retrieve_remote_content(fid)
+            if entity:
+                fetched = process_replies(fid, getattr(entity, "_replies", None) or [])
+        except Exception as ex:
+            logger.exception("refresh_host_replies - failed to refresh replies of %s: %s", fid, ex)
+        reschedule_replies(fid, fetched)
+    logger.debug("refresh_host_replies - refreshed %s reply collections on %s", len(fids), host)
+
+
+def replies_tasks(scheduler):
+    # Refresh reply collections of remote content that are due
+    scheduler.schedule(
+        scheduled_time=datetime.utcnow(),
+        func=refresh_reply_collections,
+        interval=60,  # every minute
+        timeout=60*5,  # 5 minutes
+    )
@@ -2,22 +2,25 @@ import logging
 from typing import List, TYPE_CHECKING, Optional
 from uuid import uuid4
 
-import django_rq
 from django.conf import settings
 from dynamic_preferences.registries import global_preferences_registry
 from federation.entities import base
 from federation.exceptions import NoSuitableProtocolFoundError, NoSenderKeyFoundError, SignatureVerificationError
 from federation.inbound import handle_receive
-from federation.outbound import handle_send
 
 from socialhome.content.enums import ContentType
 from socialhome.content.models import Content
 from socialhome.enums import Visibility
+from socialhome.federate.delivery import queue_send
 from socialhome.federate.models import Payload
 from socialhome.federate.utils.tasks import process_entities, sender_key_fetcher
-from socialhome.federate.utils import make_federable_profile, get_outbound_payload_logger
+from socialhome.federate.utils import (
+    make_federable_profile, get_outbound_payload_logger, plan_deliveries, log_delivery_plan, is_duplicate_payload,
+    mark_payload_seen,
+)
 from socialhome.federate.utils.entities import make_federable_content, make_federable_retraction
 from socialhome.users.models import Profile
+from socialhome.users.utils import with_private_key
 
 if TYPE_CHECKING:
     from federation import RequestType
@@ -25,20 +28,24 @@ if TYPE_CHECKING:
 logger = logging.getLogger("socialhome")
 
 
-def receive_task(request, uuid=None):
-    # type: (RequestType, Optional[str]) -> None
-    """Process received payload."""
+def get_received_entities(request, uuid=None):
+    # type: (RequestType, Optional[str]) -> List
+    """Verify a received payload and get the entities in it."""
+    if is_duplicate_payload(request.body, uuid=uuid):
+        return []
     profile = None
     if uuid:
         try:
             profile = Profile.objects.get(uuid=uuid, user__isnull=False)
         except Profile.DoesNotExist:
             logger.warning("No local profile found with uuid")
-            return
+            return []
     try:
         sender, protocol_name, entities = handle_receive(
-            request, user=profile.federable if profile else None, sender_key_fetcher=sender_key_fetcher,
+            request, user=with_private_key(profile.federable) if profile else None,
+            sender_key_fetcher=sender_key_fetcher,
         )
+        mark_payload_seen(request.body, uuid=uuid)
         logger.debug("sender=%s, protocol_name=%s, entities=%s" % (sender, protocol_name, entities))
         preferences = global_preferences_registry.manager()
         if preferences["admin__log_all_receive_payloads"]:
@@ -54,17 +61,25 @@ def receive_task(request, uuid=None):
             )
     except NoSuitableProtocolFoundError:
         logger.warning("No suitable protocol found for payload")
-        return
+        return []
     except NoSenderKeyFoundError:
         logger.warning("Could not find a public key for the sender - skipping payload")
-        return
+        return []
     except SignatureVerificationError:
         logger.warning("Signature validation failed - skipping payload")
-        return
+        return []
     if not entities:
         logger.warning("No entities in payload")
-        return
-    process_entities(entities)
+        return []
+    return entities
+
+
+def receive_task(request, uuid=None):
+    # type: (RequestType, Optional[str]) -> None
+    """Process received payload."""
+    entities = get_received_entities(request, uuid=uuid)
+    if entities:
+        process_entities(entities)
 
 
 def send_content(content_id, activity_fid, recipient_id=None):
@@ -105,34 +120,47 @@ def send_content(content_id, activity_fid, recipient_id=None):
                     recipients.append(content.author.get_recipient_for_matrix_appservice())
             recipients.extend(_get_remote_followers(content.author, content.visibility))
 
-        logger.debug("send_content - sending to recipients: %s", recipients)
-        handle_send(entity, content.author.federable, recipients, payload_logger=get_outbound_payload_logger())
+        plan = plan_deliveries(recipients)
+        log_delivery_plan("send_content", plan)
+        queue_send(entity, content.author.federable, plan.recipients, payload_logger=get_outbound_payload_logger())
     else:
         logger.warning("send_content - No entity for %s", content)
 
 
-def _get_remote_participants_for_content(target_content, participants=None, exclude=None, include_remote=False):
+def _get_remote_participants_for_content(target_content, exclude=None, include_remote=False):
     """Get remote participants for a target content.
 
-    Look at both replies and shares of target local content. Does a recursive call to get also replies of shares,
-    even if those shares are remote.
+    Look at both replies and shares of target local content, and also at the replies of shares, even if those
+    shares are remote. Runs a fixed number of queries, whatever the size of the thread.
     """
-    if not participants:
-        participants = []
     if not include_remote and not target_content.local:
-        return participants
-    replies = Content.objects.filter(root_parent_id=target_content.id, local=False, author__user__isnull=True)
-    for reply in replies:
-        if not exclude or (reply.author.fid != exclude and reply.author.handle != exclude):
-            participants.append(reply.author.get_recipient_for_visibility(target_content.visibility))
+        return []
+    # Visibility to use for the participants under each root
+    visibilities = {target_content.id: target_content.visibility}
+    share_authors = {}
     if target_content.content_type == ContentType.CONTENT:
-        shares = Content.objects.filter(share_of_id=target_content.id, local=False)
-        for share in shares:
-            if not exclude or (share.author.fid != exclude and share.author.handle != exclude):
-                participants.append(share.author.get_recipient_for_visibility(target_content.visibility))
-            participants = _get_remote_participants_for_content(
-                share, participants, exclude=exclude, include_remote=True
-            )
+        shares = Content.objects.filter(share_of_id=target_content.id, local=False).select_related("author")
+        for share in shares.order_by("id"):
+            visibilities[share.id] = share.visibility
+            share_authors[share.id] = share.author
+    replies = {}
+    reply_qs = Content.objects.filter(
+        root_parent_id__in=visibilities.keys(), local=False, author__user__isnull=True,
+    ).select_related("author")
+    for reply in reply_qs.order_by("id"):
+        replies.setdefault(reply.root_parent_id, []).append(reply.author)
+
+    def is_excluded(profile):
+        return exclude and (profile.fid == exclude or profile.handle == exclude)
+
+    participants = []
+    for root_id, visibility in visibilities.items():
+        authors = replies.get(root_id, [])
+        if root_id in share_authors:
+            authors = [share_authors[root_id]] + authors
+        participants.extend(
+            author.get_recipient_for_visibility(visibility) for author in authors if not is_excluded(author)
+        )
     return participants
 
 
@@ -193,8 +221,9 @@ def send_reply(content_id, activity_fid):
     if not recipients:
         logger.debug("send_reply - no remote recipients for content: %s", content.id)
         return
-    logger.debug("send_reply - sending to recipients: %s", recipients)
-    handle_send(entity, content.author.federable, recipients, payload_logger=get_outbound_payload_logger())
+    plan = plan_deliveries(recipients)
+    log_delivery_plan("send_reply", plan)
+    queue_send(entity, content.author.federable, plan.recipients, payload_logger=get_outbound_payload_logger())
 
 
 def send_share(content_id, activity_fid):
@@ -218,8 +247,9 @@ def send_share(content_id, activity_fid):
         if not content.share_of.local:
             # Send to original author
             recipients.append(content.share_of.author.get_recipient_for_visibility(content.visibility))
-        logger.debug("send_share - sending to recipients: %s", recipients)
-        handle_send(entity, content.author.federable, recipients, payload_logger=get_outbound_payload_logger())
+        plan = plan_deliveries(recipients)
+        log_delivery_plan("send_share", plan)
+        queue_send(entity, content.author.federable, plan.recipients, payload_logger=get_outbound_payload_logger())
     else:
         logger.warning("send_share - No entity for %s", content)
 
@@ -241,12 +271,9 @@ def send_content_retraction(content, author_id):
         else:
             recipients = _get_limited_recipients(author.fid, content)
 
-        logger.debug("send_content_retraction - sending to recipients: %s", recipients)
-        # Queue to the background since sending could take a while
-        django_rq.enqueue(
-            handle_send, entity, author.federable, recipients, payload_logger=get_outbound_payload_logger(),
-            job_timeout=10000,
-        )
+        plan = plan_deliveries(recipients)
+        log_delivery_plan("send_content_retraction", plan)
+        queue_send(entity, author.federable, plan.recipients, payload_logger=get_outbound_payload_logger())
     else:
         logger.warning("send_content_retraction - No retraction entity for %s", content)
 
@@ -268,8 +295,9 @@ def send_profile_retraction(profile):
             # Don't send in development mode
             return
         recipients = _get_remote_followers(profile, profile.visibility)
-        logger.debug("send_profile_retraction - sending to recipients: %s", recipients)
-        handle_send(entity, profile.federable, recipients, payload_logger=get_outbound_payload_logger())
+        plan = plan_deliveries(recipients)
+        log_delivery_plan("send_profile_retraction", plan)
+        queue_send(entity, profile.federable, plan.recipients, payload_logger=get_outbound_payload_logger())
     else:
         logger.warning("send_profile_retraction - No retraction entity for %s", profile)
 
@@ -307,9 +335,10 @@ def forward_entity(entity, target_content_id):
         recipients = _get_limited_recipients(entity.actor_id, target_content)
     else:
         return
-    logger.debug("forward_entity - sending to recipients: %s", recipients)
-    handle_send(
-        entity, content.author.federable, recipients, parent_user=target_content.author.federable,
+    plan = plan_deliveries(recipients)
+    log_delivery_plan("forward_entity", plan)
+    queue_send(
+        entity, content.author.federable, plan.recipients, parent_user=target_content.author.federable,
         payload_logger=get_outbound_payload_logger(),
     )
 
@@ -340,7 +369,7 @@ def send_follow_change(profile_id, followed_id, follow):
     # Explicitly use limited visibility to force private endpoint
     recipients = [remote_profile.get_recipient_for_visibility(Visibility.LIMITED)]
     logger.debug("send_follow_change - sending to recipients: %s", recipients)
-    handle_send(entity, profile.federable, recipients, payload_logger=get_outbound_payload_logger())
+    queue_send(entity, profile.federable, recipients, payload_logger=get_outbound_payload_logger())
     # Also trigger a profile send
     send_profile(profile_id, recipients=recipients)
 
@@ -371,5 +400,6 @@ def send_profile(profile_id, recipients=None):
             recipients = []
         recipients.extend(_get_remote_followers(profile, profile.visibility))
 
-    logger.debug("send_profile - sending to recipients: %s", recipients)
-    handle_send(entity, profile.federable, recipients, payload_logger=get_outbound_payload_logger())
+    plan = plan_deliveries(recipients)
+    log_delivery_plan("send_profile", plan)
+    queue_send(entity, profile.federable, plan.recipients, payload_logger=get_outbound_payload_logger())
@@ -0,0 +1,222 @@
+import pickle
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+from django.test import override_settings
+from federation import outbound
+from federation.types import UserType
+
+from socialhome.federate.delivery import (
+    queue_send, deliver_to_host, get_delivery_stats, get_circuit_key, get_host_key, get_slots_key,
+    schedule_delivery, queue_due_deliveries, acquire_slot, release_slot, DELIVERY_BACKOFF, DELIVERY_BUSY_DELAY,
+    DELIVERY_MAX_BUSY_RESCHEDULES, DELIVERY_SLOT_TIMEOUT, PENDING_DELIVERIES_KEY, PENDING_DELIVERIES_DATA_KEY,
+)
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.utils import get_redis_connection
+
+
+class RemoteServerHandler(BaseHTTPRequestHandler):
+    """Stand-in remote server, responding with the status code given as the path."""
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(int(self.path.strip("/")))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def send_to_recipients(entity, author_user, recipients, parent_user=None, payload_logger=None):
+    """Stand-in for handle_send, sending a document to each recipient through ``federation.outbound``."""
+    for recipient in recipients:
+        outbound.send_document(recipient["endpoint"], b"payload")
+
+
+@patch("socialhome.federate.delivery.handle_send", side_effect=send_to_recipients)
+@patch("socialhome.federate.delivery.schedule_delivery")
+class TestDeliverToHost(SocialhomeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(("127.0.0.1", 0), RemoteServerHandler)
+        cls.host = "127.0.0.1:%s" % cls.server.server_port
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.author = UserType(id="https://example.com/u/author/")
+        self.r = get_redis_connection()
+        self.r.delete(
+            "sh:delivery:hosts", get_host_key(self.host), get_circuit_key(self.host), get_slots_key(self.host),
+        )
+
+    def recipient(self, status):
+        return {"endpoint": f"http://{self.host}/{status}", "fid": "", "protocol": "diaspora", "public": True}
+
+    def test_queue_send_delivers_per_host(self, mock_schedule, mock_send):
+        queue_send("entity", self.author, [self.recipient(200), self.recipient(202)])
+        mock_send.assert_called_once_with(
+            "entity", self.author, [self.recipient(200), self.recipient(202)], parent_user=None, payload_logger=None,
+        )
+        stats = get_delivery_stats()[self.host]
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["active"], 0)
+        self.assertEqual(stats["sent"], 2)
+        self.assertEqual(stats["failed"], 0)
+        self.assertTrue(stats["latency"] > 0)
+        self.assertFalse(mock_schedule.called)
+
+    @patch("socialhome.federate.delivery.django_rq.enqueue")
+    def test_queue_send_enqueues_a_job_per_host(self, mock_enqueue, mock_schedule, mock_send):
+        other = {"endpoint": "https://example.com/inbox", "fid": "", "protocol": "activitypub", "public": True}
+        queue_send("entity", self.author, [self.recipient(200), other, self.recipient(202)])
+        self.assertEqual(mock_enqueue.call_count, 2)
+        self.assertEqual(mock_enqueue.call_args_list[0][0][1:5], (
+            self.host, "entity", self.author, [self.recipient(200), self.recipient(202)],
+        ))
+        self.assertEqual(mock_enqueue.call_args_list[1][0][1:5], ("example.com", "entity", self.author, [other]))
+        self.assertEqual(get_delivery_stats()[self.host]["depth"], 1)
+        self.r.delete(get_host_key("example.com"))
+
+    def test_failed_sends_are_retried_with_backoff(self, mock_schedule, mock_send):
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(200), self.recipient(503)], attempt=2)
+        mock_schedule.assert_called_once_with(
+            DELIVERY_BACKOFF * 2, self.host, "entity", self.author, [self.recipient(503)], attempt=3,
+            parent_user=None, payload_logger=None, queued_at=None,
+        )
+        stats = get_delivery_stats()[self.host]
+        self.assertEqual(stats["sent"], 1)
+        self.assertEqual(stats["failed"], 1)
+
+    def test_client_errors_are_not_retried(self, mock_schedule, mock_send):
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(404)])
+        self.assertFalse(mock_schedule.called)
+
+    @override_settings(SOCIALHOME_DELIVERY_MAX_ATTEMPTS=3)
+    def test_gives_up_after_max_attempts(self, mock_schedule, mock_send):
+        self.r.sadd("sh:delivery:hosts", self.host)
+        self.r.hset(get_host_key(self.host), "depth", 1)
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(500)], attempt=3)
+        self.assertFalse(mock_schedule.called)
+        self.assertEqual(get_delivery_stats()[self.host]["depth"], 0)
+
+    @patch("socialhome.federate.delivery.logger.exception")
+    def test_send_exception_is_recorded_as_failure(self, mock_logger, mock_schedule, mock_send):
+        self.r.sadd("sh:delivery:hosts", self.host)
+        self.r.hset(get_host_key(self.host), "depth", 1)
+        mock_send.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            deliver_to_host(self.host, "entity", self.author, [self.recipient(200)])
+        self.assertFalse(mock_schedule.called)
+        self.assertTrue(mock_logger.called)
+        stats = get_delivery_stats()[self.host]
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["active"], 0)
+        self.assertEqual(stats["failed"], 1)
+
+    @override_settings(SOCIALHOME_DELIVERY_CIRCUIT_THRESHOLD=2)
+    def test_failing_host_is_paused(self, mock_schedule, mock_send):
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(500)])
+        self.assertEqual(self.r.ttl(get_circuit_key(self.host)), -2)
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(500)])
+        self.assertTrue(self.r.ttl(get_circuit_key(self.host)) > 0)
+        mock_send.reset_mock()
+        mock_schedule.reset_mock()
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(200)], attempt=2)
+        self.assertFalse(mock_send.called)
+        args, kwargs = mock_schedule.call_args
+        self.assertTrue(args[0] > DELIVERY_BACKOFF)
+        self.assertEqual(kwargs["attempt"], 2)
+
+    def test_successful_send_resets_failures(self, mock_schedule, mock_send):
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(500)])
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(200)])
+        self.assertEqual(self.r.hget(get_host_key(self.host), "consecutive_failures"), b"0")
+
+    @override_settings(SOCIALHOME_DELIVERY_HOST_CONCURRENCY=1)
+    def test_busy_host_is_rescheduled(self, mock_schedule, mock_send):
+        self.assertTrue(acquire_slot(self.host))
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(200)], busy=2)
+        self.assertFalse(mock_send.called)
+        args, kwargs = mock_schedule.call_args
+        self.assertEqual(args[0], DELIVERY_BUSY_DELAY)
+        self.assertEqual(kwargs["busy"], 3)
+        self.assertEqual(self.r.zcard(get_slots_key(self.host)), 1)
+
+    @override_settings(SOCIALHOME_DELIVERY_HOST_CONCURRENCY=1)
+    def test_busy_host_gives_up_after_max_reschedules(self, mock_schedule, mock_send):
+        self.r.sadd("sh:delivery:hosts", self.host)
+        self.r.hset(get_host_key(self.host), "depth", 1)
+        acquire_slot(self.host)
+        deliver_to_host(self.host, "entity", self.author, [self.recipient(200)], busy=DELIVERY_MAX_BUSY_RESCHEDULES)
+        self.assertFalse(mock_send.called)
+        self.assertFalse(mock_schedule.called)
+        stats = get_delivery_stats()[self.host]
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["failed"], 1)
+
+    @override_settings(SOCIALHOME_DELIVERY_HOST_CONCURRENCY=2)
+    def test_slots(self, mock_schedule, mock_send):
+        holder = acquire_slot(self.host)
+        self.assertTrue(holder)
+        self.assertTrue(acquire_slot(self.host))
+        self.assertIsNone(acquire_slot(self.host))
+        release_slot(self.host, holder)
+        self.assertTrue(acquire_slot(self.host))
+
+    @override_settings(SOCIALHOME_DELIVERY_HOST_CONCURRENCY=1)
+    def test_slots_of_dead_jobs_expire(self, mock_schedule, mock_send):
+        started = time.time() - DELIVERY_SLOT_TIMEOUT
+        with patch("socialhome.federate.delivery.time.time", return_value=started):
+            self.assertTrue(acquire_slot(self.host))
+        # Rejected attempts don't keep the slot alive
+        with patch("socialhome.federate.delivery.time.time", return_value=started + 10):
+            self.assertIsNone(acquire_slot(self.host))
+        self.assertTrue(acquire_slot(self.host))
+        self.assertEqual(self.r.zcard(get_slots_key(self.host)), 1)
+
+
+@patch("socialhome.federate.delivery.django_rq.enqueue")
+class TestScheduleDelivery(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.r.delete(PENDING_DELIVERIES_KEY, PENDING_DELIVERIES_DATA_KEY)
+
+    @patch("socialhome.federate.delivery.time.time", return_value=1000)
+    def test_schedule_delivery_is_stored(self, mock_time, mock_enqueue):
+        schedule_delivery(60, "example.com", "entity", "author", [{"endpoint": "foo"}], attempt=2)
+        (delivery_id, due), = self.r.zrange(PENDING_DELIVERIES_KEY, 0, -1, withscores=True)
+        self.assertEqual(due, 1060)
+        self.assertEqual(
+            pickle.loads(self.r.hget(PENDING_DELIVERIES_DATA_KEY, delivery_id)),
+            ("example.com", "entity", "author", [{"endpoint": "foo"}], {"attempt": 2}),
+        )
+        self.assertFalse(mock_enqueue.called)
+
+    def test_queue_due_deliveries(self, mock_enqueue):
+        with patch("socialhome.federate.delivery.time.time", return_value=1000):
+            schedule_delivery(60, "example.com", "entity", "author", [], attempt=2)
+            schedule_delivery(120, "example.org", "entity", "author", [], attempt=3)
+        with patch("socialhome.federate.delivery.time.time", return_value=1060):
+            self.assertEqual(queue_due_deliveries(), 1)
+            self.assertEqual(queue_due_deliveries(), 0)
+        mock_enqueue.assert_called_once_with(deliver_to_host, "example.com", "entity", "author", [], attempt=2)
+        self.assertEqual(self.r.zcard(PENDING_DELIVERIES_KEY), 1)
+        self.assertEqual(self.r.hlen(PENDING_DELIVERIES_DATA_KEY), 1)
+
+    @patch("socialhome.federate.delivery.time.time", return_value=1000)
+    def test_queue_due_deliveries__in_batches(self, mock_time, mock_enqueue):
+        for _i in range(3):
+            schedule_delivery(0, "example.com", "entity", "author", [])
+        self.assertEqual(queue_due_deliveries(batch_size=2), 3)
+        self.assertEqual(mock_enqueue.call_count, 3)
+        self.assertEqual(self.r.zcard(PENDING_DELIVERIES_KEY), 0)
@@ -0,0 +1,139 @@
+from unittest.mock import patch
+
+from django.test import override_settings
+from federation.types import RequestType
+
+from socialhome.federate.inbound import (
+    INBOUND_QUEUE_KEY, push_payload, pop_payloads, is_backlogged, receive_payloads, consume_payloads, get_backlog,
+    INBOUND_PROCESSING_KEY, finish_payloads, requeue_payloads,
+)
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.utils import get_redis_connection
+
+
+def make_request(body):
+    return RequestType(body=body, headers={}, method="POST", url="https://127.0.0.1:8000/receive/public/")
+
+
+class InboundTestCase(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        get_redis_connection().delete(INBOUND_QUEUE_KEY, INBOUND_PROCESSING_KEY)
+
+
+class TestPushPopPayloads(InboundTestCase):
+    def test_payloads_are_popped_in_order_in_batches(self):
+        for i in range(3):
+            self.assertEqual(push_payload(make_request(b"%d" % i), uuid="1234" if i == 1 else None), i + 1)
+        payloads = pop_payloads(2, 0)
+        self.assertEqual([(request.body, uuid) for request, uuid in payloads], [(b"0", None), (b"1", "1234")])
+        self.assertEqual(get_backlog(), 1)
+        payloads = pop_payloads(2, 0)
+        self.assertEqual([request.body for request, _uuid in payloads], [b"2"])
+        self.assertEqual(get_backlog(), 0)
+
+    def test_empty_queue(self):
+        self.assertEqual(pop_payloads(10, 0), [])
+
+    def test_waits_for_more_payloads(self):
+        push_payload(make_request(b"foo"))
+        with patch.object(get_redis_connection(), "brpoplpush", return_value=None) as mock_brpoplpush:
+            payloads = pop_payloads(2, 1)
+        mock_brpoplpush.assert_called_once_with(INBOUND_QUEUE_KEY, INBOUND_PROCESSING_KEY, timeout=1)
+        self.assertEqual([request.body for request, _uuid in payloads], [b"foo"])
+
+    def test_unloadable_payloads_are_skipped(self):
+        get_redis_connection().lpush(INBOUND_QUEUE_KEY, b"foobar")
+        push_payload(make_request(b"foo"))
+        self.assertEqual([request.body for request, _uuid in pop_payloads(10, 0)], [b"foo"])
+
+
+class TestProcessingPayloads(InboundTestCase):
+    def test_popped_payloads_are_kept_until_finished(self):
+        for i in range(3):
+            push_payload(make_request(b"%d" % i))
+        pop_payloads(2, 0)
+        r = get_redis_connection()
+        self.assertEqual(r.llen(INBOUND_PROCESSING_KEY), 2)
+        finish_payloads()
+        self.assertEqual(r.llen(INBOUND_PROCESSING_KEY), 0)
+        self.assertEqual(get_backlog(), 1)
+
+    def test_requeued_payloads_are_popped_first_in_order(self):
+        for i in range(3):
+            push_payload(make_request(b"%d" % i))
+        pop_payloads(2, 0)
+        push_payload(make_request(b"3"))
+        self.assertEqual(requeue_payloads(), 2)
+        self.assertEqual(get_redis_connection().llen(INBOUND_PROCESSING_KEY), 0)
+        self.assertEqual(get_backlog(), 4)
+        self.assertEqual([request.body for request, _uuid in pop_payloads(10, 0)], [b"0", b"1", b"2", b"3"])
+
+    def test_nothing_to_requeue(self):
+        self.assertEqual(requeue_payloads(), 0)
+        self.assertEqual(get_backlog(), 0)
+
+
+class TestIsBacklogged(InboundTestCase):
+    @override_settings(SOCIALHOME_INBOUND_BATCHING=True, SOCIALHOME_INBOUND_MAX_BACKLOG=2)
+    def test_backlogged_at_max_backlog(self):
+        push_payload(make_request(b"foo"))
+        self.assertFalse(is_backlogged())
+        push_payload(make_request(b"bar"))
+        self.assertTrue(is_backlogged())
+
+    @override_settings(SOCIALHOME_INBOUND_BATCHING=False, SOCIALHOME_INBOUND_MAX_BACKLOG=1)
+    def test_never_backlogged_without_batching(self):
+        push_payload(make_request(b"foo"))
+        self.assertFalse(is_backlogged())
+
+
+@patch("socialhome.federate.inbound.process_entities")
+@patch("socialhome.federate.inbound.get_received_entities")
+class TestReceivePayloads(InboundTestCase):
+    def test_entities_of_payloads_are_processed_together(self, mock_received, mock_process):
+        mock_received.side_effect = [["entity1"], [], ["entity2", "entity3"]]
+        requests = [make_request(b"1"), make_request(b"2"), make_request(b"3")]
+        self.assertEqual(receive_payloads([(request, None) for request in requests]), 3)
+        mock_process.assert_called_once_with(["entity1", "entity2", "entity3"])
+        mock_received.assert_any_call(requests[0], uuid=None)
+
+    def test_failing_payload_does_not_stop_the_batch(self, mock_received, mock_process):
+        mock_received.side_effect = [Exception, ["entity"]]
+        receive_payloads([(make_request(b"1"), None), (make_request(b"2"), "1234")])
+        mock_process.assert_called_once_with(["entity"])
+
+    def test_nothing_to_process(self, mock_received, mock_process):
+        mock_received.return_value = []
+        self.assertEqual(receive_payloads([(make_request(b"1"), None)]), 0)
+        self.assertFalse(mock_process.called)
+
+
+@patch("socialhome.federate.inbound.receive_payloads", return_value=1)
+class TestConsumePayloads(InboundTestCase):
+    def test_consumes_in_batches(self, mock_receive):
+        for i in range(5):
+            push_payload(make_request(b"%d" % i))
+        self.assertEqual(consume_payloads(batch_size=2, wait=0, max_batches=4), 5)
+        self.assertEqual(
+            [[request.body for request, _uuid in call[0][0]] for call in mock_receive.call_args_list],
+            [[b"0", b"1"], [b"2", b"3"], [b"4"]],
+        )
+        self.assertEqual(get_redis_connection().llen(INBOUND_PROCESSING_KEY), 0)
+
+    def test_payloads_left_over_are_processed_first(self, mock_receive):
+        for i in range(3):
+            push_payload(make_request(b"%d" % i))
+        # The consumer stopped before finishing this batch
+        pop_payloads(2, 0)
+        consume_payloads(batch_size=10, wait=0, max_batches=1)
+        self.assertEqual(
+            [request.body for request, _uuid in mock_receive.call_args[0][0]], [b"0", b"1", b"2"],
+        )
+
+    def test_batch_is_kept_when_processing_fails(self, mock_receive):
+        mock_receive.side_effect = Exception
+        push_payload(make_request(b"0"))
+        with self.assertRaises(Exception):
+            consume_payloads(batch_size=10, wait=0, max_batches=1)
+        self.assertEqual(get_redis_connection().llen(INBOUND_PROCESSING_KEY), 1)
@@ -0,0 +1,69 @@
+import datetime
+import json
+
+from django.test import override_settings
+from django.utils.timezone import now
+
+from socialhome.content.tests.factories import ContentFactory
+from socialhome.federate.nodeinfo import (
+    get_usage_statistics, refresh_nodeinfo_documents, get_nodeinfo_document, get_nodeinfo_key,
+)
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.users.tests.factories import UserFactory
+from socialhome.utils import get_redis_connection
+
+
+class TestGetUsageStatistics(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory(last_login=now() - datetime.timedelta(days=3))
+        UserFactory(last_login=now() - datetime.timedelta(days=20))
+        UserFactory(last_login=now() - datetime.timedelta(days=100))
+        UserFactory(last_login=None)
+        content = ContentFactory(author=cls.user.profile)
+        ContentFactory(author=cls.user.profile)
+        ContentFactory(author=cls.user.profile, parent=content)
+        ContentFactory()
+
+    def test_counts(self):
+        with self.assertNumQueries(2):
+            statistics = get_usage_statistics()
+        self.assertEqual(statistics, {
+            "users": {"total": 4, "activeHalfyear": 3, "activeMonth": 2, "activeWeek": 1},
+            "localPosts": 2,
+            "localComments": 1,
+        })
+
+
+class TestNodeInfoDocuments(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory()
+
+    @override_settings(SOCIALHOME_STATISTICS=True)
+    def test_refresh_stores_documents(self):
+        refresh_nodeinfo_documents()
+        with self.assertNumQueries(0):
+            body, etag = get_nodeinfo_document("nodeinfo")
+            body2, etag2 = get_nodeinfo_document("nodeinfo2")
+        self.assertEqual(json.loads(body)["usage"]["users"], {"total": 1, "activeHalfyear": 0, "activeMonth": 0})
+        self.assertEqual(json.loads(body2)["usage"]["users"]["total"], 1)
+        self.assertNotEqual(etag, etag2)
+        self.assertTrue(get_redis_connection().ttl(get_nodeinfo_key("nodeinfo")) > 0)
+
+    @override_settings(SOCIALHOME_STATISTICS=True)
+    def test_etag_changes_with_statistics(self):
+        _body, etag = get_nodeinfo_document("nodeinfo")
+        UserFactory()
+        self.assertEqual(get_nodeinfo_document("nodeinfo")[1], etag)
+        refresh_nodeinfo_documents()
+        self.assertNotEqual(get_nodeinfo_document("nodeinfo")[1], etag)
+
+    @override_settings(SOCIALHOME_STATISTICS=False)
+    def test_no_statistics(self):
+        body, _etag = get_nodeinfo_document("nodeinfo")
+        self.assertEqual(json.loads(body)["usage"], {"users": {}})
+        body, _etag = get_nodeinfo_document("nodeinfo2")
+        self.assertNotIn("usage", json.loads(body))
@@ -0,0 +1,115 @@
+import json
+import time
+from unittest.mock import patch, Mock, call
+
+from socialhome.federate.replies import (
+    REPLIES_DUE_KEY, REPLIES_STATE_KEY, REPLIES_FIRST_DELAY, REPLIES_MIN_INTERVAL, REPLIES_MAX_INTERVAL,
+    track_replies, reschedule_replies, refresh_reply_collections, refresh_host_replies, untrack_replies,
+)
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.utils import get_redis_connection
+
+
+class RepliesTestCase(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+
+    def get_state(self, fid):
+        state = self.r.hget(REPLIES_STATE_KEY, fid)
+        return json.loads(state) if state else None
+
+    def get_due_in(self, fid):
+        return self.r.zscore(REPLIES_DUE_KEY, fid) - time.time()
+
+
+class TestTrackReplies(RepliesTestCase):
+    def test_tracks_fid(self):
+        track_replies("https://example.com/post/1")
+        self.assertEqual(self.get_state("https://example.com/post/1")["interval"], REPLIES_MIN_INTERVAL)
+        self.assertAlmostEqual(self.get_due_in("https://example.com/post/1"), REPLIES_FIRST_DELAY, delta=5)
+
+    def test_untrack(self):
+        track_replies("https://example.com/post/1")
+        untrack_replies("https://example.com/post/1")
+        self.assertIsNone(self.get_state("https://example.com/post/1"))
+        self.assertIsNone(self.r.zscore(REPLIES_DUE_KEY, "https://example.com/post/1"))
+
+
+class TestRescheduleReplies(RepliesTestCase):
+    def setUp(self):
+        super().setUp()
+        track_replies("https://example.com/post/1")
+
+    def test_interval_doubles_without_new_replies(self):
+        reschedule_replies("https://example.com/post/1", 0)
+        self.assertEqual(self.get_state("https://example.com/post/1")["interval"], REPLIES_MIN_INTERVAL * 2)
+        self.assertAlmostEqual(self.get_due_in("https://example.com/post/1"), REPLIES_MIN_INTERVAL * 2, delta=5)
+        for _i in range(10):
+            reschedule_replies("https://example.com/post/1", 0)
+        self.assertEqual(self.get_state("https://example.com/post/1")["interval"], REPLIES_MAX_INTERVAL)
+
+    def test_interval_resets_on_new_replies(self):
+        for _i in range(3):
+            reschedule_replies("https://example.com/post/1", 0)
+        reschedule_replies("https://example.com/post/1", 2)
+        self.assertEqual(self.get_state("https://example.com/post/1")["interval"], REPLIES_MIN_INTERVAL)
+
+    def test_untracked_after_tracking_period(self):
+        state = self.get_state("https://example.com/post/1")
+        state["until"] = time.time() - 1
+        self.r.hset(REPLIES_STATE_KEY, "https://example.com/post/1", json.dumps(state))
+        reschedule_replies("https://example.com/post/1", 1)
+        self.assertIsNone(self.get_state("https://example.com/post/1"))
+        self.assertIsNone(self.r.zscore(REPLIES_DUE_KEY, "https://example.com/post/1"))
+
+
+@patch("socialhome.federate.replies.django_rq.enqueue")
+class TestRefreshReplyCollections(RepliesTestCase):
+    def test_queues_a_job_per_host_for_due_collections(self, mock_enqueue):
+        fids = [
+            "https://example.com/post/1", "https://example.com/post/2", "https://example.org/post/1",
+            "https://example.net/post/1",
+        ]
+        for fid in fids:
+            track_replies(fid)
+        self.r.zadd(REPLIES_DUE_KEY, {fid: time.time() - 1 for fid in fids[:3]})
+        self.assertEqual(refresh_reply_collections(), 3)
+        self.assertCountEqual(
+            mock_enqueue.call_args_list,
+            [
+                call(refresh_host_replies, "example.com", ["https://example.com/post/1", "https://example.com/post/2"]),
+                call(refresh_host_replies, "example.org", ["https://example.org/post/1"]),
+            ],
+        )
+        # Claimed until the jobs have run
+        mock_enqueue.reset_mock()
+        self.assertEqual(refresh_reply_collections(), 0)
+        self.assertFalse(mock_enqueue.called)
+
+    def test_limit(self, mock_enqueue):
+        for i in range(5):
+            track_replies(f"https://example.com/post/{i}")
+        self.r.zadd(REPLIES_DUE_KEY, {f"https://example.com/post/{i}": time.time() - 1 for i in range(5)})
+        self.assertEqual(refresh_reply_collections(limit=2), 2)
+        self.assertEqual(refresh_reply_collections(limit=2), 2)
+        self.assertEqual(refresh_reply_collections(limit=2), 1)
+
+
+@patch("socialhome.federate.replies.reschedule_replies")
+@patch("socialhome.federate.utils.tasks.process_replies", return_value=2)
+@patch("socialhome.federate.replies.retrieve_remote_content")
+class TestRefreshHostReplies(RepliesTestCase):
+    def test_processes_replies_and_reschedules(self, mock_retrieve, mock_process, mock_reschedule):
+        mock_retrieve.side_effect = [Mock(_replies=["https://example.com/reply/1"]), None, Exception]
+        refresh_host_replies(
+            "example.com", ["https://example.com/post/1", "https://example.com/post/2", "https://example.com/post/3"],
+        )
+        mock_process.assert_called_once_with("https://example.com/post/1", ["https://example.com/reply/1"])
+        self.assertEqual(
+            mock_reschedule.call_args_list,
+            [
+                call("https://example.com/post/1", 2), call("https://example.com/post/2", 0),
+                call("https://example.com/post/3", 0),
+            ],
+        )
@@ -2,7 +2,9 @@ from unittest.mock import patch, ANY
 
 from django.test import override_settings
 from federation.entities.base import Comment, Post
+from federation.exceptions import SignatureVerificationError
 from federation.tests.fixtures.keys import get_dummy_private_key
+from federation.types import RequestType
 from test_plus import TestCase
 
 from socialhome.content.tests.factories import (
@@ -10,7 +12,8 @@ from socialhome.content.tests.factories import (
 from socialhome.enums import Visibility
 from socialhome.federate.tasks import (
     receive_task, send_content, send_content_retraction, send_reply, forward_entity, _get_remote_followers,
-    send_follow_change, send_profile, send_share, send_profile_retraction, _get_limited_recipients)
+    send_follow_change, send_profile, send_share, send_profile_retraction, _get_limited_recipients,
+    _get_remote_participants_for_content)
 from socialhome.tests.utils import SocialhomeTestCase
 from socialhome.users.models import Profile
 from socialhome.users.tests.factories import (
@@ -24,22 +27,38 @@ class TestReceiveTask(SocialhomeTestCase):
     def setUpTestData(cls):
         super().setUpTestData()
         cls.user = UserFactory()
+        cls.request = RequestType(body=b"foobar", headers={}, method="POST", url="https://example.com/receive/public")
 
     @patch("socialhome.federate.tasks.handle_receive", return_value=("sender", "diaspora", ["entity"]), autospec=True)
     def test_receive_task_runs(self, mock_handle_receive, mock_process_entities):
-        receive_task("foobar")
+        receive_task(self.request)
         mock_process_entities.assert_called_with(["entity"])
 
     @patch("socialhome.federate.tasks.handle_receive", return_value=("sender", "diaspora", []), autospec=True)
     def test_receive_task_returns_none_on_no_entities(self, mock_handle_receive, mock_process_entities):
-        self.assertIsNone(receive_task("foobar"))
+        self.assertIsNone(receive_task(self.request))
         self.assertTrue(mock_process_entities.called is False)
 
     @patch("socialhome.federate.tasks.handle_receive", return_value=("sender", "diaspora", ["entity"]), autospec=True)
     def test_receive_task_with_uuid(self, mock_handle_receive, mock_process_entities):
-        receive_task("foobar", uuid=self.user.profile.uuid)
+        receive_task(self.request, uuid=self.user.profile.uuid)
         mock_process_entities.assert_called_with(["entity"])
 
+    @patch("socialhome.federate.tasks.handle_receive", return_value=("sender", "diaspora", ["entity"]), autospec=True)
+    def test_receive_task_drops_duplicates(self, mock_handle_receive, mock_process_entities):
+        receive_task(self.request)
+        receive_task(self.request)
+        self.assertEqual(mock_handle_receive.call_count, 1)
+        self.assertEqual(mock_process_entities.call_count, 1)
+        receive_task(self.request, uuid=self.user.profile.uuid)
+        self.assertEqual(mock_handle_receive.call_count, 2)
+
+    @patch("socialhome.federate.tasks.handle_receive", side_effect=SignatureVerificationError, autospec=True)
+    def test_receive_task_does_not_remember_failed_payloads(self, mock_handle_receive, mock_process_entities):
+        receive_task(self.request)
+        receive_task(self.request)
+        self.assertEqual(mock_handle_receive.call_count, 2)
+
 
 class TestSendContent(SocialhomeTestCase):
     @classmethod
@@ -62,7 +81,7 @@ class TestSendContent(SocialhomeTestCase):
         send_content(self.public_content.id, self.public_content.activities.first().fid)
         mock_maker.assert_called_once_with(self.public_content)
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_handle_send_is_called(self, mock_maker, mock_send):
         post = Post()
@@ -78,7 +97,7 @@ class TestSendContent(SocialhomeTestCase):
             payload_logger=None,
         )
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_handle_send_is_called__limited_content(self, mock_maker, mock_send):
         post = Post()
@@ -102,7 +121,7 @@ class TestSendContent(SocialhomeTestCase):
         self.assertTrue(mock_logger.called)
 
     @override_settings(DEBUG=True)
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     def test_content_not_sent_in_debug_mode(self, mock_send):
         send_content(self.public_content.id, "foo")
         self.assertTrue(mock_send.called is False)
@@ -118,12 +137,12 @@ class TestSendContentRetraction(SocialhomeTestCase):
         cls.profile = cls.user.profile
         cls.limited_content2 = LimitedContentFactory(author=cls.profile)
 
-    @patch("socialhome.federate.tasks.django_rq.enqueue", autospec=True)
-    @patch("socialhome.federate.tasks._get_limited_recipients", autospec=True)
+    @patch("socialhome.federate.tasks.queue_send", autospec=True)
+    @patch("socialhome.federate.tasks._get_limited_recipients", return_value=[], autospec=True)
     @patch("socialhome.federate.tasks.make_federable_retraction", return_value="entity", autospec=True)
-    def test_limited_retraction_calls_get_recipients(self, mock_maker, mock_get, mock_enqueue):
+    def test_limited_retraction_calls_get_recipients(self, mock_maker, mock_get, mock_send):
         send_content_retraction(self.limited_content2, self.limited_content2.author.id)
-        self.assertTrue(mock_enqueue.called is True)
+        self.assertTrue(mock_send.called is True)
         self.assertTrue(mock_get.called is True)
 
     @patch("socialhome.federate.tasks.make_federable_retraction", return_value=None, autospec=True)
@@ -138,17 +157,15 @@ class TestSendContentRetraction(SocialhomeTestCase):
         send_content_retraction(self.public_content, self.public_content.author_id)
         mock_maker.assert_called_once_with(self.public_content, self.public_content.author)
 
-    @patch("socialhome.federate.tasks.django_rq.enqueue", autospec=True)
+    @patch("socialhome.federate.tasks.queue_send", autospec=True)
     @patch("socialhome.federate.tasks.make_federable_retraction", return_value="entity", autospec=True)
-    def test_handle_create_payload_is_called(self, mock_maker, mock_enqueue):
+    def test_handle_create_payload_is_called(self, mock_maker, mock_send):
         send_content_retraction(self.public_content, self.public_content.author_id)
-        mock_enqueue.assert_called_once_with(
-            ANY,
+        mock_send.assert_called_once_with(
             "entity",
             self.public_content.author.federable,
             [],
             payload_logger=None,
-            job_timeout=10000,
         )
 
     @patch("socialhome.federate.tasks.make_federable_retraction", return_value=None)
@@ -158,13 +175,13 @@ class TestSendContentRetraction(SocialhomeTestCase):
         self.assertTrue(mock_logger.called is True)
 
     @override_settings(DEBUG=True)
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     def test_content_not_sent_in_debug_mode(self, mock_send):
         send_content_retraction(self.public_content, self.public_content.author_id)
         self.assertTrue(mock_send.called is False)
 
 
-@patch("socialhome.federate.tasks.handle_send")
+@patch("socialhome.federate.tasks.queue_send")
 @patch("socialhome.federate.tasks.make_federable_retraction", return_value="entity")
 class TestSendProfileRetraction(SocialhomeTestCase):
     @classmethod
@@ -225,7 +242,7 @@ class TestSendReply(SocialhomeTestCase):
         cls.limited_local_reply = LimitedContentFactory(author=author.profile, parent=cls.limited_local_content)
         cls.limited_local_reply.limited_visibilities.add(cls.remote_profile)
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.forward_entity")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_send_reply__ignores_local_root_author(self, mock_make, mock_forward, mock_sender):
@@ -235,7 +252,7 @@ class TestSendReply(SocialhomeTestCase):
         self.assertTrue(mock_sender.called is False)
         self.assertTrue(mock_forward.called is False)
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.forward_entity")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_send_reply__limited_content(self, mock_make, mock_forward, mock_sender):
@@ -249,7 +266,7 @@ class TestSendReply(SocialhomeTestCase):
             payload_logger=None,
         )
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.forward_entity")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_send_reply__to_remote_author(self, mock_make, mock_forward, mock_sender):
@@ -261,7 +278,7 @@ class TestSendReply(SocialhomeTestCase):
         ], payload_logger=None)
         self.assertTrue(mock_forward.called is False)
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.forward_entity")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_send_reply__to_remote_follower(self, mock_make, mock_forward, mock_sender):
@@ -299,7 +316,7 @@ class TestSendShare(SocialhomeTestCase):
         send_share(self.share.id, self.share.activities.first().fid)
         mock_maker.assert_called_once_with(self.share)
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_handle_send_is_called(self, mock_maker, mock_send):
         post = Post()
@@ -319,12 +336,12 @@ class TestSendShare(SocialhomeTestCase):
         self.assertTrue(mock_logger.called)
 
     @override_settings(DEBUG=True)
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     def test_content_not_sent_in_debug_mode(self, mock_send):
         send_share(self.share.id, "foo")
         self.assertTrue(mock_send.called is False)
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.make_federable_content")
     def test_doesnt_send_to_local_share_author(self, mock_maker, mock_send):
         post = Post()
@@ -332,6 +349,26 @@ class TestSendShare(SocialhomeTestCase):
         send_share(self.local_share.id, self.local_share.activities.first().fid)
         mock_send.assert_called_once_with(post, self.local_share.author.federable, [], payload_logger=None)
 
+    @patch("socialhome.federate.tasks.queue_send")
+    @patch("socialhome.federate.tasks.make_federable_content")
+    def test_followers_on_shared_inbox_get_one_delivery(self, mock_maker, mock_send):
+        post = Post()
+        mock_maker.return_value = post
+        user = UserFactory()
+        followers = ProfileFactory.create_batch(
+            3, inbox_public="https://example.com/inbox", protocol="activitypub",
+        )
+        other_follower = ProfileFactory(inbox_public="https://example.org/inbox", protocol="activitypub")
+        for follower in followers + [other_follower]:
+            follower.following.add(user.profile)
+        share = ContentFactory(share_of=self.local_content, author=user.profile, visibility=Visibility.PUBLIC)
+        send_share(share.id, share.activities.first().fid)
+        args, kwargs = mock_send.call_args
+        self.assertEqual(
+            sorted(recipient["endpoint"] for recipient in args[2]),
+            ["https://example.com/inbox", "https://example.org/inbox"],
+        )
+
 
 class TestForwardEntity(TestCase):
     @classmethod
@@ -350,7 +387,7 @@ class TestForwardEntity(TestCase):
         cls.remote_limited_reply = LimitedContentFactory(parent=cls.limited_content)
         cls.limited_content.limited_visibilities.set((cls.limited_reply.author, cls.remote_limited_reply.author))
 
-    @patch("socialhome.federate.tasks.handle_send", return_value=None, autospec=True)
+    @patch("socialhome.federate.tasks.queue_send", return_value=None, autospec=True)
     def test_forward_entity(self, mock_send):
         entity = Comment(actor_id=self.reply.author.fid, id=self.reply.fid)
         forward_entity(entity, self.public_content.id)
@@ -366,7 +403,7 @@ class TestForwardEntity(TestCase):
         args, kwargs = mock_send.call_args_list[0]
         self.assertEqual({recipient["fid"] for recipient in args[2]}, expected)
 
-    @patch("socialhome.federate.tasks.handle_send", return_value=None)
+    @patch("socialhome.federate.tasks.queue_send", return_value=None)
     def test_forward_entity__limited_content(self, mock_send):
         entity = Comment(actor_id=self.limited_reply.author.fid, id=self.limited_reply.fid)
         forward_entity(entity, self.limited_content.id)
@@ -375,6 +412,42 @@ class TestForwardEntity(TestCase):
         ], parent_user=self.limited_content.author.federable, payload_logger=None)
 
 
+class TestGetRemoteParticipantsForContent(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        author = UserFactory()
+        cls.content = PublicContentFactory(author=author.profile)
+        cls.share = PublicContentFactory(share_of=cls.content)
+        cls.share2 = PublicContentFactory(share_of=cls.content)
+        cls.replies = ContentFactory.create_batch(480, parent=cls.content)
+        cls.share_replies = ContentFactory.create_batch(10, parent=cls.share)
+        cls.share2_replies = ContentFactory.create_batch(10, parent=cls.share2)
+        cls.local_reply = ContentFactory(parent=cls.content, author=author.profile)
+
+    def test_participants_are_returned_in_thread_order(self):
+        participants = _get_remote_participants_for_content(self.content)
+        expected = [
+            item.author.get_recipient_for_visibility(Visibility.PUBLIC) for item in
+            self.replies + [self.share] + self.share_replies + [self.share2] + self.share2_replies
+        ]
+        self.assertEqual(participants, expected)
+
+    def test_exclude_is_excluded(self):
+        participants = _get_remote_participants_for_content(self.content, exclude=self.share.author.fid)
+        self.assertNotIn(self.share.author.fid, {participant["fid"] for participant in participants})
+        self.assertEqual(len(participants), 501)
+
+    def test_remote_content_is_skipped_unless_included(self):
+        self.assertEqual(_get_remote_participants_for_content(self.share), [])
+        self.assertEqual(len(_get_remote_participants_for_content(self.share, include_remote=True)), 10)
+
+    def test_query_count_does_not_depend_on_thread_size(self):
+        with self.assertNumQueries(2):
+            participants = _get_remote_participants_for_content(self.content)
+        self.assertEqual(len(participants), 502)
+
+
 class TestGetRemoteFollowers(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -437,7 +510,7 @@ class TestSendFollow(TestCase):
             rsa_public_key=get_dummy_private_key().publickey().exportKey(),
         )
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.send_profile")
     @patch("socialhome.federate.tasks.base.Follow", return_value="entity")
     def test_send_follow_change(self, mock_follow, mock_profile, mock_send):
@@ -462,7 +535,7 @@ class TestSendProfile(SocialhomeTestCase):
         cls.remote_profile = ProfileFactory()
         cls.remote_profile2 = ProfileFactory()
 
-    @patch("socialhome.federate.tasks.handle_send", autospec=True)
+    @patch("socialhome.federate.tasks.queue_send", autospec=True)
     @patch("socialhome.federate.tasks._get_remote_followers", autospec=True)
     @patch("socialhome.federate.tasks.make_federable_profile", return_value="profile", autospec=True)
     def test_send_local_profile(self, mock_federable, mock_get, mock_send):
@@ -485,7 +558,7 @@ class TestSendProfile(SocialhomeTestCase):
         send_profile(self.remote_profile.id)
         self.assertFalse(mock_make.called)
 
-    @patch("socialhome.federate.tasks.handle_send")
+    @patch("socialhome.federate.tasks.queue_send")
     @patch("socialhome.federate.tasks.make_federable_profile", return_value="profile")
     def test_send_to_given_recipients_only(self, mock_federable, mock_send):
         recipients = [self.remote_profile.fid]
@@ -0,0 +1,83 @@
+import json
+
+from django.test import override_settings
+
+from socialhome.federate.utils import (
+    get_entity_dedup_key, get_payload_dedup_keys, is_duplicate_payload, mark_payload_seen, get_duplicate_counts,
+)
+from socialhome.federate.utils.dedup import DUPLICATE_COUNTS_KEY
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.utils import get_redis_connection
+
+
+def make_activity(activity_id, actor="https://example.com/user/1", **kwargs):
+    obj = {"id": "https://example.com/note/1", "type": "Note", "published": "2021-01-01T00:00:00Z"}
+    obj.update(kwargs)
+    return json.dumps({"id": activity_id, "type": "Create", "actor": actor, "object": obj}).encode("utf-8")
+
+
+class TestGetEntityDedupKey(SocialhomeTestCase):
+    def test_key_from_activity_object(self):
+        self.assertEqual(
+            get_entity_dedup_key(make_activity("https://example.com/activity/1")),
+            "Create:https://example.com/user/1:https://example.com/note/1:2021-01-01T00:00:00Z",
+        )
+        self.assertEqual(
+            get_entity_dedup_key(make_activity("https://example.com/activity/2", updated="2021-01-02T00:00:00Z")),
+            "Create:https://example.com/user/1:https://example.com/note/1:2021-01-02T00:00:00Z",
+        )
+        self.assertEqual(
+            get_entity_dedup_key(
+                make_activity("https://example.com/activity/3", actor={"id": "https://example.com/user/2"}),
+            ),
+            "Create:https://example.com/user/2:https://example.com/note/1:2021-01-01T00:00:00Z",
+        )
+
+    def test_no_key(self):
+        self.assertIsNone(get_entity_dedup_key(b"<xml/>"))
+        self.assertIsNone(get_entity_dedup_key(b'["foo"]'))
+        self.assertIsNone(get_entity_dedup_key(b'{"type": "Delete", "object": "https://example.com/note/1"}'))
+        self.assertIsNone(get_entity_dedup_key(make_activity("https://example.com/activity/1", published=None)))
+        self.assertIsNone(get_entity_dedup_key(make_activity("https://example.com/activity/1", actor=None)))
+
+
+class TestIsDuplicatePayload(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        get_redis_connection().delete(DUPLICATE_COUNTS_KEY)
+
+    def test_body_duplicates(self):
+        self.assertFalse(is_duplicate_payload(b"<xml/>"))
+        mark_payload_seen(b"<xml/>")
+        self.assertTrue(is_duplicate_payload(b"<xml/>"))
+        self.assertFalse(is_duplicate_payload(b"<xml/>", uuid="1234"))
+        self.assertFalse(is_duplicate_payload(b"<xml2/>"))
+        self.assertEqual(get_duplicate_counts(), {"body": 1})
+
+    def test_entity_duplicates(self):
+        mark_payload_seen(make_activity("https://example.com/activity/1"))
+        # Relayed copy with a different body
+        self.assertTrue(is_duplicate_payload(make_activity("https://relay.example.com/activity/1")))
+        # Edited version is not a duplicate
+        self.assertFalse(
+            is_duplicate_payload(make_activity("https://example.com/activity/2", updated="2021-01-02T00:00:00Z")),
+        )
+        self.assertEqual(get_duplicate_counts(), {"entity": 1})
+
+    def test_same_object_from_other_actor_is_not_duplicate(self):
+        mark_payload_seen(make_activity("https://example.com/activity/1"))
+        self.assertFalse(is_duplicate_payload(
+            make_activity("https://example.org/activity/1", actor="https://example.org/user/1"),
+        ))
+        self.assertEqual(get_duplicate_counts(), {})
+
+    def test_seen_payloads_expire(self):
+        mark_payload_seen(b"<xml/>")
+        for key in get_payload_dedup_keys(b"<xml/>").values():
+            ttl = get_redis_connection().ttl(key)
+            self.assertTrue(0 < ttl <= 3600)
+
+    @override_settings(SOCIALHOME_INBOUND_DEDUP_TTL=0)
+    def test_disabled(self):
+        mark_payload_seen(b"<xml/>")
+        self.assertFalse(is_duplicate_payload(b"<xml/>"))
@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from socialhome.federate.utils import plan_deliveries
+
+
+def recipient(fid, endpoint="https://example.com/inbox", public=True, protocol="activitypub"):
+    return {"endpoint": endpoint, "fid": fid, "public": public, "protocol": protocol}
+
+
+class TestPlanDeliveries(TestCase):
+    def test_public_recipients_collapse_by_shared_inbox_and_protocol(self):
+        plan = plan_deliveries([
+            recipient("https://example.com/u/1"),
+            recipient("https://example.com/u/2"),
+            recipient("https://example.com/u/3", protocol="diaspora"),
+            recipient("https://example.org/u/1", endpoint="https://example.org/inbox"),
+        ])
+        self.assertEqual(plan.recipients, [
+            recipient("https://example.com/u/1"),
+            recipient("https://example.com/u/3", protocol="diaspora"),
+            recipient("https://example.org/u/1", endpoint="https://example.org/inbox"),
+        ])
+        self.assertEqual(plan.requested, 4)
+        self.assertEqual(plan.deliveries, 3)
+        self.assertEqual(plan.reduction, 0.25)
+
+    def test_limited_recipients_are_only_deduplicated(self):
+        plan = plan_deliveries([
+            recipient("https://example.com/u/1", public=False),
+            recipient("https://example.com/u/2", public=False),
+            recipient("https://example.com/u/1", public=False),
+        ])
+        self.assertEqual(plan.recipients, [
+            recipient("https://example.com/u/1", public=False),
+            recipient("https://example.com/u/2", public=False),
+        ])
+
+    def test_recipients_without_shared_inbox_are_only_deduplicated(self):
+        plan = plan_deliveries([
+            recipient("https://example.com/u/1", endpoint=""),
+            recipient("https://example.com/u/2", endpoint=""),
+            recipient("https://example.com/u/1", endpoint=""),
+            recipient("@foo:example.com", endpoint="https://matrix.example.com", protocol="matrix"),
+            recipient("@bar:example.com", endpoint="https://matrix.example.com", protocol="matrix"),
+        ])
+        self.assertEqual(plan.deliveries, 4)
+
+    def test_empty_recipients(self):
+        plan = plan_deliveries([None])
+        self.assertEqual(plan.recipients, [])
+        self.assertEqual(plan.requested, 0)
+        self.assertEqual(plan.reduction, 0.0)
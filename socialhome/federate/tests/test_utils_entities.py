@@ -1,13 +1,14 @@
 from django.conf import settings
 from django.test import override_settings, RequestFactory
 from federation.entities import base
+from federation.types import UserType, ReceiverVariant
 
 from socialhome.content.tests.factories import PublicContentFactory, SiteContentFactory, ContentFactory
 from socialhome.federate.utils import (
-    get_federable_object, get_profile, make_federable_profile, make_federable_retraction,
+    get_federable_object, get_profile, make_federable_profile, make_federable_retraction, get_profiles_from_receivers,
 )
 from socialhome.tests.utils import SocialhomeTestCase
-from socialhome.users.tests.factories import UserFactory, PublicUserFactory, SiteUserFactory
+from socialhome.users.tests.factories import UserFactory, PublicUserFactory, SiteUserFactory, ProfileFactory
 
 
 class TestGetFederableObject(SocialhomeTestCase):
@@ -110,3 +111,36 @@ class TestMakeFederableRetraction(SocialhomeTestCase):
     def test_target_id_correct_for_share(self):
         obj = make_federable_retraction(self.share, author=self.profile)
         self.assertEqual(obj.target_id, self.share.activities.first().fid)
+
+
+class TestGetProfilesFromReceivers(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.users = UserFactory.create_batch(5)
+        cls.remote_profile = ProfileFactory()
+        cls.remote_profile2 = ProfileFactory()
+        cls.remote_profile.followers.add(cls.users[0].profile, cls.users[1].profile)
+        cls.remote_profile2.followers.add(cls.users[1].profile, cls.users[2].profile)
+
+    def test_actors_and_followers(self):
+        receivers = [
+            UserType(id=self.users[3].profile.fid, receiver_variant=ReceiverVariant.ACTOR),
+            UserType(id=self.remote_profile.fid, receiver_variant=ReceiverVariant.ACTOR),
+            UserType(id=self.remote_profile.fid, receiver_variant=ReceiverVariant.FOLLOWERS),
+            UserType(id=self.remote_profile2.fid, receiver_variant=ReceiverVariant.FOLLOWERS),
+        ]
+        self.assertEqual(
+            set(get_profiles_from_receivers(receivers)),
+            {self.users[0].profile, self.users[1].profile, self.users[2].profile, self.users[3].profile},
+        )
+
+    def test_queries_do_not_grow_with_receivers(self):
+        receivers = [
+            UserType(id=user.profile.fid, receiver_variant=ReceiverVariant.ACTOR) for user in self.users
+        ] + [
+            UserType(id=profile.fid, receiver_variant=ReceiverVariant.FOLLOWERS)
+            for profile in (self.remote_profile, self.remote_profile2)
+        ]
+        with self.assertNumQueries(3):
+            self.assertEqual(len(get_profiles_from_receivers(receivers)), 5)
@@ -1,7 +1,9 @@
 from unittest.mock import patch
 
+from django.test import override_settings, RequestFactory
+
 from socialhome.federate.tasks import receive_task
-from socialhome.federate.utils import queue_payload
+from socialhome.federate.utils import queue_payload, mark_payload_seen
 from socialhome.tests.utils import SocialhomeTestCase
 
 
@@ -35,3 +37,22 @@ class TestQueuePayload(SocialhomeTestCase):
         queue_payload(request)
         _args, kwargs = mock_enqueue.call_args
         self.assertEqual(kwargs['uuid'], '1234')
+
+    @override_settings(SOCIALHOME_INBOUND_BATCHING=True)
+    @patch("socialhome.federate.inbound.push_payload", autospec=True)
+    @patch("socialhome.federate.utils.generic.django_rq.enqueue", autospec=True)
+    def test_pushes_to_inbound_queue_when_batching(self, mock_enqueue, mock_push):
+        self.assertTrue(queue_payload(self.request, uuid='1234'))
+        self.assertFalse(mock_enqueue.called)
+        args, kwargs = mock_push.call_args
+        self.assertEqual(args[0].body, self.request.body)
+        self.assertEqual(kwargs['uuid'], '1234')
+
+    @patch("socialhome.federate.utils.generic.django_rq.enqueue", autospec=True)
+    def test_drops_duplicates(self, mock_enqueue):
+        request = RequestFactory().post("/receive/public/", data="<xml/>", content_type="application/xml")
+        self.assertTrue(queue_payload(request))
+        self.assertEqual(mock_enqueue.call_count, 1)
+        mark_payload_seen(request.body)
+        self.assertTrue(queue_payload(request))
+        self.assertEqual(mock_enqueue.call_count, 1)
@@ -1,6 +1,13 @@
-from unittest.mock import patch, Mock, call
-
-from django.db import IntegrityError, transaction
+import logging
+import os
+import random
+import time
+import uuid
+from unittest import skipUnless
+from unittest.mock import patch, Mock, call, ANY
+
+from django.db import IntegrityError, transaction, connection
+from django.test.utils import CaptureQueriesContext
 from federation.entities import base
 from federation.entities.activitypub.entities import ActivitypubComment
 from federation.tests.factories import entities
@@ -10,12 +17,13 @@ from socialhome.content.enums import ContentType
 from socialhome.content.models import Content
 from socialhome.content.tests.factories import ContentFactory, LocalContentFactory, PublicContentFactory
 from socialhome.enums import Visibility
+from socialhome.federate.replies import REPLIES_DUE_KEY
 from socialhome.federate.tasks import forward_entity
 # noinspection PyProtectedMember
 from socialhome.federate.utils.tasks import (
     process_entities, get_sender_profile, process_entity_post,
     process_entity_retraction, sender_key_fetcher, process_entity_comment, process_entity_follow,
-    process_entity_share, _process_mentions)
+    process_entity_share, _process_mentions, EntityLookups, process_replies)
 from socialhome.federate.utils import make_federable_profile
 from socialhome.federate.utils.entities import make_federable_content, make_federable_retraction
 from socialhome.notifications.tasks import send_follow_notification
@@ -24,6 +32,10 @@ from socialhome.users.models import Profile
 from socialhome.users.tests.factories import (
     ProfileFactory, UserFactory, BaseProfileFactory, BaseShareFactory, PublicProfileFactory,
     SelfUserFactory)
+from socialhome.users.utils import cache_sender, get_cached_sender, get_sender_cache_key, sender_public_keys
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
 
 
 class TestProcessEntities(SocialhomeTestCase):
@@ -43,13 +55,13 @@ class TestProcessEntities(SocialhomeTestCase):
     @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value="profile")
     def test_process_entity_post_is_called(self, mock_sender, mock_process):
         process_entities([self.post])
-        mock_process.assert_called_once_with(self.post, "profile")
+        mock_process.assert_called_once_with(self.post, "profile", lookups=ANY)
 
     @patch("socialhome.federate.utils.tasks.process_entity_post")
     @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value="profile")
     def test_process_entity_post_is_called__with_receiving_profile(self, mock_sender, mock_process):
         process_entities([self.post])
-        mock_process.assert_called_once_with(self.post, "profile")
+        mock_process.assert_called_once_with(self.post, "profile", lookups=ANY)
 
     @patch("socialhome.federate.utils.tasks.process_entity_retraction")
     @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value="profile")
@@ -61,13 +73,13 @@ class TestProcessEntities(SocialhomeTestCase):
     @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value="profile")
     def test_process_entity_comment_is_called(self, mock_sender, mock_process):
         process_entities([self.comment])
-        mock_process.assert_called_once_with(self.comment, "profile")
+        mock_process.assert_called_once_with(self.comment, "profile", lookups=ANY)
 
     @patch("socialhome.federate.utils.tasks.process_entity_comment")
     @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value="profile")
     def test_process_entity_comment_is_called__with_receiving_profile(self, mock_sender, mock_process):
         process_entities([self.comment])
-        mock_process.assert_called_once_with(self.comment, "profile")
+        mock_process.assert_called_once_with(self.comment, "profile", lookups=ANY)
 
     @patch("socialhome.federate.utils.tasks.process_entity_follow")
     @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value="profile")
@@ -85,7 +97,7 @@ class TestProcessEntities(SocialhomeTestCase):
     @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value="profile")
     def test_process_entity_share_is_called(self, mock_sender, mock_process):
         process_entities([self.share])
-        mock_process.assert_called_once_with(self.share, "profile")
+        mock_process.assert_called_once_with(self.share, "profile", lookups=ANY)
 
     @patch("socialhome.federate.utils.tasks.process_entity_post", side_effect=Exception)
     @patch("socialhome.federate.utils.tasks.logger.exception")
@@ -94,6 +106,157 @@ class TestProcessEntities(SocialhomeTestCase):
         process_entities([self.post])
         self.assertEqual(mock_logger.called, 1)
 
+    def test_batch_of_comments_uses_prefetched_lookups(self):
+        parent = ContentFactory()
+        author = ProfileFactory()
+        mentioned = ProfileFactory()
+        comments = []
+        for i in range(5):
+            comment = base.Comment(
+                id=f"https://example.com/comment/{i}", target_id=parent.fid, raw_content="foobar",
+                actor_id=author.fid,
+            )
+            comment._mentions = {mentioned.fid}
+            comments.append(comment)
+        with patch.object(Content.objects, "fed", wraps=Content.objects.fed) as mock_content_fed, \
+                patch.object(Profile.objects, "fed", wraps=Profile.objects.fed) as mock_profile_fed, \
+                patch("socialhome.federate.utils.tasks.get_sender_profile") as mock_sender:
+            process_entities(comments)
+        self.assertFalse(mock_content_fed.called)
+        self.assertFalse(mock_profile_fed.called)
+        self.assertFalse(mock_sender.called)
+        replies = Content.objects.filter(parent=parent)
+        self.assertEqual(replies.count(), 5)
+        for reply in replies:
+            self.assertEqual(reply.author, author)
+            self.assertEqual(set(reply.mentions.all()), {mentioned})
+
+    def test_batch__retracted_content_is_looked_up_again(self):
+        author = ProfileFactory()
+        content = ContentFactory(author=author)
+        retraction = base.Retraction(entity_type="Post", target_id=content.fid, actor_id=author.fid)
+        comment = base.Comment(
+            id="https://example.com/comment", target_id=content.fid, raw_content="foobar", actor_id=author.fid,
+        )
+        with patch("socialhome.federate.utils.tasks.retrieve_remote_content", return_value=None):
+            process_entities([retraction, comment])
+        self.assertFalse(Content.objects.filter(id=content.id).exists())
+        self.assertFalse(Content.objects.filter(fid=comment.id).exists())
+
+
+class TestEntityLookups(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_local_and_remote_user()
+        cls.content = ContentFactory()
+        cls.other_content = ContentFactory()
+        cls.mentioned = ProfileFactory()
+        cls.comment = base.Comment(
+            id="https://example.com/comment", target_id=cls.content.fid, root_target_id="https://example.com/root",
+            raw_content="foobar", actor_id=cls.remote_profile.fid,
+        )
+        cls.comment._mentions = {cls.mentioned.fid, "https://example.com/unknown"}
+
+    def test_prefetches_with_a_query_for_profiles_and_content(self):
+        with self.assertNumQueries(2):
+            lookups = EntityLookups([self.comment, entities.PostFactory()])
+        with self.assertNumQueries(0):
+            self.assertEqual(lookups.get_content(self.content.fid), self.content)
+            self.assertIsNone(lookups.get_content("https://example.com/root"))
+            self.assertIsNone(lookups.get_content(self.comment.id))
+            self.assertEqual(lookups.get_profile(self.mentioned.fid), self.mentioned)
+            self.assertIsNone(lookups.get_profile("https://example.com/unknown"))
+            self.assertEqual(lookups.get_sender(self.remote_profile.fid), self.remote_profile)
+
+    def test_falls_back_to_a_query(self):
+        lookups = EntityLookups([self.comment])
+        with self.assertNumQueries(1):
+            self.assertEqual(lookups.get_content(self.other_content.fid), self.other_content)
+        with self.assertNumQueries(0):
+            self.assertEqual(lookups.get_content(self.other_content.fid), self.other_content)
+        with self.assertNumQueries(1):
+            self.assertEqual(lookups.get_profile(self.profile.fid), self.profile)
+
+    def test_add_content(self):
+        lookups = EntityLookups([self.comment])
+        content = ContentFactory(fid=self.comment.id)
+        lookups.add_content(content)
+        with self.assertNumQueries(0):
+            self.assertEqual(lookups.get_content(self.comment.id), content)
+
+    def test_forget_content(self):
+        lookups = EntityLookups([self.comment])
+        lookups.forget_content(self.content.fid)
+        with self.assertNumQueries(1):
+            self.assertEqual(lookups.get_content(self.content.fid), self.content)
+        lookups.forget_content("https://example.com/root")
+        with self.assertNumQueries(1):
+            self.assertIsNone(lookups.get_content("https://example.com/root"))
+
+    @patch("socialhome.federate.utils.tasks.get_sender_profile", return_value=None)
+    def test_get_sender__local_profile_is_not_used(self, mock_sender):
+        lookups = EntityLookups([entities.PostFactory(actor_id=self.profile.fid)])
+        self.assertIsNone(lookups.get_sender(self.profile.fid))
+        mock_sender.assert_called_once_with(self.profile.fid)
+
+
+@skipUnless(os.environ.get("SOCIALHOME_BENCHMARKS"), "Set SOCIALHOME_BENCHMARKS=1 to run benchmarks")
+class TestProcessEntitiesBenchmark(SocialhomeTestCase):
+    """Compare processing a corpus of entities one by one to processing it as one batch."""
+    posts = 100
+    comments = 300
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.authors = ProfileFactory.create_batch(10) + ProfileFactory.create_batch(10, diaspora=True)
+        for author in cls.authors:
+            author.followers.add(*[user.profile for user in UserFactory.create_batch(3)])
+
+    def make_corpus(self):
+        """Make posts and comments like the ones received over ActivityPub and Diaspora."""
+        corpus = []
+        posts = []
+        for _i in range(self.posts + self.comments):
+            author = random.choice(self.authors)
+            guid = str(uuid.uuid4())
+            kwargs = {
+                "id": f"https://example.com/objects/{guid}", "actor_id": author.fid, "raw_content": "foobar",
+                "guid": guid if author.guid else "", "handle": author.handle or "",
+            }
+            if len(posts) < self.posts:
+                entity = base.Post(public=random.choice((True, False)), provider_display_name="", **kwargs)
+                posts.append(entity)
+            else:
+                parent = random.choice(posts)
+                entity = base.Comment(target_id=parent.id, root_target_id=parent.id, **kwargs)
+            entity._mentions = {profile.handle or profile.fid for profile in random.sample(self.authors, 2)}
+            entity._receivers = [UserType(id=author.fid, receiver_variant=ReceiverVariant.FOLLOWERS)]
+            corpus.append(entity)
+        return corpus
+
+    @staticmethod
+    def timeit(func):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            func()
+            duration = time.perf_counter() - start
+        return duration, len(context.captured_queries)
+
+    def test_benchmark(self):
+        corpus = self.make_corpus()
+        single_duration, single_queries = self.timeit(lambda: [process_entities([entity]) for entity in corpus])
+        corpus = self.make_corpus()
+        batch_duration, batch_queries = self.timeit(lambda: process_entities(corpus))
+        self.assertEqual(
+            Content.objects.filter(fid__startswith="https://example.com/objects/").count(), len(corpus) * 2,
+        )
+        logger.info(
+            "%s entities: one by one %.2f s (%s queries), batch %.2f s (%s queries)", len(corpus), single_duration,
+            single_queries, batch_duration, batch_queries,
+        )
+
 
 class TestProcessMentions(SocialhomeTestCase):
     @classmethod
@@ -124,6 +287,20 @@ class TestProcessMentions(SocialhomeTestCase):
             set(),
         )
 
+    def test_addition_happens__with_lookups(self):
+        self.entity._mentions = {
+            self.profile.fid,
+            self.profile2.fid,
+        }
+        lookups = EntityLookups([self.entity])
+        with patch.object(Profile.objects, "fed_in") as mock_fed_in:
+            _process_mentions(self.content, self.entity, lookups=lookups)
+        self.assertFalse(mock_fed_in.called)
+        self.assertEqual(
+            set(self.content.mentions.all()),
+            {self.profile, self.profile2},
+        )
+
 
 class TestProcessEntityPost(SocialhomeTestCase):
     @classmethod
@@ -143,6 +320,12 @@ class TestProcessEntityPost(SocialhomeTestCase):
         content = Content.objects.get(fid=entity.id)
         self.assertEqual(content.limited_visibilities.count(), 0)
 
+    def test_reply_collection_is_tracked(self):
+        entity = entities.PostFactory()
+        entity._replies = []
+        process_entity_post(entity, ProfileFactory())
+        self.assertIsNotNone(get_redis_connection().zscore(REPLIES_DUE_KEY, entity.id))
+
     def test_visibility_is_added_to_receiving_followers(self):
         entity = entities.PostFactory(actor_id=self.profile.fid)
         entity._receivers = [UserType(id=entity.actor_id, receiver_variant=ReceiverVariant.FOLLOWERS)]
@@ -371,6 +554,36 @@ class TestProcessEntityComment(SocialhomeTestCase):
         self.assertFalse(mock_update.called)
 
 
+class TestProcessReplies(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.replies = ContentFactory.create_batch(3)
+
+    @patch("socialhome.federate.utils.tasks.retrieve_remote_content")
+    def test_existing_replies_are_checked_with_one_query(self, mock_retrieve):
+        with self.assertNumQueries(1):
+            self.assertEqual(process_replies("https://example.com/post", [reply.fid for reply in self.replies]), 0)
+        self.assertFalse(mock_retrieve.called)
+
+    @patch("socialhome.federate.utils.tasks.process_entities")
+    @patch("socialhome.federate.utils.tasks.retrieve_remote_content", side_effect=["entity", None])
+    def test_missing_replies_are_fetched_and_processed_together(self, mock_retrieve, mock_process):
+        reply_ids = [
+            self.replies[0].fid, "https://example.com/reply/1", "https://example.com/reply/2",
+            "https://example.com/reply/1",
+        ]
+        self.assertEqual(process_replies("https://example.com/post", reply_ids), 1)
+        self.assertEqual(
+            mock_retrieve.call_args_list, [call("https://example.com/reply/1"), call("https://example.com/reply/2")],
+        )
+        mock_process.assert_called_once_with(["entity"])
+
+    def test_no_replies(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(process_replies("https://example.com/post", []), 0)
+
+
 class TestProcessEntityRetraction(SocialhomeTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -572,6 +785,10 @@ class TestGetSenderProfile(SocialhomeTestCase):
         super().setUpTestData()
         cls.create_local_and_remote_user()
 
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+
     def test_returns_existing_profile(self):
         self.assertEqual(get_sender_profile(self.remote_profile.fid), self.remote_profile)
 
@@ -591,6 +808,18 @@ class TestGetSenderProfile(SocialhomeTestCase):
         assert sender_profile.rsa_public_key == "xyz"
         assert not sender_profile.rsa_private_key
 
+    def test_cached_sender_is_fetched_by_id(self):
+        get_sender_profile(self.remote_profile.fid)
+        self.assertEqual(get_cached_sender(self.remote_profile.fid)["id"], self.remote_profile.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_sender_profile(self.remote_profile.fid), self.remote_profile)
+
+    def test_stale_cached_sender_is_not_used(self):
+        other_profile = PublicProfileFactory()
+        cache_sender(other_profile)
+        self.r.set(get_sender_cache_key(self.remote_profile.fid), self.r.get(get_sender_cache_key(other_profile.fid)))
+        self.assertEqual(get_sender_profile(self.remote_profile.fid), self.remote_profile)
+
     @patch("socialhome.federate.utils.tasks.retrieve_remote_profile")
     def test_returns_none_if_no_remote_profile_found(self, mock_retrieve):
         mock_retrieve.return_value = None
@@ -733,6 +962,22 @@ class TestSenderKeyFetcher(SocialhomeTestCase):
     def test_local_profile_is_skipped(self):
         self.assertIsNone(sender_key_fetcher(self.profile.fid), self.profile.rsa_public_key)
 
+    def test_public_key_is_cached(self):
+        sender_key_fetcher(self.remote_profile.fid)
+        with self.assertNumQueries(0):
+            self.assertEqual(sender_key_fetcher(self.remote_profile.fid), self.remote_profile.rsa_public_key)
+
+    def test_public_key_is_shared_between_processes(self):
+        sender_key_fetcher(self.remote_profile.fid)
+        sender_public_keys.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(sender_key_fetcher(self.remote_profile.fid), self.remote_profile.rsa_public_key)
+
+    def test_cached_public_key_is_cleared_on_remote_profile_update(self):
+        sender_key_fetcher(self.remote_profile.fid)
+        Profile.from_remote_profile(BaseProfileFactory(id=self.remote_profile.fid, public_key="new key"))
+        self.assertEqual(sender_key_fetcher(self.remote_profile.fid), "new key")
+
     @patch("socialhome.federate.utils.tasks.retrieve_remote_profile")
     @patch("socialhome.federate.utils.tasks.Profile.from_remote_profile")
     def test_remote_profile_public_key_is_returned(self, mock_from_remote, mock_retrieve):
@@ -14,9 +14,11 @@ from socialhome.content.enums import ContentType
 from socialhome.content.models import Content
 from socialhome.content.tests.factories import ContentFactory
 from socialhome.enums import Visibility
+from socialhome.federate.inbound import INBOUND_QUEUE_KEY, INBOUND_RETRY_AFTER
 from socialhome.tests.utils import SocialhomeTestCase
 from socialhome.users.models import Profile, User
 from socialhome.users.tests.factories import UserFactory
+from socialhome.utils import get_redis_connection
 
 
 class TestFederationDiscovery(SocialhomeTestCase):
@@ -63,6 +65,29 @@ class TestFederationDiscovery(SocialhomeTestCase):
         self.get("federate:nodeinfo")
         self.response_200()
 
+    @override_settings(SOCIALHOME_STATISTICS=True)
+    def test_nodeinfo_is_served_from_cache_with_etag(self):
+        self.get("federate:nodeinfo")
+        self.response_200()
+        etag = self.last_response["ETag"]
+        self.assertEqual(json.loads(decode_if_bytes(self.last_response.content))["usage"]["users"]["total"], 1)
+        with self.assertNumQueries(0):
+            self.get("federate:nodeinfo")
+        self.assertEqual(self.last_response["ETag"], etag)
+        response = self.client.get(reverse("federate:nodeinfo"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(SOCIALHOME_STATISTICS=True)
+    def test_nodeinfo2_is_served_from_cache_with_etag(self):
+        response = self.client.get("/.well-known/x-nodeinfo2")
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(decode_if_bytes(response.content))
+        self.assertEqual(data["server"]["software"], "socialhome")
+        self.assertEqual(data["usage"]["users"]["total"], 1)
+        with self.assertNumQueries(0):
+            response = self.client.get("/.well-known/x-nodeinfo2", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
 
 class TestReceivePublic(SocialhomeTestCase):
     def test_receive_public_responds(self):
@@ -73,6 +98,27 @@ class TestReceivePublic(SocialhomeTestCase):
         )
         self.assertEqual(self.last_response.status_code, 202)
 
+    @override_settings(SOCIALHOME_INBOUND_BATCHING=True, SOCIALHOME_INBOUND_MAX_BACKLOG=1)
+    def test_receive_public_responds_429_when_backlogged(self):
+        r = get_redis_connection()
+        r.delete(INBOUND_QUEUE_KEY)
+        self.post(
+            "federate:receive-public",
+            data='<foobar/>',
+            extra={"content_type": "application/magic-envelope+xml"},
+        )
+        self.assertEqual(self.last_response.status_code, 202)
+        self.assertEqual(r.llen(INBOUND_QUEUE_KEY), 1)
+        self.post(
+            "federate:receive-public",
+            data='<foobar/>',
+            extra={"content_type": "application/magic-envelope+xml"},
+        )
+        self.assertEqual(self.last_response.status_code, 429)
+        self.assertEqual(self.last_response["Retry-After"], str(INBOUND_RETRY_AFTER))
+        self.assertEqual(r.llen(INBOUND_QUEUE_KEY), 1)
+        r.delete(INBOUND_QUEUE_KEY)
+
 
 class TestReceiveUser(SocialhomeTestCase):
     def test_receive_user_responds_for_json_payload(self):
@@ -4,12 +4,15 @@ from django.views.decorators.csrf import csrf_exempt
 from federation.hostmeta.generators import NODEINFO_DOCUMENT_PATH
 
 from socialhome.federate.views import (
-    host_meta_view, webfinger_view, hcard_view, nodeinfo_well_known_view, nodeinfo_view,
+    host_meta_view, webfinger_view, hcard_view, nodeinfo_well_known_view, nodeinfo_view, nodeinfo2_view,
     ReceivePublicView, ReceiveUserView, content_xml_view, content_fetch_view)
 
 app_name = 'federate'
 
 urlpatterns = [
+    # Cached version of the federation provided NodeInfo2 document
+    url(r"^.well-known/x-nodeinfo2$", nodeinfo2_view, name="nodeinfo2"),
+
     # Federation provided urls
     url(r"", include("federation.django.urls")),
 
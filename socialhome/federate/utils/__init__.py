@@ -1,3 +1,5 @@
+from .dedup import *  # noqa
+from .delivery import *  # noqa
 from .generic import *  # noqa
 from .entities import *  # noqa
 from .tasks import *  # noqa
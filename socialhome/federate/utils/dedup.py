@@ -0,0 +1,87 @@
+import json
+import logging
+from hashlib import sha256
+from typing import Dict, Optional, Union
+
+from django.conf import settings
+
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
+
+DUPLICATE_COUNTS_KEY = "sh:inbound:duplicates"
+
+
+def get_entity_dedup_key(body: Union[bytes, str]) -> Optional[str]:
+    """Get the activity type, actor, object id and update time of an ActivityPub payload.
+
+    Copies of the same activity delivered through different routes, for example by a relay and by the origin
+    server, have different bodies but the same key. Activities by different actors embedding the same object,
+    for example shares of it, have different keys. Other payloads don't have a key.
+    """
+    try:
+        data = json.loads(body)
+    except (TypeError, ValueError):
+        return
+    if not isinstance(data, dict) or not isinstance(data.get("object"), dict):
+        return
+    actor = data.get("actor")
+    if isinstance(actor, dict):
+        actor = actor.get("id")
+    obj = data["object"]
+    updated = obj.get("updated") or obj.get("published")
+    if not actor or not obj.get("id") or not updated:
+        return
+    return f"{data.get('type')}:{actor}:{obj['id']}:{updated}"
+
+
+def get_payload_dedup_keys(body: Union[bytes, str], uuid: str = None) -> Dict[str, str]:
+    """Get the Redis keys marking a payload as seen, by kind of duplicate."""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    keys = {"body": "sh:inbound:seen:body:%s" % sha256(str(uuid or "").encode("utf-8") + body).hexdigest()}
+    entity_key = get_entity_dedup_key(body)
+    if entity_key:
+        keys["entity"] = "sh:inbound:seen:entity:%s" % sha256(entity_key.encode("utf-8")).hexdigest()
+    return keys
+
+
+def is_duplicate_payload(body: Union[bytes, str], uuid: str = None) -> bool:
+    """Check whether a payload was already received and verified, before verifying it again.
+
+    Duplicates are counted by kind, see ``get_duplicate_counts``.
+    """
+    if not settings.SOCIALHOME_INBOUND_DEDUP_TTL or not body:
+        return False
+    keys = get_payload_dedup_keys(body, uuid)
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        for key in keys.values():
+            pipe.exists(key)
+        seen = pipe.execute()
+    for kind, exists in zip(keys, seen):
+        if exists:
+            r.hincrby(DUPLICATE_COUNTS_KEY, kind, 1)
+            logger.debug("is_duplicate_payload - dropping payload already received (%s)", kind)
+            return True
+    return False
+
+
+def mark_payload_seen(body: Union[bytes, str], uuid: str = None) -> None:
+    """Remember a payload that passed signature verification.
+
+    Only verified payloads are remembered, so a forged copy can't get the real one dropped.
+    """
+    if not settings.SOCIALHOME_INBOUND_DEDUP_TTL or not body:
+        return
+    r = get_redis_connection()
+    with r.pipeline() as pipe:
+        for key in get_payload_dedup_keys(body, uuid).values():
+            pipe.set(key, 1, ex=settings.SOCIALHOME_INBOUND_DEDUP_TTL)
+        pipe.execute()
+
+
+def get_duplicate_counts() -> Dict[str, int]:
+    """Get how many received payloads were dropped as duplicates, by kind."""
+    counts = get_redis_connection().hgetall(DUPLICATE_COUNTS_KEY)
+    return {key.decode("utf-8"): int(value) for key, value in counts.items()}
@@ -0,0 +1,59 @@
+import logging
+from typing import Dict, List, NamedTuple, Tuple
+
+logger = logging.getLogger("socialhome")
+
+# Protocols where a public payload is the same for every recipient, so one delivery per inbox is enough
+SHARED_INBOX_PROTOCOLS = ("activitypub", "diaspora")
+
+
+class DeliveryPlan(NamedTuple):
+    """Recipients to hand to ``handle_send``, with the fan-out before and after planning."""
+    recipients: List[Dict]
+    requested: int
+
+    @property
+    def deliveries(self) -> int:
+        return len(self.recipients)
+
+    @property
+    def reduction(self) -> float:
+        """Share of the requested deliveries that were avoided, from 0 to 1."""
+        if not self.requested:
+            return 0.0
+        return 1 - self.deliveries / self.requested
+
+
+def get_delivery_key(recipient: Dict) -> Tuple:
+    """Get the key recipients needing the same delivery share.
+
+    Public recipients of protocols with shared inboxes collapse by protocol and inbox. Other recipients, for
+    example limited ones which get a payload encrypted to them, are only deduplicated.
+    """
+    protocol = recipient.get("protocol")
+    endpoint = recipient.get("endpoint")
+    if recipient.get("public") and endpoint and protocol in SHARED_INBOX_PROTOCOLS:
+        return protocol, endpoint
+    return protocol, endpoint, recipient.get("fid"), bool(recipient.get("public"))
+
+
+def plan_deliveries(recipients: List[Dict]) -> DeliveryPlan:
+    """Collapse recipients into one per needed delivery, keeping the order of first appearance.
+
+    :param recipients: Recipient dictionaries, see ``Profile.get_recipient_for_visibility``
+    :returns: DeliveryPlan
+    """
+    recipients = [recipient for recipient in recipients if recipient]
+    planned = {}
+    for recipient in recipients:
+        planned.setdefault(get_delivery_key(recipient), recipient)
+    return DeliveryPlan(recipients=list(planned.values()), requested=len(recipients))
+
+
+def log_delivery_plan(name: str, plan: DeliveryPlan) -> None:
+    """Report the fan-out reduction of a send."""
+    logger.info(
+        "%s - %s deliveries for %s recipients (%.0f%% fewer)",
+        name, plan.deliveries, plan.requested, plan.reduction * 100,
+    )
+    logger.debug("%s - sending to recipients: %s", name, plan.recipients)
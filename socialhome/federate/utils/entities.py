@@ -109,21 +109,16 @@ def get_profiles_from_receivers(receivers: List[UserType]) -> List[Profile]:
     """
     Get a list of local Profile objects from a list of receivers in an entity.
     """
+    actor_ids = [receiver.id for receiver in receivers if receiver.receiver_variant == ReceiverVariant.ACTOR]
+    followed_ids = [receiver.id for receiver in receivers if receiver.receiver_variant == ReceiverVariant.FOLLOWERS]
     profile_ids = set()
-    for receiver in receivers:
-        if receiver.receiver_variant == ReceiverVariant.ACTOR:
-            try:
-                profile = Profile.objects.fed(receiver.id, user__isnull=False).get()
-            except Profile.DoesNotExist:
-                continue
-            else:
-                profile_ids.add(profile.id)
-        elif receiver.receiver_variant == ReceiverVariant.FOLLOWERS:
-            sender = Profile.objects.fed(receiver.id, user__isnull=True)
-            receiver_ids = set(
-                Profile.objects.filter(user__isnull=False, following__in=sender).values_list("id", flat=True),
-            )
-            profile_ids = profile_ids.union(receiver_ids)
+    if actor_ids:
+        profile_ids.update(Profile.objects.fed_in(actor_ids, user__isnull=False).values_list("id", flat=True))
+    if followed_ids:
+        senders = Profile.objects.fed_in(followed_ids, user__isnull=True)
+        profile_ids.update(
+            Profile.objects.filter(user__isnull=False, following__in=senders).values_list("id", flat=True),
+        )
     return Profile.objects.filter(id__in=profile_ids)
 
 
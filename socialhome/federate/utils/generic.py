@@ -1,4 +1,3 @@
-import datetime
 import logging
 import pickle
 import re
@@ -8,13 +7,12 @@ import django_rq
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.http import HttpRequest
-from django.utils.timezone import now
 from dynamic_preferences.registries import global_preferences_registry
 from federation.types import RequestType
 
 from socialhome import __version__ as version
-from socialhome.content.enums import ContentType
 from socialhome.federate.models import Payload
+from socialhome.federate.utils.dedup import is_duplicate_payload
 
 logger = logging.getLogger("socialhome")
 
@@ -36,12 +34,13 @@ def get_matrix_config() -> Optional[Dict]:
         }
 
 
-def get_nodeinfo2_data():
+def get_nodeinfo2_data(statistics: Dict = None):
     """
     Return data set for a NodeInfo2 document.
+
+    :param statistics: Counts from ``get_usage_statistics``, counted now if not given
     """
-    from socialhome.content.models import Content  # Circulars
-    from socialhome.users.models import User  # Circulars
+    from socialhome.federate.nodeinfo import get_usage_statistics  # Circulars
     site = Site.objects.get_current()
     data = {
         "server": {
@@ -54,16 +53,7 @@ def get_nodeinfo2_data():
         "openRegistrations": settings.ACCOUNT_ALLOW_REGISTRATION,
     }
     if settings.SOCIALHOME_STATISTICS:
-        data.update({"usage": {
-            "users": {
-                "total": User.objects.count(),
-                "activeHalfyear": User.objects.filter(last_login__gte=now() - datetime.timedelta(days=180)).count(),
-                "activeMonth": User.objects.filter(last_login__gte=now() - datetime.timedelta(days=30)).count(),
-                "activeWeek": User.objects.filter(last_login__gte=now() - datetime.timedelta(days=7)).count(),
-            },
-            "localPosts": Content.objects.filter(author__user__isnull=False, content_type=ContentType.CONTENT).count(),
-            "localComments": Content.objects.filter(author__user__isnull=False, content_type=ContentType.REPLY).count(),
-        }})
+        data["usage"] = statistics or get_usage_statistics()
     if settings.SOCIALHOME_SHOW_ADMINS:
         data.update({"organization": {
             "contact": settings.ADMINS[0][1],
@@ -100,7 +90,11 @@ def outbound_payload_logger(payload: Union[str, Dict], protocol: str, sender: st
 def queue_payload(request: HttpRequest, uuid: str = None):
     """
     Queue payload for processing.
+
+    Payloads go to a background job each, or with ``SOCIALHOME_INBOUND_BATCHING`` to the inbound queue read by
+    ``consume_payloads``.
     """
+    from socialhome.federate.inbound import push_payload  # Circulars
     from socialhome.federate.tasks import receive_task  # Circulars
     try:
         # Create a simpler request object we can push to RQ
@@ -131,7 +125,13 @@ def queue_payload(request: HttpRequest, uuid: str = None):
             if match:
                 uuid = match.groups()[0]
 
-        django_rq.enqueue(receive_task, _request, uuid=uuid)
+        if is_duplicate_payload(_request.body, uuid=uuid):
+            # Already received and processed, nothing to do
+            return True
+        if settings.SOCIALHOME_INBOUND_BATCHING:
+            push_payload(_request, uuid=uuid)
+        else:
+            django_rq.enqueue(receive_task, _request, uuid=uuid)
         return True
     except Exception:
         logger.exception('Failed to enqueue payload')
@@ -1,5 +1,4 @@
 import logging
-import datetime as dt
 from typing import Optional, List, Any
 
 import django_rq
@@ -10,9 +9,11 @@ from socialhome.content.enums import ContentType
 from socialhome.content.models import Content
 from socialhome.content.utils import safe_text, safe_text_for_markdown
 from socialhome.enums import Visibility
+from socialhome.federate.replies import track_replies
 from socialhome.federate.utils import get_profiles_from_receivers
 from socialhome.utils import safe_make_aware
 from socialhome.users.models import Profile, User
+from socialhome.users.utils import cache_sender, get_cached_sender, get_profile_identifiers, sender_public_keys
 
 logger = logging.getLogger("socialhome")
 
@@ -22,6 +23,12 @@ def get_sender_profile(sender: str) -> Optional[Profile]:
 
     Fetch it from federation layer if necessary or if the public key is empty for some reason.
     """
+    cached = get_cached_sender(sender)
+    if cached:
+        sender_profile = Profile.objects.filter(id=cached["id"], user__isnull=True).first()
+        # Make sure the profile wasn't changed or replaced after it was cached
+        if sender_profile and sender_profile.rsa_public_key and sender in get_profile_identifiers(sender_profile):
+            return sender_profile
     try:
         logger.debug("get_sender_profile - looking from local db using %s", sender)
         sender_profile = Profile.objects.fed(sender).exclude(rsa_public_key="").get()
@@ -36,33 +43,126 @@ def get_sender_profile(sender: str) -> Optional[Profile]:
         if sender_profile.is_local:
             logger.warning("get_sender_profile - %s is local! Skip.", sender)
             return
+        cache_sender(sender_profile)
     return sender_profile
 
 
+def get_entity_sender_id(entity) -> str:
+    return entity.id if isinstance(entity, base.Profile) else entity.actor_id
+
+
+class EntityLookups:
+    """Profiles and content referred to by a batch of entities, fetched up front with one query each.
+
+    Identifiers that were prefetched are answered from memory, including when nothing was found. Other
+    identifiers fall back to a query of their own.
+    """
+    def __init__(self, entities: List):
+        self.profiles = {}
+        self.contents = {}
+        self.prefetched_profiles = set()
+        self.prefetched_contents = set()
+        profile_ids = set()
+        content_ids = set()
+        for entity in entities:
+            profile_ids.add(get_entity_sender_id(entity))
+            # noinspection PyProtectedMember
+            profile_ids.update(getattr(entity, "_mentions", None) or ())
+            if isinstance(entity, (base.Post, base.Comment)):
+                content_ids.add(safe_text(entity.id))
+            if isinstance(entity, base.Comment):
+                content_ids.update((entity.target_id, entity.root_target_id))
+        profile_ids.discard(None)
+        content_ids.discard(None)
+        if profile_ids:
+            for profile in Profile.objects.fed_in(profile_ids):
+                self.add_profile(profile)
+            self.prefetched_profiles = profile_ids
+        if content_ids:
+            for content in Content.objects.fed_in(content_ids).select_related("author__user", "parent"):
+                self.add_content(content)
+            self.prefetched_contents = content_ids
+
+    def add_profile(self, profile: Profile):
+        for identifier in (profile.fid, profile.guid, profile.handle):
+            if identifier:
+                self.profiles[identifier] = profile
+
+    def add_content(self, content: Content):
+        for identifier in (content.fid, content.guid):
+            if identifier:
+                self.contents[identifier] = content
+
+    def forget_profile(self, identifier: str):
+        """Make the next lookup of a profile that may have changed query it again."""
+        profile = self.profiles.get(identifier)
+        for key in (profile.fid, profile.guid, profile.handle) if profile else (identifier,):
+            self.profiles.pop(key, None)
+            self.prefetched_profiles.discard(key)
+
+    def forget_content(self, identifier: str):
+        """Make the next lookup of a content that may have changed or been deleted query it again."""
+        content = self.contents.get(identifier)
+        for key in (content.fid, content.guid) if content else (identifier,):
+            self.contents.pop(key, None)
+            self.prefetched_contents.discard(key)
+
+    def get_profile(self, identifier: str) -> Optional[Profile]:
+        if identifier in self.profiles or identifier in self.prefetched_profiles:
+            return self.profiles.get(identifier)
+        profile = Profile.objects.fed(identifier).first()
+        if profile:
+            self.add_profile(profile)
+        return profile
+
+    def get_content(self, identifier: str) -> Optional[Content]:
+        if identifier in self.contents or identifier in self.prefetched_contents:
+            return self.contents.get(identifier)
+        content = Content.objects.fed(identifier).select_related("author__user", "parent").first()
+        if content:
+            self.add_content(content)
+        return content
+
+    def get_sender(self, sender: str) -> Optional[Profile]:
+        """Get the sender profile, see ``get_sender_profile``."""
+        profile = self.profiles.get(sender)
+        if profile and profile.user_id is None and profile.rsa_public_key:
+            return profile
+        profile = get_sender_profile(sender)
+        if profile:
+            self.add_profile(profile)
+        return profile
+
+
 def process_entities(entities: List):
-    """Process a list of entities."""
+    """Process a list of entities.
+
+    The profiles and content the entities refer to are fetched in bulk first, see ``EntityLookups``.
+    """
+    lookups = EntityLookups(entities)
     for entity in entities:
         logger.info("Entity: %s", entity)
         # noinspection PyProtectedMember
         logger.info("Receivers: %s", entity._receivers)
-        sender_id = entity.id if isinstance(entity, base.Profile) else entity.actor_id
-        profile = get_sender_profile(sender_id)
+        profile = lookups.get_sender(get_entity_sender_id(entity))
         if not profile:
             logger.warning("No sender profile for entity %s, skipping", entity)
             continue
         try:
             if isinstance(entity, base.Post):
-                process_entity_post(entity, profile)
+                process_entity_post(entity, profile, lookups=lookups)
             elif isinstance(entity, base.Retraction):
+                lookups.forget_content(safe_text(entity.target_id))
                 process_entity_retraction(entity, profile)
             elif isinstance(entity, base.Comment):
-                process_entity_comment(entity, profile)
+                process_entity_comment(entity, profile, lookups=lookups)
             elif isinstance(entity, base.Follow):
                 process_entity_follow(entity, profile)
             elif isinstance(entity, base.Profile):
+                lookups.forget_profile(entity.id)
                 Profile.from_remote_profile(entity)
             elif isinstance(entity, base.Share):
-                process_entity_share(entity, profile)
+                process_entity_share(entity, profile, lookups=lookups)
         except Exception as ex:
             logger.exception("Failed to handle %s: %s", entity.id, ex)
 
@@ -82,10 +182,10 @@ def process_entity_follow(entity, profile):
         logger.info("Profile %s has unfollowed user %s", profile, user)
 
 
-def validate_against_old_content(fid, entity, profile):
+def validate_against_old_content(fid, entity, profile, lookups: EntityLookups = None):
     """Do some validation against a possible local object."""
     try:
-        old_content = Content.objects.fed(fid).get()
+        old_content = _get_content(fid, lookups)
     except Content.DoesNotExist:
         return True
     # Do some validation
@@ -104,10 +204,10 @@ def validate_against_old_content(fid, entity, profile):
 
 
 # noinspection PyProtectedMember
-def process_entity_post(entity: Any, profile: Profile):
+def process_entity_post(entity: Any, profile: Profile, lookups: EntityLookups = None):
     """Process an entity of type Post."""
     fid = safe_text(entity.id)
-    if not validate_against_old_content(fid, entity, profile):
+    if not validate_against_old_content(fid, entity, profile, lookups=lookups):
         return
     values = {
         "fid": fid,
@@ -122,14 +222,13 @@ def process_entity_post(entity: Any, profile: Profile):
         values["guid"] = safe_text(entity.guid)
         extra_lookups["guid"] = values["guid"]
     content, created = Content.objects.fed_update_or_create(fid, values, extra_lookups=extra_lookups)
-    _process_mentions(content, entity)
+    if lookups:
+        lookups.add_content(content)
+    _process_mentions(content, entity, lookups=lookups)
     if created:
         logger.info("Saved Content: %s", content)
         if hasattr(entity, '_replies'):
-            if django_rq.get_scheduler().enqueue_in(dt.timedelta(seconds=90), process_replies, entity):
-                logger.info("process_replies - queued job for entity %s", entity.id)
-            else:
-                logger.warn("process_replies - failed to enqueue job for entity %s", entity.id)
+            track_replies(fid)
     else:
         logger.info("Updated Content: %s", content)
     if content.visibility == Visibility.LIMITED:
@@ -145,13 +244,13 @@ def process_entity_post(entity: Any, profile: Profile):
 
 
 # noinspection PyProtectedMember
-def process_entity_comment(entity: Any, profile: Profile):
+def process_entity_comment(entity: Any, profile: Profile, lookups: EntityLookups = None):
     """Process an entity of type Comment."""
     fid = safe_text(entity.id)
-    if not validate_against_old_content(fid, entity, profile):
+    if not validate_against_old_content(fid, entity, profile, lookups=lookups):
         return
     try:
-        parent = Content.objects.fed(entity.target_id).get()
+        parent = _get_content(entity.target_id, lookups)
     except Content.DoesNotExist:
         # Try fetching. If found, process and then try again
         # This maybe useless as federation should walk up to the root
@@ -172,8 +271,12 @@ def process_entity_comment(entity: Any, profile: Profile):
             # pixelfed uses the @ form in reply collections
             if getattr(remote_target, 'url', None) == entity.target_id:
                 entity.target_id = remote_target.id
+            if lookups:
+                # Fetching may have created the target and root, don't trust what was prefetched for them
+                lookups.forget_content(entity.target_id)
+                lookups.forget_content(entity.root_target_id)
             try:
-                parent = Content.objects.fed(entity.target_id).get()
+                parent = _get_content(entity.target_id, lookups)
             except Content.DoesNotExist:
                 logger.warning("Comment target was fetched from remote, but it is still missing locally! Comment: %s",
                                entity)
@@ -184,7 +287,7 @@ def process_entity_comment(entity: Any, profile: Profile):
     root_parent = parent
     if entity.root_target_id:
         try:
-            root_parent = Content.objects.fed(entity.root_target_id).get()
+            root_parent = _get_content(entity.root_target_id, lookups)
         except Content.DoesNotExist:
             pass
     visibility = None
@@ -203,14 +306,13 @@ def process_entity_comment(entity: Any, profile: Profile):
         values["guid"] = safe_text(entity.guid)
         extra_lookups["guid"] = values["guid"]
     content, created = Content.objects.fed_update_or_create(fid, values, extra_lookups=extra_lookups)
-    _process_mentions(content, entity)
+    if lookups:
+        lookups.add_content(content)
+    _process_mentions(content, entity, lookups=lookups)
     if created:
         logger.info("Saved Content from comment entity: %s", content)
         if hasattr(entity, '_replies'):
-            if django_rq.get_scheduler().enqueue_in(dt.timedelta(seconds=90), process_replies, entity):
-                logger.info("process_replies - queued job for entity %s", entity.id)
-            else:
-                logger.warn("process_replies - failed to enqueue job for entity %s", entity.id)
+            track_replies(fid)
     else:
         logger.info("Updated Content from comment entity: %s", content)
 
@@ -265,7 +367,20 @@ def _embed_entity_medias_to_post(children, text):
     return text
 
 
-def _process_mentions(content, entity):
+def _get_content(fid: str, lookups: EntityLookups = None) -> Content:
+    """Get Content by federated ID, from the batch lookups if given.
+
+    :raises: Content.DoesNotExist
+    """
+    if not lookups:
+        return Content.objects.fed(fid).get()
+    content = lookups.get_content(fid)
+    if not content:
+        raise Content.DoesNotExist
+    return content
+
+
+def _process_mentions(content, entity, lookups: EntityLookups = None):
     """
     Link mentioned profiles to the content.
     """
@@ -273,16 +388,15 @@ def _process_mentions(content, entity):
     existing_fids = set(content.mentions.values_list('fid', flat=True))
     to_remove = existing_fids.difference(fids)
     to_add = fids.difference(existing_fids)
-    for fid in to_remove:
-        try:
-            content.mentions.remove(Profile.objects.fed(fid).get())
-        except Profile.DoesNotExist:
-            pass
-    for fid in to_add:
-        try:
-            content.mentions.add(Profile.objects.fed(fid).get())
-        except Profile.DoesNotExist:
-            pass
+    if to_remove:
+        content.mentions.remove(*content.mentions.filter(fid__in=to_remove))
+    if to_add:
+        if lookups:
+            profiles = [profile for profile in map(lookups.get_profile, to_add) if profile]
+        else:
+            profiles = list(Profile.objects.fed_in(to_add))
+        if profiles:
+            content.mentions.add(*profiles)
 
 
 def _retract_content(target_fid, profile):
@@ -327,7 +441,7 @@ def process_entity_retraction(entity, profile):
         logger.debug("Ignoring retraction of entity_type %s", entity_type)
 
 
-def process_entity_share(entity, profile):
+def process_entity_share(entity, profile, lookups: EntityLookups = None):
     """Process an entity of type Share."""
     if not entity.entity_type == "Post":
         # TODO: enable shares of replies too
@@ -376,7 +490,7 @@ def process_entity_share(entity, profile):
     if getattr(entity, "guid", None):
         values["guid"] = safe_text(entity.guid)
     content, created = Content.objects.fed_update_or_create(fid, values, extra_lookups={'share_of': target_content})
-    _process_mentions(content, entity)
+    _process_mentions(content, entity, lookups=lookups)
     if created:
         logger.info("Saved share: %s", content)
     else:
@@ -389,34 +503,30 @@ def process_entity_share(entity, profile):
         django_rq.enqueue(forward_entity, entity, target_content.id)
 
 
-def process_replies(entity=None, fetch=False, delta=None):
-    # Process Activitypub reply collection
-    if fetch:
-        # Refresh entity
-        entity = retrieve_remote_content(entity.id)
-        if not entity: return
+def process_replies(fid: str, reply_ids: List[str]) -> int:
+    """Fetch and process the replies in an ActivityPub reply collection that we don't have yet.
 
-
-    for reply in getattr(entity, '_replies', []):
-        try:
-            content = Content.objects.fed(reply).get()
-        except Content.DoesNotExist:
-            # Try to fetch and process
-            logger.debug(
-                "process_replies - fetching reply %s for entity %s", reply, entity.id)
-            remote_content = retrieve_remote_content(reply)
-            if remote_content:
-                process_entities([remote_content])
-    
-    # Using a delta increasing by a factor of two, refresh
-    # the replies up to 5 days after publication
-    delta = delta * 2 if delta else dt.timedelta(minutes=15)
-    if hasattr(entity, '_replies'):
-        if delta < dt.timedelta(5):
-            if django_rq.get_scheduler().enqueue_in(delta, process_replies, entity, True, delta):
-                logger.info("process_replies - queued refresh job for entity %s", entity.id)
-            else:
-                logger.warn("process_replies - failed to enqueue refresh job for entity %s", entity.id)
+    :param fid: Fid of the content the replies are to
+    :param reply_ids: Ids of the replies in the collection
+    :returns: Number of replies fetched
+    """
+    if not reply_ids:
+        return 0
+    existing = set()
+    for reply_fid, reply_guid in Content.objects.fed_in(reply_ids).values_list("fid", "guid"):
+        existing.update((reply_fid, reply_guid))
+    remote_contents = []
+    # Keep the collection order so that replies to replies come after their parents
+    for reply in dict.fromkeys(reply_ids):
+        if reply in existing:
+            continue
+        logger.debug("process_replies - fetching reply %s for entity %s", reply, fid)
+        remote_content = retrieve_remote_content(reply)
+        if remote_content:
+            remote_contents.append(remote_content)
+    if remote_contents:
+        process_entities(remote_contents)
+    return len(remote_contents)
 
 
 def sender_key_fetcher(fid):
@@ -430,7 +540,16 @@ def sender_key_fetcher(fid):
     :rtype: str
     """
     logger.debug("sender_key_fetcher - Checking for fid '%s'", fid)
+    public_key = sender_public_keys.get(fid)
+    if public_key:
+        return public_key
+    cached = get_cached_sender(fid)
+    if cached:
+        sender_public_keys.set(fid, cached["public_key"])
+        return cached["public_key"]
     profile = get_sender_profile(fid)
     if not profile:
         return
+    if profile.rsa_public_key:
+        sender_public_keys.set(fid, profile.rsa_public_key)
     return profile.rsa_public_key
@@ -1,26 +1,24 @@
-import datetime
 import logging
 
 from django.conf import settings
-from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.http.response import Http404, JsonResponse, HttpResponseRedirect, HttpResponseNotFound, \
     HttpResponseServerError
 from django.shortcuts import get_object_or_404
-from django.utils.timezone import now
+from django.views.decorators.http import condition
 from django.views.generic import View
 
 from federation.entities.diaspora.utils import get_full_xml_representation
 from federation.hostmeta.generators import (
-    generate_host_meta, generate_legacy_webfinger, generate_hcard, get_nodeinfo_well_known_document, NodeInfo,
+    generate_host_meta, generate_legacy_webfinger, generate_hcard, get_nodeinfo_well_known_document,
 )
 from federation.protocols.diaspora.magic_envelope import MagicEnvelope
 
-from socialhome import __version__ as version
-from socialhome.content.enums import ContentType
 from socialhome.content.models import Content
 from socialhome.enums import Visibility
+from socialhome.federate.inbound import INBOUND_RETRY_AFTER, is_backlogged
+from socialhome.federate.nodeinfo import get_nodeinfo_document
 from socialhome.federate.utils import queue_payload
 from socialhome.federate.utils.entities import make_federable_content
 from socialhome.users.models import User, Profile
@@ -86,29 +84,33 @@ def nodeinfo_well_known_view(request):
     return JsonResponse(wellknown)
 
 
+def nodeinfo_etag(request, name):
+    return get_nodeinfo_document(name)[1]
+
+
+def nodeinfo_document_response(name):
+    body, etag = get_nodeinfo_document(name)
+    response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    return response
+
+
+@condition(etag_func=lambda request: nodeinfo_etag(request, "nodeinfo"))
 def nodeinfo_view(request):
-    """Generate a NodeInfo document."""
-    site = Site.objects.get_current()
-    usage = {"users": {}}
-    if settings.SOCIALHOME_STATISTICS:
-        usage = {
-            "users": {
-                "total": User.objects.count(),
-                "activeHalfyear": User.objects.filter(last_login__gte=now() - datetime.timedelta(days=180)).count(),
-                "activeMonth": User.objects.filter(last_login__gte=now() - datetime.timedelta(days=30)).count(),
-            },
-            "localPosts": Content.objects.filter(author__user__isnull=False, content_type=ContentType.CONTENT).count(),
-            "localComments": Content.objects.filter(author__user__isnull=False, content_type=ContentType.REPLY).count(),
-        }
-    nodeinfo = NodeInfo(
-        software={"name": "socialhome", "version": version},
-        protocols={"inbound": ["diaspora"], "outbound": ["diaspora"]},
-        services={"inbound": [], "outbound": []},
-        open_registrations=settings.ACCOUNT_ALLOW_REGISTRATION,
-        usage=usage,
-        metadata={"nodeName": site.name}
-    )
-    return JsonResponse(nodeinfo.doc)
+    """Generate a NodeInfo document.
+
+    Served rendered from Redis, see ``refresh_nodeinfo_documents``.
+    """
+    return nodeinfo_document_response("nodeinfo")
+
+
+@condition(etag_func=lambda request: nodeinfo_etag(request, "nodeinfo2"))
+def nodeinfo2_view(request):
+    """Generate a NodeInfo2 document.
+
+    Served rendered from Redis, see ``refresh_nodeinfo_documents``.
+    """
+    return nodeinfo_document_response("nodeinfo2")
 
 
 def content_xml_view(request, uuid):
@@ -156,9 +158,18 @@ def content_fetch_view(request, objtype, guid):
         raise Http404()
 
 
+def backlogged_response():
+    """Ask the remote server to try again later, the inbound queue is full."""
+    response = HttpResponse(status=429)
+    response["Retry-After"] = INBOUND_RETRY_AFTER
+    return response
+
+
 class ReceivePublicView(View):
     """Generic federation /receive/public view."""
     def post(self, request, *args, **kwargs):
+        if is_backlogged():
+            return backlogged_response()
         if queue_payload(request):
             return HttpResponse(status=202)
         return HttpResponseBadRequest()
@@ -167,6 +178,8 @@ class ReceivePublicView(View):
 class ReceiveUserView(View):
     """Diaspora /receive/users view."""
     def post(self, request, *args, **kwargs):
+        if is_backlogged():
+            return backlogged_response()
         if queue_payload(request, uuid=kwargs.get('uuid')):
             return HttpResponse(status=202)
         return HttpResponseBadRequest()
@@ -0,0 +1,73 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from socialhome.streams.streams import ADD_TO_STREAM_SCRIPT, REDIS_BATCH_SIZE, BaseStream
+from socialhome.streams.tasks import delete_redis_keys
+from socialhome.utils import get_redis_connection
+
+KEY_PREFIX = "sh:benchmark:streams"
+# Benchmark keys expire by themselves if the benchmark is interrupted
+EXPIRY = 60 * 60
+
+
+class Command(BaseCommand):
+    help = "Benchmark Redis memory used by stream precaches. Fills a stream per user with the previous layout, " \
+           "which stored a through for every item, and with the current one, which only stores throughs of " \
+           "shares. The benchmark keys are deleted at the end."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, help="Amount of streams to fill, defaults to 10000.", default=10000)
+        parser.add_argument("--items", type=int, help="Items per stream, defaults to 100.", default=100)
+        parser.add_argument(
+            "--shares", type=float, help="Share of items that are shares, defaults to 0.1.", default=0.1,
+        )
+
+    def handle(self, *args, **options):
+        r = get_redis_connection()
+        items = [
+            (id, id + 1000000 if random.random() < options["shares"] else id, 1500000000 + id)
+            for id in range(1, options["items"] + 1)
+        ]
+        for layout in ("previous", "current"):
+            keys = ["%s:%s:%s" % (KEY_PREFIX, layout, user_id) for user_id in range(options["users"])]
+            before = r.info("memory")["used_memory"]
+            if layout == "previous":
+                self.fill_previous(keys, items)
+            else:
+                self.fill_current(keys, items)
+            used = r.info("memory")["used_memory"] - before
+            key_count = sum(1 for _key in r.scan_iter(match="%s:%s:*" % (KEY_PREFIX, layout), count=1000))
+            self.stdout.write(
+                "%s layout: %.1f MB, %.0f bytes per stream, %s keys" % (
+                    layout.capitalize(), used / 1024 / 1024, used / len(keys), key_count,
+                )
+            )
+            delete_redis_keys("%s:%s:*" % (KEY_PREFIX, layout), only_without_expiry=False, ops_per_second=0)
+
+    @staticmethod
+    def fill_previous(keys, items):
+        r = get_redis_connection()
+        for index in range(0, len(keys), REDIS_BATCH_SIZE // 10):
+            with r.pipeline(transaction=False) as pipe:
+                for key in keys[index:index + REDIS_BATCH_SIZE // 10]:
+                    throughs_key = BaseStream.get_throughs_key(key)
+                    pipe.zadd(key, {id: score for id, _through, score in items})
+                    pipe.hset(throughs_key, mapping={id: through for id, through, _score in items})
+                    pipe.expire(key, EXPIRY)
+                    pipe.expire(throughs_key, EXPIRY)
+                pipe.execute()
+
+    @staticmethod
+    def fill_current(keys, items):
+        r = get_redis_connection()
+        script = r.register_script(ADD_TO_STREAM_SCRIPT)
+        for index in range(0, len(keys), REDIS_BATCH_SIZE // 10):
+            with r.pipeline(transaction=False) as pipe:
+                for key in keys[index:index + REDIS_BATCH_SIZE // 10]:
+                    for id, through, score in items:
+                        script(
+                            keys=[key, BaseStream.get_throughs_key(key)], args=[id, through, score, EXPIRY],
+                            client=pipe,
+                        )
+                pipe.execute()
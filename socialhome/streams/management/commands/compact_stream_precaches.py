@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from socialhome.streams.tasks import compact_stream_throughs
+
+
+class Command(BaseCommand):
+    help = "Remove throughs that are the content itself from stream precaches, which are no longer stored. " \
+           "Safe to run while Socialhome is running."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ops-per-second", type=int, help="Most Redis operations per second, 0 to not limit. Defaults to "
+                                               "SOCIALHOME_REDIS_MAINTENANCE_OPS.",
+        )
+
+    def handle(self, *args, **options):
+        counts = compact_stream_throughs(ops_per_second=options["ops_per_second"])
+        self.stdout.write(
+            "Examined %s throughs hashes, removed %s throughs." % (counts["examined"], counts["removed"]),
+        )
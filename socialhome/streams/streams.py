@@ -1,50 +1,136 @@
+import binascii
 import datetime
+import heapq
+import json
 import logging
 import time
-from typing import List, Tuple, Dict
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import List, Tuple, Dict, Set, NamedTuple, Union
 
 import django_rq
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.db.models import Case, When, Q
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from django.utils.functional import cached_property
 from django.utils.timezone import now
 
 from socialhome.content.enums import ContentType
 from socialhome.content.models import Content
+from socialhome.enums import Visibility
 from socialhome.streams.consumers import notify_listeners
 from socialhome.streams.enums import StreamType
 from socialhome.users.models import User, Profile
+from socialhome.users.utils import filter_recently_active_user_ids
 from socialhome.utils import get_redis_connection
 
 logger = logging.getLogger("socialhome")
 
 
+# Add content to a stream unless already there, in which case only the through is updated if it differs.
+# Throughs are only stored when they differ from the content, ie for shares. Other content is its own through.
+# KEYS: stream key, throughs key. ARGV: content id, through id, score, expiry.
+ADD_TO_STREAM_SCRIPT = """
+if redis.call("ZSCORE", KEYS[1], ARGV[1]) then
+    if ARGV[1] ~= ARGV[2] then
+        redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+        redis.call("EXPIRE", KEYS[2], ARGV[4])
+    end
+    return 0
+end
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+if ARGV[1] ~= ARGV[2] then
+    redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+    redis.call("EXPIRE", KEYS[2], ARGV[4])
+end
+return 1
+"""
+
+# Trim a stream to the given size, removing the throughs of the removed items too.
+# KEYS: stream key, throughs key. ARGV: size.
+TRIM_STREAM_SCRIPT = """
+local removed = redis.call("ZRANGE", KEYS[1], 0, -ARGV[1] - 1)
+if #removed == 0 then
+    return 0
+end
+redis.call("ZREMRANGEBYRANK", KEYS[1], 0, -ARGV[1] - 1)
+for i = 1, #removed, 1000 do
+    redis.call("HDEL", KEYS[2], unpack(removed, i, math.min(i + 999, #removed)))
+end
+return #removed
+"""
+
+# Get a range of a stream with the scores and throughs, in one round trip.
+# KEYS: stream key, throughs key. ARGV: "rank", start, stop or "score", max, min, offset, count.
+GET_STREAM_RANGE_SCRIPT = """
+local items
+if ARGV[1] == "rank" then
+    items = redis.call("ZREVRANGE", KEYS[1], ARGV[2], ARGV[3], "WITHSCORES")
+else
+    items = redis.call("ZREVRANGEBYSCORE", KEYS[1], ARGV[2], ARGV[3], "WITHSCORES", "LIMIT", ARGV[4], ARGV[5])
+end
+local result = {}
+for i = 1, #items, 2 do
+    result[#result + 1] = {items[i], items[i + 1], redis.call("HGET", KEYS[2], items[i]) or items[i]}
+end
+return result
+"""
+
+# How many keys to write per Redis pipeline
+REDIS_BATCH_SIZE = 1000
+
+# Ordered set of profiles with an author timeline, scored by the time it was last written to.
+# See ``is_fan_out_on_read``.
+AUTHOR_TIMELINES_KEY = "sh:timelines:authors"
+
+# Visibilities of content in shared timelines, by audience. Other content visible to a user is fetched from the
+# database when the stream is read.
+SHARED_TIMELINE_VISIBILITIES = {
+    "anonymous": (Visibility.PUBLIC,),
+    "site": (Visibility.PUBLIC, Visibility.SITE),
+}
+
+# Ordered set of precached stream keys, scored by the time they were last written to. Used by
+# ``groom_redis_precaches`` so that it doesn't need to go through the whole keyspace.
+PRECACHE_KEYS_KEY = "sh:precache:keys"
+
+
 def add_to_redis(content, through, keys):
     """Add content to a list of Redis ordered sets.
 
+    Keys are written in pipelined batches using a server side script, so that each key update is atomic
+    and adding the same content again is idempotent.
+
     :param content: Content object to add
     :param through: Content through object. For example on shares, this is the linked share content object
     :param keys: List of keys to add to
+    :return: Count of keys the content was added to, ie was not in already
     """
     if not keys:
-        return
+        return 0
     r = get_redis_connection()
-    for key in keys:
-        rank = r.zrank(key, content.id)
-        if rank:
-            # If through is not content, update
-            if content.id != through.id:
-                throughs_key = BaseStream.get_throughs_key(key)
-                r.hset(throughs_key, content.id, through.id)
-        else:
-            # Only add if not in the set already
-            # This stops shares popping up more than once, for example
-            r.zadd(key, {content.id: int(time.time())})
-            r.expire(key, settings.REDIS_DEFAULT_EXPIRY)
-            throughs_key = BaseStream.get_throughs_key(key)
-            r.hset(throughs_key, content.id, through.id)
-            r.expire(throughs_key, settings.REDIS_DEFAULT_EXPIRY)
+    script = r.register_script(ADD_TO_STREAM_SCRIPT)
+    score = int(time.time())
+    added = 0
+    start = time.perf_counter()
+    for index in range(0, len(keys), REDIS_BATCH_SIZE):
+        pipeline = r.pipeline(transaction=False)
+        batch = keys[index:index + REDIS_BATCH_SIZE]
+        for key in batch:
+            script(
+                keys=[key, BaseStream.get_throughs_key(key)],
+                args=[content.id, through.id, score, settings.REDIS_DEFAULT_EXPIRY],
+                client=pipeline,
+            )
+        pipeline.zadd(PRECACHE_KEYS_KEY, {key: score for key in batch})
+        added += sum(pipeline.execute()[:-1])
+    elapsed = time.perf_counter() - start
+    logger.debug(
+        "add_to_redis - wrote %s keys (%s new) in %.3f seconds, %.0f keys/s",
+        len(keys), added, elapsed, len(keys) / elapsed if elapsed else 0,
+    )
+    return added
 
 
 def add_to_stream_for_users(content_id, through_id, stream_cls_name, acting_profile_id):
@@ -52,11 +138,13 @@ def add_to_stream_for_users(content_id, through_id, stream_cls_name, acting_prof
 
     Excludes author of content.
 
+    Eligible users are resolved for all precached users at once, see ``check_and_add_to_keys_for_users``.
+
     This function is designed to be queued to RQ.
     """
     stream_cls = globals().get(stream_cls_name)
     try:
-        content = Content.objects.get(id=content_id)
+        content = Content.objects.select_related("author").prefetch_related("tags").get(id=content_id)
     except Content.DoesNotExist:
         logger.warning("Stream.add_to_stream_for_users - content %s does not exist!", content_id)
         return
@@ -71,17 +159,79 @@ def add_to_stream_for_users(content_id, through_id, stream_cls_name, acting_prof
         logger.warning("Stream.add_to_stream_for_users - acting profile %s does not exist!", acting_profile_id)
         return
 
-    qs = get_precache_users_qs(acting_profile)
+    users = list(get_precache_users_qs(acting_profile))
     cache_keys = []
     notify_keys = set()
-    # Cache for each active user`
-    for user in qs.iterator():
-        check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile, notify_keys,
-                              through.content_type == ContentType.SHARE)
-    add_to_redis(content, through, cache_keys)
+    check_and_add_to_keys_for_users(
+        stream_cls, users, content, cache_keys, acting_profile, notify_keys,
+        through.content_type == ContentType.SHARE,
+    )
+    if stream_cls is FollowedStream and is_fan_out_on_read(content, acting_profile):
+        # Followers merge the author timeline in when reading their stream
+        add_to_author_timeline(content, through, acting_profile)
+    else:
+        add_to_redis(content, through, cache_keys)
     notify_listeners(content, notify_keys)
 
 
+def get_author_timeline_key(profile_id):
+    return "sh:timelines:author:%s" % profile_id
+
+
+def get_author_timeline_ids():
+    """Get the ID's of the profiles with an author timeline that hasn't expired."""
+    r = get_redis_connection()
+    ids = r.zrangebyscore(AUTHOR_TIMELINES_KEY, time.time() - settings.REDIS_DEFAULT_EXPIRY, "+inf")
+    return {int(id) for id in ids}
+
+
+def is_fan_out_on_read(content, acting_profile):
+    """Check whether content should go to the author timeline instead of to each follower stream.
+
+    Only for content visible to all local users, from profiles with at least
+    ``settings.SOCIALHOME_STREAMS_FAN_OUT_ON_READ_FOLLOWERS`` local followers.
+    """
+    threshold = settings.SOCIALHOME_STREAMS_FAN_OUT_ON_READ_FOLLOWERS
+    if not threshold or content.content_type != ContentType.CONTENT or \
+            content.visibility not in (Visibility.PUBLIC, Visibility.SITE):
+        return False
+    return acting_profile.followers.filter(user__isnull=False).count() >= threshold
+
+
+def add_to_author_timeline(content, through, profile):
+    """Add content to the timeline of the profile that authored or shared it, see ``FollowedStream``."""
+    key = get_author_timeline_key(profile.id)
+    keys = [key, BaseStream.get_throughs_key(key)]
+    r = get_redis_connection()
+    add_script = r.register_script(ADD_TO_STREAM_SCRIPT)
+    trim_script = r.register_script(TRIM_STREAM_SCRIPT)
+    score = int(time.time())
+    with r.pipeline(transaction=False) as pipeline:
+        add_script(keys=keys, args=[content.id, through.id, score, settings.REDIS_DEFAULT_EXPIRY], client=pipeline)
+        # Author timelines are not groomed, see ``groom_redis_precaches``
+        trim_script(keys=keys, args=[settings.SOCIALHOME_STREAMS_PRECACHE_SIZE], client=pipeline)
+        pipeline.zadd(AUTHOR_TIMELINES_KEY, {profile.id: score})
+        pipeline.execute()
+
+
+def add_stream_to_keys(stream, user, cache_keys, acting_profile, notify_keys, is_share):
+    """Add a stream that should cache the content to the cache and notify keys.
+
+    :param stream: Stream instance which should cache the content.
+    :param user: User the stream belongs to.
+    :param cache_keys: List of existing stream keys to add to.
+    :param acting_profile: The Profile object that caused this check.
+    :param notify_keys: List of existing notify keys to add to.
+    :param is_share: Boolean whether this is a shared content.
+    """
+    if stream.__class__ in CACHED_STREAM_CLASSES:
+        cache_keys.append(stream.key)
+    if is_share and (not stream.notify_for_shares or acting_profile.user_id == user.id):
+        return
+    if user.recently_active:
+        notify_keys.add(stream.notify_key)
+
+
 def check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile, notify_keys, is_share):
     """Check if content should be added to this user stream and add to the keys if so.
 
@@ -104,12 +254,57 @@ def check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile,
     streams = stream_cls.get_target_streams(content, user, acting_profile)
     for stream in streams:
         if stream.should_cache_content(content):
-            if stream_cls in CACHED_STREAM_CLASSES:
-                cache_keys.append(stream.key)
-            if is_share and (not stream.notify_for_shares or acting_profile == getattr(user, "profile", None)):
-                continue
-            if user.recently_active:
-                notify_keys.add(stream.notify_key)
+            add_stream_to_keys(stream, user, cache_keys, acting_profile, notify_keys, is_share)
+
+
+def check_and_add_to_keys_for_users(stream_cls, users, content, cache_keys, acting_profile, notify_keys, is_share):
+    """Bulk version of ``check_and_add_to_keys`` for a list of users.
+
+    Instead of running the stream queryset once per user, the users that should cache the content are
+    resolved with a fixed amount of queries per stream class, see ``BaseStream.get_cacheable_user_ids``.
+    User activity is resolved with one Redis round-trip.
+
+    :param users: List of User objects to check for.
+
+    See ``check_and_add_to_keys`` for the rest of the parameters.
+    """
+    if not users:
+        return
+    active_ids = filter_recently_active_user_ids(user.id for user in users)
+    for user in users:
+        # Prime the cached property so we don't hit Redis per user
+        user.recently_active = user.id in active_ids
+    if stream_cls not in CACHED_STREAM_CLASSES:
+        # We're only going to notify, so skip users who are not around to be notified
+        users = [user for user in users if user.recently_active]
+        if not users:
+            return
+    user_ids = stream_cls.get_cacheable_user_ids(content, {user.id for user in users}, acting_profile)
+    for user in users:
+        if user.id not in user_ids:
+            continue
+        for stream in stream_cls.get_target_streams(content, user, acting_profile):
+            add_stream_to_keys(stream, user, cache_keys, acting_profile, notify_keys, is_share)
+
+
+def get_visible_user_ids(content, user_ids):
+    """Filter a set of User ID's down to those the content is visible to.
+
+    Mirrors logic in `ContentQuerySet.visible_for_user`, but for a set of users at once.
+
+    :param content: Content object to check.
+    :param user_ids: Set of User ID's.
+    :return: Set of User ID's
+    """
+    if content.visibility in (Visibility.PUBLIC, Visibility.SITE):
+        return set(user_ids)
+    visible_ids = {content.author.user_id} & set(user_ids)
+    if content.visibility == Visibility.LIMITED:
+        visible_ids.update(
+            uid for uid in content.limited_visibilities.filter(user__isnull=False).values_list("user_id", flat=True)
+            if uid in user_ids
+        )
+    return visible_ids
 
 
 def get_precache_users_qs(acting_profile):
@@ -128,6 +323,53 @@ def get_precache_users_qs(acting_profile):
     return qs
 
 
+def get_shared_timeline_keys(content, audiences=None):
+    """Get the keys of the shared timelines the content belongs in.
+
+    :param audiences: Audiences to get the keys for. Defaults to the audiences the content is visible to.
+    """
+    if audiences is None:
+        audiences = [
+            audience for audience, visibilities in SHARED_TIMELINE_VISIBILITIES.items()
+            if content.visibility in visibilities
+        ]
+    return [
+        key for stream_cls in SHARED_TIMELINE_CLASSES for key in stream_cls.get_shared_timeline_keys(content, audiences)
+    ]
+
+
+def add_to_shared_timelines(content):
+    """Add content to the shared timelines it belongs in and trim them."""
+    keys = get_shared_timeline_keys(content)
+    if not keys:
+        return
+    r = get_redis_connection()
+    with r.pipeline(transaction=False) as pipeline:
+        for key in keys:
+            pipeline.zadd(key, {content.id: int(content.created.timestamp())})
+            pipeline.zremrangebyrank(key, 0, -settings.SOCIALHOME_STREAMS_SHARED_TIMELINE_SIZE - 1)
+            pipeline.expire(key, settings.REDIS_DEFAULT_EXPIRY)
+        pipeline.execute()
+
+
+def remove_from_shared_timelines(content):
+    """Remove content from all the shared timelines it could be in."""
+    keys = get_shared_timeline_keys(content, audiences=SHARED_TIMELINE_VISIBILITIES.keys())
+    if not keys:
+        return
+    r = get_redis_connection()
+    with r.pipeline(transaction=False) as pipeline:
+        for key in keys:
+            pipeline.zrem(key, content.id)
+        pipeline.execute()
+
+
+def update_shared_timelines(content):
+    """Update the shared timelines after content has been edited, for example its visibility changed."""
+    remove_from_shared_timelines(content)
+    add_to_shared_timelines(content)
+
+
 def update_streams_with_content(content):
     """Handle content adding to streams.
 
@@ -140,6 +382,8 @@ def update_streams_with_content(content):
     if content.content_type == ContentType.SHARE:
         # If this is a share we want to cache the shared content, not the original
         content = content.share_of
+    if through == content:
+        add_to_shared_timelines(content)
     # Do author immediately
     if acting_profile.is_local:
         keys = []
@@ -159,18 +403,66 @@ def update_streams_with_content(content):
         notify_listeners(content, {"streams_content__%s" % content.root_parent.channel_group_name})
 
 
+class StreamCursor(NamedTuple):
+    """Position of the last item of a stream page.
+
+    When ``cached`` is true, ``value`` is the score of the item in the stream Redis precache. Otherwise it is
+    the value of the stream ordering field of the item in the database. ``id`` is the content ID, used as
+    a tiebreaker for items with the same ``value``.
+    """
+    cached: bool
+    value: Union[int, str]
+    id: int
+
+    @classmethod
+    def decode(cls, cursor: str) -> "StreamCursor":
+        """Decode an opaque cursor string.
+
+        The value must be an integer score for cached cursors. Otherwise it's either an integer or an ISO 8601
+        datetime, depending on the stream ordering field.
+
+        :raises ValueError: If the cursor is not valid.
+        """
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            cached, value, id = json.loads(urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+        except (TypeError, UnicodeError, binascii.Error, json.JSONDecodeError) as ex:
+            raise ValueError("Invalid cursor: %s" % ex)
+        if not isinstance(id, int) or isinstance(id, bool):
+            raise ValueError("Invalid cursor id")
+        if isinstance(value, str) and not cached:
+            if not parse_datetime(value):
+                raise ValueError("Invalid cursor value")
+        elif not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("Invalid cursor value")
+        return cls(bool(cached), value, id)
+
+    def encode(self) -> str:
+        """Encode to an opaque string to be passed to clients."""
+        data = json.dumps([int(self.cached), self.value, self.id], separators=(",", ":"))
+        return urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
 class BaseStream:
     accept_ids = None
+    cursor = None
     last_id = None
+    next_cursor = None
     key_base = ["sh", "streams"]
     notify_for_shares = True
     ordering = "-created"
     paginate_by = 15
     redis = None
+    # Whether the stream is read from a timeline cached once for all users, see ``get_shared_content_ids``
+    shared_timeline = False
     stream_type = None
 
-    def __init__(self, last_id: int = None, user: User = None, accept_ids: List = None, **kwargs):
+    def __init__(
+        self, last_id: int = None, user: User = None, accept_ids: List = None, cursor: StreamCursor = None,
+        **kwargs,
+    ):
         self.accept_ids = accept_ids or []
+        self.cursor = cursor
         self.last_id = last_id
         self.user = user
 
@@ -189,6 +481,8 @@ class BaseStream:
         return ids, throughs
 
     def get_cached_content_ids(self):
+        if self.cursor or not self.last_id:
+            return self.get_cached_range_by_cursor()
         self.init_redis_connection()
         index = 0
         if self.last_id:
@@ -201,21 +495,171 @@ class BaseStream:
 
     def get_cached_range(self, index):
         self.init_redis_connection()
-        raw_ids = self.redis.zrevrange(self.key, index, index + self.paginate_by)
-        if not raw_ids:
+        items = self.get_cached_items("rank", index, index + self.paginate_by)
+        if not items:
             return [], {}
-        ids = [int(x) for x in raw_ids]
-        # Get throughs and make it a dict
-        throughs = self.redis.hmget(self.get_throughs_key(self.key), keys=ids)
-        throughs = {id: int(through) for id, through in zip(ids, throughs)}
+        ids = [id for id, _score, _through in items]
+        throughs = {id: through for id, _score, through in items}
         return ids, throughs
 
+    def get_cached_items(self, *args, client=None, key=None):
+        """Get a range of cached items, see ``GET_STREAM_RANGE_SCRIPT``.
+
+        :param client: Pipeline to queue the script to. The items are not returned in this case.
+        :param key: Precache to get the items from. Defaults to ``cache_key``.
+        :returns: List of tuples of content ID, score and through ID
+        """
+        key = key or self.cache_key
+        script = self.redis.register_script(GET_STREAM_RANGE_SCRIPT)
+        items = script(keys=[key, self.get_throughs_key(key)], args=args, client=client or self.redis)
+        if client:
+            return
+        return self.parse_cached_items(items)
+
+    @staticmethod
+    def parse_cached_items(items):
+        return [(int(id), int(float(score)), int(through)) for id, score, through in items]
+
+    def get_cached_range_by_cursor(self):
+        """Get a page of cached content ID's after the cursor, if any.
+
+        Items are ordered by score and then by member, the same way Redis orders sorted sets, so that inserts
+        between page loads don't shift the pages.
+        """
+        return self.get_cached_page(self.get_cached_items_by_cursor())
+
+    def get_cached_items_by_cursor(self, keys=None):
+        """Get the cached items after the cursor, at most a page of them.
+
+        :param keys: Precaches to merge the items of. Defaults to ``cache_key``.
+        :returns: List of tuples of content ID, score and through ID
+        """
+        if self.cursor and not self.cursor.cached:
+            # Cursor is already past the cached items
+            return []
+        self.init_redis_connection()
+        keys = keys or [self.cache_key]
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            if self.cursor:
+                # Items with the same score as the cursor that come after it, then the items with a lower score
+                self.get_cached_items("score", self.cursor.value, self.cursor.value, 0, -1, client=pipeline, key=key)
+                self.get_cached_items(
+                    "score", "(%s" % self.cursor.value, "-inf", 0, self.paginate_by, client=pipeline, key=key,
+                )
+            else:
+                self.get_cached_items("score", "+inf", "-inf", 0, self.paginate_by, client=pipeline, key=key)
+        results = pipeline.execute()
+        if self.cursor:
+            cursor_member = str(self.cursor.id).encode("utf-8")
+            results = [
+                [item for item in ties if item[0] < cursor_member] + items
+                for ties, items in zip(results[::2], results[1::2])
+            ]
+        if len(results) == 1:
+            return self.parse_cached_items(results[0])
+        # Merge the precaches, which are each in the same order already
+        merged = heapq.merge(
+            *(self.parse_cached_items(items) for items in results),
+            key=lambda item: (item[1], str(item[0])), reverse=True,
+        )
+        items = []
+        ids = set()
+        for item in merged:
+            if item[0] not in ids:
+                ids.add(item[0])
+                items.append(item)
+            if len(items) >= self.paginate_by:
+                break
+        return items
+
+    def get_cached_page(self, items):
+        """Get content ID's and throughs for a page of cached items and set the next cursor."""
+        items = items[:self.paginate_by]
+        if not items:
+            return [], {}
+        ids = [id for id, _score, _through in items]
+        self.next_cursor = StreamCursor(True, items[-1][1], ids[-1])
+        throughs = {id: through for id, _score, through in items}
+        return ids, throughs
+
+    @property
+    def cache_key(self):
+        """Key of the precache the stream is read from."""
+        return self.get_shared_timeline_key(self.key_extra, self.audience) if self.shared_timeline else self.key
+
+    @property
+    def audience(self):
+        """Audience of the shared timeline for the stream user, see ``SHARED_TIMELINE_VISIBILITIES``."""
+        return "site" if self.user.is_authenticated else "anonymous"
+
+    def get_shared_content_ids(self):
+        """Get a page of content ID's from the shared timeline of the stream.
+
+        Content that is visible to the user but not to the whole audience of the timeline, like limited content,
+        is fetched from the database and merged in.
+        """
+        self.init_redis_connection()
+        if not self.redis.exists(self.cache_key):
+            self.fill_shared_timeline()
+        items = self.get_cached_items_by_cursor()
+        if self.audience == "site" and (items or not self.cursor):
+            items = self.merge_shared_exceptions(items)
+        return self.get_cached_page(items)
+
+    def merge_shared_exceptions(self, items):
+        """Merge content only visible to the stream user in to a page of shared timeline items."""
+        qs = self.get_queryset().exclude(visibility__in=SHARED_TIMELINE_VISIBILITIES[self.audience])
+        if self.cursor:
+            qs = qs.filter(created__lt=datetime.datetime.fromtimestamp(self.cursor.value + 1, datetime.timezone.utc))
+        if len(items) >= self.paginate_by:
+            qs = qs.filter(created__gte=datetime.datetime.fromtimestamp(items[-1][1], datetime.timezone.utc))
+        exceptions = [
+            (item["id"], int(item["created"].timestamp()), item["through"])
+            for item in qs.values("id", "created", "through").order_by("-created", "-id")[:self.paginate_by]
+        ]
+        if self.cursor:
+            position = (self.cursor.value, str(self.cursor.id))
+            exceptions = [item for item in exceptions if (item[1], str(item[0])) < position]
+        # Same order as Redis, by score and then by member
+        return sorted(items + exceptions, key=lambda item: (item[1], str(item[0])), reverse=True)
+
+    def fill_shared_timeline(self):
+        """Fill the shared timeline of the stream from the database, if it's not cached."""
+        visibilities = SHARED_TIMELINE_VISIBILITIES[self.audience]
+        items = self.get_queryset().filter(visibility__in=visibilities).values_list("id", "created").order_by(
+            "-created", "-id",
+        )[:settings.SOCIALHOME_STREAMS_SHARED_TIMELINE_SIZE]
+        if not items:
+            return
+        with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.zadd(self.cache_key, {id: int(created.timestamp()) for id, created in items})
+            pipeline.expire(self.cache_key, settings.REDIS_DEFAULT_EXPIRY)
+            pipeline.execute()
+
+    @classmethod
+    def get_shared_timeline_key(cls, key_extra, audience):
+        """
+        Get shared timeline key.
+
+        Format: ``sh:timelines:<streamtype>:<keyextra>:<audience>``
+        """
+        parts = ["sh", "timelines", cls.stream_type.value]
+        if key_extra:
+            parts.append(key_extra)
+        return ":".join(parts + [audience])
+
+    @classmethod
+    def get_shared_timeline_keys(cls, content, audiences):
+        """Get the keys of the shared timelines of this class the content belongs in, for the given audiences."""
+        return []
+
     def init_redis_connection(self):
         if not self.redis:
             self.redis = get_redis_connection()
 
     def get_content(self):
-        """Get queryset of Content objects.
+        """Get list of Content objects.
 
         Keep ordering as returned by the list of content id's.
         """
@@ -223,12 +667,25 @@ class BaseStream:
             ids, throughs = self.get_accept_ids_content_ids()
         else:
             ids, throughs = self.get_content_ids()
-        # Case/When tip thanks to https://stackoverflow.com/a/37648265/1489738
-        preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(ids)])
-        content = Content.objects.filter(id__in=ids)\
-            .select_related("author__user", "share_of").prefetch_related("tags").order_by(preserved)
+        content = self.get_content_by_ids(ids)
+        if self.shared_timeline:
+            # Visibility could have changed after the content was added to the shared timeline
+            content = [item for item in content if item.visible_for_user(self.user)]
         return content, throughs
 
+    @staticmethod
+    def get_content_by_ids(ids: List[int]) -> List[Content]:
+        """Fetch Content objects by primary key and return them in the order of ``ids``.
+
+        Ordering is done in Python rather than with a ``CASE`` expression in the query, which would grow with the
+        page size and prevent Postgres from reusing query plans.
+        """
+        if not ids:
+            return []
+        content = Content.objects.filter(id__in=ids).select_related("author__user", "share_of").prefetch_related("tags")
+        content_by_id = {item.id: item for item in content}
+        return [content_by_id[id] for id in ids if id in content_by_id]
+
     def get_content_ids(self):
         """Get a list of content ID's."""
         ids = []
@@ -237,23 +694,84 @@ class BaseStream:
             ids, throughs = self.get_cached_content_ids()
             if len(ids) >= self.paginate_by:
                 return ids, throughs
+        elif self.shared_timeline and (self.cursor or not self.last_id):
+            ids, throughs = self.get_shared_content_ids()
+            if len(ids) >= self.paginate_by:
+                return ids, throughs
         remaining = self.paginate_by - len(ids)
         qs = self.get_queryset()
-        if self.last_id:
+        if self.last_id and not self.cursor:
             if self.ordering == "-created":
                 qs = qs.filter(through__lt=self.last_id)
             else:
                 qs = qs.filter(through__gt=self.last_id)
-        # Get and fill remaining items
-        ids_throughs = qs.values("id", "through").order_by(self.ordering)[:remaining]
-        for item in ids_throughs:
+            # Get and fill remaining items
+            ids_throughs = qs.values("id", "through").order_by(self.ordering)[:remaining]
+            for item in ids_throughs:
+                ids.append(item["id"])
+                throughs[item["id"]] = item["through"]
+            return ids, throughs
+        return self.get_keyset_content_ids(qs, ids, throughs, remaining)
+
+    def get_keyset_content_ids(self, qs, ids, throughs, remaining):
+        """Fill remaining content ID's from the database using keyset pagination.
+
+        Continues after the last cached ID, if any, or otherwise after the cursor. Ordering is by the stream
+        ordering field with the content ID as tiebreaker.
+        """
+        field = self.ordering.lstrip("-")
+        descending = self.ordering.startswith("-")
+        if ids:
+            position = (self.get_ordering_value(ids[-1]), ids[-1])
+            qs = qs.exclude(id__in=ids)
+        elif self.cursor and self.cursor.cached:
+            position = (self.get_ordering_value(self.cursor.id), self.cursor.id)
+        elif self.cursor:
+            position = (self.cursor.value, self.cursor.id)
+        else:
+            position = None
+        if position:
+            value, id = position
+            lookup = "lt" if descending else "gt"
+            if value is None:
+                # The cursor content has been removed, best effort is to continue by ID
+                qs = qs.filter(**{f"id__{lookup}": id})
+            else:
+                qs = qs.filter(Q(**{f"{field}__{lookup}": value}) | Q(**{field: value, f"id__{lookup}": id}))
+        items = list(qs.values("id", "through", field).order_by(
+            self.ordering, "-id" if descending else "id",
+        )[:remaining])
+        for item in items:
             ids.append(item["id"])
             throughs[item["id"]] = item["through"]
+        if items:
+            value = items[-1][field]
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            self.next_cursor = StreamCursor(False, value, items[-1]["id"])
         return ids, throughs
 
+    def get_ordering_value(self, content_id):
+        """Get the value of the stream ordering field for a content."""
+        return Content.objects.filter(id=content_id).values_list(self.ordering.lstrip("-"), flat=True).first()
+
     def get_queryset(self, *args, **kwars):
         raise NotImplemented
 
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids: Set[int], acting_profile) -> Set[int]:
+        """Get the User ID's for which the target streams of this class should cache the content.
+
+        Set based counterpart of ``should_cache_content`` which must resolve the users with a fixed amount
+        of queries, regardless of the amount of users given.
+
+        :param content: Content object being added to streams.
+        :param user_ids: Set of User ID's to check.
+        :param acting_profile: The Profile that caused the caching, ie author or sharer.
+        :return: Set of User ID's
+        """
+        raise NotImplementedError
+
     @classmethod
     def get_target_streams(cls, content, user, acting_profile):
         """Get a list of target instances of this class.
@@ -332,6 +850,53 @@ class FollowedStream(BaseStream):
     def get_queryset(self, single_id=None):
         return Content.objects.followed(self.user, single_id=single_id)
 
+    @cached_property
+    def author_timeline_keys(self):
+        """Timeline keys of followed profiles whose content is not added to the stream precache."""
+        author_ids = get_author_timeline_ids()
+        if not author_ids:
+            return []
+        followed_ids = self.user.profile.following.filter(id__in=author_ids).values_list("id", flat=True)
+        return [get_author_timeline_key(id) for id in followed_ids]
+
+    def get_cached_content_ids(self):
+        """Get cached content ID's, continuing after ``last_id`` in the merged precaches when paging with it.
+
+        The position of ``last_id`` is its highest score in the precaches, as duplicates are dropped after
+        their first occurrence when merging.
+        """
+        if self.cursor or not self.last_id or not self.author_timeline_keys:
+            return super().get_cached_content_ids()
+        self.init_redis_connection()
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in [self.key] + self.author_timeline_keys:
+            pipeline.zscore(key, self.last_id)
+        scores = [score for score in pipeline.execute() if score is not None]
+        if not scores:
+            return [], {}
+        self.cursor = StreamCursor(True, int(max(scores)), int(self.last_id))
+        return self.get_cached_range_by_cursor()
+
+    def get_cached_range_by_cursor(self):
+        """Get a page of cached content ID's after the cursor, if any.
+
+        The stream precache is merged with the timelines of followed profiles with many followers, see
+        ``is_fan_out_on_read``.
+        """
+        return self.get_cached_page(self.get_cached_items_by_cursor(keys=[self.key] + self.author_timeline_keys))
+
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT:
+            return set()
+        # Content is followed via the author or any of the sharers
+        author_ids = {content.author_id}
+        author_ids.update(Content.objects.filter(share_of=content).values_list("author_id", flat=True))
+        follower_ids = Profile.objects.filter(
+            following__in=author_ids, user__isnull=False,
+        ).values_list("user_id", flat=True).distinct()
+        return get_visible_user_ids(content, set(follower_ids) & user_ids)
+
     @property
     def notify_key_extra(self):
         return self.user.id
@@ -343,6 +908,12 @@ class LimitedStream(BaseStream):
     def get_queryset(self, single_id=None):
         return Content.objects.limited(self.user, single_id=single_id)
 
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT or content.visibility != Visibility.LIMITED:
+            return set()
+        return get_visible_user_ids(content, user_ids)
+
     @property
     def notify_key_extra(self):
         return self.user.id
@@ -350,11 +921,24 @@ class LimitedStream(BaseStream):
 
 class LocalStream(BaseStream):
     notify_for_shares = False
+    shared_timeline = True
     stream_type = StreamType.LOCAL
 
     def get_queryset(self, single_id=None):
         return Content.objects.local(self.user, single_id=single_id)
 
+    @classmethod
+    def get_shared_timeline_keys(cls, content, audiences):
+        if content.content_type != ContentType.CONTENT or not content.local:
+            return []
+        return [cls.get_shared_timeline_key(None, audience) for audience in audiences]
+
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT or not content.local:
+            return set()
+        return get_visible_user_ids(content, user_ids)
+
     @property
     def notify_key_extra(self):
         return self.user.id
@@ -369,6 +953,16 @@ class ProfileStreamBase(BaseStream):
     def get_target_streams(cls, content, user, acting_profile):
         return [cls(user=user, profile=acting_profile)]
 
+    @staticmethod
+    def get_profile_visible_user_ids(profile, user_ids):
+        """Filter a set of User ID's down to those the profile is visible to.
+
+        Mirrors logic in `Profile.visible_to_user`, for authenticated users.
+        """
+        if profile.visibility == Visibility.SELF:
+            return {profile.user_id} & user_ids
+        return set(user_ids)
+
     @property
     def key_extra(self):
         return str(self.profile.id)
@@ -384,6 +978,14 @@ class ProfileAllStream(ProfileStreamBase):
     def get_queryset(self, single_id=None):
         return Content.objects.profile(self.profile, self.user, single_id=single_id)
 
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT:
+            return set()
+        if content.author_id != acting_profile.id and not content.shares.filter(author=acting_profile).exists():
+            return set()
+        return get_visible_user_ids(content, cls.get_profile_visible_user_ids(acting_profile, user_ids))
+
 
 class ProfilePinnedStream(ProfileStreamBase):
     notify_for_shares = False
@@ -394,14 +996,39 @@ class ProfilePinnedStream(ProfileStreamBase):
     def get_queryset(self, single_id=None):
         return Content.objects.profile_pinned(self.profile, self.user, single_id=single_id)
 
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT or content.author_id != acting_profile.id \
+                or not content.pinned:
+            return set()
+        return get_visible_user_ids(content, cls.get_profile_visible_user_ids(acting_profile, user_ids))
+
 
 class PublicStream(BaseStream):
     notify_for_shares = False
+    shared_timeline = True
     stream_type = StreamType.PUBLIC
 
+    @property
+    def audience(self):
+        # Only public content, whoever the user is
+        return "anonymous"
+
     def get_queryset(self, single_id=None):
         return Content.objects.public(single_id=single_id)
 
+    @classmethod
+    def get_shared_timeline_keys(cls, content, audiences):
+        if content.content_type != ContentType.CONTENT or "anonymous" not in audiences:
+            return []
+        return [cls.get_shared_timeline_key(None, "anonymous")]
+
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT or content.visibility != Visibility.PUBLIC:
+            return set()
+        return set(user_ids)
+
     @property
     def notify_key_extra(self):
         return self.user.id
@@ -409,6 +1036,7 @@ class PublicStream(BaseStream):
 
 class TagStream(BaseStream):
     notify_for_shares = False
+    shared_timeline = True
     stream_type = StreamType.TAG
 
     def __init__(self, tag, **kwargs):
@@ -420,6 +1048,20 @@ class TagStream(BaseStream):
             raise AttributeError("TagStream is missing tag.")
         return Content.objects.tag(self.tag, self.user, single_id=single_id)
 
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT:
+            return set()
+        return get_visible_user_ids(content, user_ids)
+
+    @classmethod
+    def get_shared_timeline_keys(cls, content, audiences):
+        if content.content_type != ContentType.CONTENT:
+            return []
+        return [
+            cls.get_shared_timeline_key(str(tag.id), audience) for tag in content.tags.all() for audience in audiences
+        ]
+
     @classmethod
     def get_target_streams(cls, content, user, acting_profile):
         return [cls(user=user, tag=tag) for tag in content.tags.all()]
@@ -440,6 +1082,18 @@ class TagsStream(BaseStream):
     def get_queryset(self, single_id=None):
         return Content.objects.tags_followed_by_user(self.user, single_id=single_id)
 
+    @classmethod
+    def get_cacheable_user_ids(cls, content, user_ids, acting_profile):
+        if content.content_type != ContentType.CONTENT:
+            return set()
+        tag_ids = [tag.id for tag in content.tags.all()]
+        if not tag_ids:
+            return set()
+        follower_ids = Profile.objects.filter(
+            followed_tags__in=tag_ids, user__isnull=False,
+        ).values_list("user_id", flat=True).distinct()
+        return get_visible_user_ids(content, set(follower_ids) & user_ids)
+
     @property
     def notify_key_extra(self):
         return self.user.id
@@ -460,3 +1114,5 @@ NON_CACHED_STREAM_CLASSES = (
 )
 
 ALL_STREAMS = CACHED_STREAM_CLASSES + NON_CACHED_STREAM_CLASSES
+
+SHARED_TIMELINE_CLASSES = tuple(stream_cls for stream_cls in ALL_STREAMS if stream_cls.shared_timeline)
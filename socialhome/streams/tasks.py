@@ -1,31 +1,149 @@
+import logging
+import time
 from datetime import datetime, timedelta
+from typing import Dict, List
 
 from django.conf import settings
 from django.utils.timezone import now
 
 from socialhome.utils import get_redis_connection
 
+logger = logging.getLogger("socialhome")
 
-def delete_redis_keys(pattern: str, only_without_expiry: bool = True):
+
+# How many keys to check and delete per Redis pipeline in ``delete_redis_keys``
+DELETE_BATCH_SIZE = 500
+
+
+def throttle(ops: int, started: float, ops_per_second: int) -> None:
+    """Sleep long enough that ``ops`` operations since ``started`` stay within ``ops_per_second``."""
+    if not ops_per_second:
+        return
+    delay = ops / ops_per_second - (time.monotonic() - started)
+    if delay > 0:
+        time.sleep(delay)
+
+
+def delete_keys_batch(keys: List[bytes], only_without_expiry: bool) -> int:
+    """
+    Delete a batch of keys, checking their expiry in one pipeline first if needed.
+
+    :returns: Count of keys deleted
+    """
+    r = get_redis_connection()
+    if only_without_expiry:
+        with r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.ttl(key)
+            keys = [key for key, ttl in zip(keys, pipe.execute()) if ttl == -1]
+    if not keys:
+        return 0
+    return r.unlink(*keys)
+
+
+def delete_redis_keys(pattern: str, only_without_expiry: bool = True, ops_per_second: int = None) -> Dict[str, int]:
     """
     Delete any keys matching pattern. Defaults to only those without expiry.
+
+    Keys are gone through with ``SCAN`` and deleted with ``UNLINK`` in batches, so that Redis is not blocked.
+
+    :param ops_per_second: Most Redis operations per second to make. Defaults to
+        ``settings.SOCIALHOME_REDIS_MAINTENANCE_OPS``.
+    :returns: Counts of keys examined and deleted
     """
+    if ops_per_second is None:
+        ops_per_second = settings.SOCIALHOME_REDIS_MAINTENANCE_OPS
     r = get_redis_connection()
-    keys = r.keys(pattern)
-    to_delete = []
+    started = time.monotonic()
+    examined = deleted = 0
+    batch = []
+    for key in r.scan_iter(match=pattern, count=DELETE_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= DELETE_BATCH_SIZE:
+            deleted += delete_keys_batch(batch, only_without_expiry)
+            examined += len(batch)
+            batch = []
+            throttle(examined + deleted, started, ops_per_second)
+    if batch:
+        deleted += delete_keys_batch(batch, only_without_expiry)
+        examined += len(batch)
+    logger.info("delete_redis_keys - examined %s and deleted %s keys matching %s", examined, deleted, pattern)
+    return {"examined": examined, "deleted": deleted}
+
+
+def compact_stream_throughs(ops_per_second: int = None) -> Dict[str, int]:
+    """
+    Remove throughs that are the content itself from the stream throughs hashes.
+
+    Streams used to store a through for every item. Only throughs of shares are stored now, see
+    ``ADD_TO_STREAM_SCRIPT``.
+
+    :param ops_per_second: Most Redis operations per second to make. Defaults to
+        ``settings.SOCIALHOME_REDIS_MAINTENANCE_OPS``.
+    :returns: Counts of throughs hashes examined and throughs removed
+    """
+    if ops_per_second is None:
+        ops_per_second = settings.SOCIALHOME_REDIS_MAINTENANCE_OPS
+    r = get_redis_connection()
+    started = time.monotonic()
+    examined = removed = 0
+    keys = []
+    for key in r.scan_iter(match="sh:streams:[a-z0-9_\\-:]*:throughs", count=DELETE_BATCH_SIZE):
+        keys.append(key)
+        if len(keys) >= DELETE_BATCH_SIZE:
+            removed += compact_throughs_batch(keys)
+            examined += len(keys)
+            keys = []
+            throttle(examined * 2, started, ops_per_second)
+    if keys:
+        removed += compact_throughs_batch(keys)
+        examined += len(keys)
+    logger.info("compact_stream_throughs - examined %s throughs hashes and removed %s throughs", examined, removed)
+    return {"examined": examined, "removed": removed}
+
+
+def compact_throughs_batch(keys: List[bytes]) -> int:
+    r = get_redis_connection()
+    with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.hgetall(key)
+        throughs = pipe.execute()
+    removed = 0
+    with r.pipeline(transaction=False) as pipe:
+        for key, items in zip(keys, throughs):
+            delkeys = [content_id for content_id, through_id in items.items() if content_id == through_id]
+            if delkeys:
+                pipe.hdel(key, *delkeys)
+                removed += len(delkeys)
+        pipe.execute()
+    return removed
+
+
+# Checkpoint of ``groom_redis_precaches``, so that each run carries on where the previous one stopped
+PRECACHE_GROOM_KEY = "sh:precache:groom"
+# How many stream keys to groom per Redis pipeline
+GROOM_BATCH_SIZE = 500
+# How many stream keys to groom per scheduled run
+GROOM_SLICE_SIZE = 10000
 
-    for key in keys:
-        if only_without_expiry:
-            delete = r.ttl(key) == -1
-        else:
-            delete = True
-        if delete:
-            to_delete.append(key)
-        if len(to_delete) > 1000:
-            r.delete(*to_delete)
 
-    if to_delete:
-        r.delete(*to_delete)
+def get_user_activities(user_activities, user_ids):
+    """
+    Fetch whether users are active for precaching, with one query for the users not fetched yet.
+
+    Users that don't exist anymore are stored as ``None``.
+    """
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.users.models import User
+    missing = set(user_ids) - set(user_activities)
+    if not missing:
+        return
+    since = now() - timedelta(days=settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS)
+    users = User.objects.filter(id__in=missing).values_list("id", "last_login", "date_joined")
+    for user_id, last_login, date_joined in users:
+        user_activities[user_id] = (last_login or date_joined) >= since
+    for user_id in missing:
+        user_activities.setdefault(user_id, None)
 
 
 def get_precache_trim_size(user_activities, key):
@@ -36,27 +154,15 @@ def get_precache_trim_size(user_activities, key):
     """
     # Local imports since we load tasks before apps are loaded fully
     from socialhome.streams.streams import BaseStream
-    from socialhome.users.models import User
     user_id = BaseStream.get_key_user_id(key)
     if not user_id:
         # Anonymous, trim as inactive
         return settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE
-    user_active = user_activities.get(user_id)
-    if user_active is not None:
-        # Trim according to activity
-        return (
-            settings.SOCIALHOME_STREAMS_PRECACHE_SIZE
-            if user_active else settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE
-        )
-    # Get user
-    try:
-        user = User.objects.get(id=user_id)
-    except User.DoesNotExist:
-        # Trim all
+    get_user_activities(user_activities, [user_id])
+    user_active = user_activities[user_id]
+    if user_active is None:
+        # User doesn't exist anymore, trim all
         return 0
-    check_time = user.last_login if user.last_login else user.date_joined
-    user_active = check_time >= now() - timedelta(days=settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS)
-    user_activities[user_id] = user_active
     # Trim according to activity
     return (
         settings.SOCIALHOME_STREAMS_PRECACHE_SIZE
@@ -64,31 +170,94 @@ def get_precache_trim_size(user_activities, key):
     )
 
 
-def groom_redis_precaches():
-    """Groom the Redis data for streams precaching."""
+def register_precache_keys():
+    """
+    Add stream keys written before the precache keys registry existed to the registry.
+
+    Uses ``SCAN`` so Redis is not blocked, and only runs once.
+    """
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.streams.streams import PRECACHE_KEYS_KEY
+    r = get_redis_connection()
+    score = int(time.time())
+    keys = []
+    for key in r.scan_iter(match="sh:streams:[a-z0-9_\\-:]*", count=GROOM_BATCH_SIZE):
+        if not key.endswith(b":throughs"):
+            keys.append(key)
+        if len(keys) >= GROOM_BATCH_SIZE:
+            r.zadd(PRECACHE_KEYS_KEY, {key: score for key in keys})
+            keys = []
+    if keys:
+        r.zadd(PRECACHE_KEYS_KEY, {key: score for key in keys})
+    r.hset(PRECACHE_GROOM_KEY, "registered", 1)
+
+
+def groom_precache_keys(keys, user_activities):
+    """
+    Trim a batch of stream keys and remove the obsolete throughs, with a few pipelined round trips.
+
+    :param keys: List of stream keys
+    :param user_activities: Dict of user activities, see ``get_user_activities``
+    """
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.streams.streams import BaseStream, PRECACHE_KEYS_KEY
     r = get_redis_connection()
+    get_user_activities(user_activities, filter(None, (BaseStream.get_key_user_id(key) for key in keys)))
+    with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            trim_size = get_precache_trim_size(user_activities, key)
+            # Make the ordered set X items length at most
+            pipe.zremrangebyrank(key, 0, -trim_size-1)
+            pipe.zrange(key, 0, -1)
+            pipe.hkeys(BaseStream.get_throughs_key(key))
+        results = pipe.execute()
+    with r.pipeline(transaction=False) as pipe:
+        for index, key in enumerate(keys):
+            content_ids, through_ids = set(results[index*3+1]), results[index*3+2]
+            throughs_key = BaseStream.get_throughs_key(key)
+            if not content_ids:
+                # Everything was removed or the key has expired
+                pipe.delete(throughs_key)
+                pipe.zrem(PRECACHE_KEYS_KEY, key)
+                continue
+            # Remove now obsolete throughs ID's from the throughs hash
+            delkeys = [through_id for through_id in through_ids if through_id not in content_ids]
+            if delkeys:
+                pipe.hdel(throughs_key, *delkeys)
+        pipe.execute()
+
+
+def groom_redis_precaches(max_keys: int = None) -> int:
+    """
+    Groom the Redis data for streams precaching.
+
+    Goes through the registry of precached stream keys in batches. Progress is stored, so that a run can stop after
+    ``max_keys`` keys and the next run continues from there.
+
+    :param max_keys: Most stream keys to groom in this run. By default goes through all of them.
+    :returns: Count of stream keys groomed
+    """
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.streams.streams import PRECACHE_KEYS_KEY
+    r = get_redis_connection()
+    if not r.hexists(PRECACHE_GROOM_KEY, "registered"):
+        register_precache_keys()
+    # Streams expire when they have not been written to for a while
+    r.zremrangebyscore(PRECACHE_KEYS_KEY, "-inf", time.time() - settings.REDIS_DEFAULT_EXPIRY)
     user_activities = {}
-    keys = r.keys("sh:streams:[a-z0-9_\-:]*")
-    for key in keys:
-        decoded_key = key.decode("utf-8")
-        if decoded_key.endswith(':throughs'):
-            # Skip throughs, we handle those separately below
-            continue
-        trim_size = get_precache_trim_size(user_activities, decoded_key)
-        # Make the ordered set X items length at most
-        r.zremrangebyrank(key, 0, -trim_size-1)
-        # Remove now obsolete throughs ID's from the throughs hash
-        throughs_key = "%s:throughs" % decoded_key
-        if not r.zcount(key, '-inf', '+inf'):
-            # No need to loop, we've removed everything
-            r.delete(throughs_key)
-            continue
-        delkeys = []
-        for content_id, _through_id in r.hgetall(throughs_key).items():
-            if r.zrank(key, int(content_id)) is None:
-                delkeys.append(int(content_id))
-        if delkeys:
-            r.hdel(throughs_key, *delkeys)
+    cursor = int(r.hget(PRECACHE_GROOM_KEY, "cursor") or 0)
+    groomed = 0
+    while True:
+        cursor, items = r.zscan(PRECACHE_KEYS_KEY, cursor, count=GROOM_BATCH_SIZE)
+        keys = [key.decode("utf-8") for key, _score in items]
+        if keys:
+            groom_precache_keys(keys, user_activities)
+            groomed += len(keys)
+        if not cursor or (max_keys and groomed >= max_keys):
+            break
+    r.hset(PRECACHE_GROOM_KEY, "cursor", cursor)
+    logger.debug("groom_redis_precaches - groomed %s stream keys", groomed)
+    return groomed
 
 
 def streams_tasks(scheduler):
@@ -100,10 +269,11 @@ def streams_tasks(scheduler):
         interval=60*60*24,  # every 24 hours
         timeout=60*60*2,  # 2 hours
     )
-    # Groom redis precaches
+    # Groom redis precaches, a slice at a time
     scheduler.schedule(
         scheduled_time=datetime.utcnow(),
         func=groom_redis_precaches,
-        interval=60*60*3,  # every 3 hours
-        timeout=60*60*2,  # 2 hours
+        args=[GROOM_SLICE_SIZE],
+        interval=60*10,  # every 10 minutes
+        timeout=60*30,  # 30 minutes
     )
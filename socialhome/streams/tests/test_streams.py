@@ -1,45 +1,85 @@
+import datetime
+import logging
+import os
 import random
-from unittest.mock import patch, Mock, call
+import time
+from unittest import skipUnless
+from unittest.mock import patch, Mock
 
 from django.contrib.auth.models import AnonymousUser
-from django.db.models import Max
+from django.db import connection
+from django.db.models import Max, Case, When
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 from freezegun import freeze_time
 
 from socialhome.content.models import Content, Tag
 from socialhome.content.tests.factories import (
     ContentFactory, PublicContentFactory, SiteContentFactory, SelfContentFactory, LimitedContentFactory)
+from socialhome.enums import Visibility
 from socialhome.streams.enums import StreamType
 from socialhome.streams.streams import (
-    BaseStream, FollowedStream, PublicStream, TagStream, add_to_redis, add_to_stream_for_users,
-    update_streams_with_content, check_and_add_to_keys, ProfileAllStream, ProfilePinnedStream, LocalStream, TagsStream)
+    BaseStream, FollowedStream, PublicStream, StreamCursor, TagStream, add_to_redis, add_to_stream_for_users,
+    update_streams_with_content, check_and_add_to_keys, check_and_add_to_keys_for_users, ProfileAllStream,
+    ProfilePinnedStream, LocalStream, TagsStream, PRECACHE_KEYS_KEY, add_to_shared_timelines,
+    update_shared_timelines, is_fan_out_on_read, add_to_author_timeline, get_author_timeline_key, ALL_STREAMS,
+    get_precache_users_qs)
 from socialhome.tests.utils import SocialhomeTestCase
-from socialhome.users.tests.factories import UserFactory, PublicUserFactory
+from socialhome.users.tests.factories import UserFactory, PublicUserFactory, PublicProfileFactory
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
 
 
-@patch("socialhome.streams.streams.get_redis_connection")
 @patch("socialhome.streams.streams.time.time", return_value=123.123)
 class TestAddToRedis(SocialhomeTestCase):
-    def test_adds_each_key(self, mock_time, mock_get):
-        mock_hset = Mock()
-        mock_zadd = Mock()
-        mock_get.return_value = Mock(hset=mock_hset, zadd=mock_zadd, zrank=Mock(return_value=None))
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.r.delete("spam", "spam:throughs", "eggs", "eggs:throughs")
+
+    def test_adds_each_key(self, mock_time):
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=1), ["spam", "eggs"]), 2)
+        self.assertEqual(self.r.zrange("spam", 0, -1, withscores=True), [(b"2", 123)])
+        self.assertEqual(self.r.zrange("eggs", 0, -1, withscores=True), [(b"2", 123)])
+        self.assertEqual(self.r.hgetall("spam:throughs"), {b"2": b"1"})
+        self.assertEqual(self.r.hgetall("eggs:throughs"), {b"2": b"1"})
+        self.assertTrue(self.r.ttl("spam") > 0)
+        self.assertTrue(self.r.ttl("spam:throughs") > 0)
+
+    def test_registers_keys_for_grooming(self, mock_time):
         add_to_redis(Mock(id=2), Mock(id=1), ["spam", "eggs"])
-        calls = [
-            call("spam", {2: 123}),
-            call("eggs", {2: 123}),
-        ]
-        self.assertEqual(mock_zadd.call_args_list, calls)
-        calls = [
-            call("spam:throughs", 2, 1),
-            call("eggs:throughs", 2, 1),
-        ]
-        self.assertEqual(mock_hset.call_args_list, calls)
-
-    def test_returns_on_no_keys(self, mock_time, mock_get):
-        mock_zadd = Mock()
-        mock_get.return_value = Mock(zadd=mock_zadd, zrank=Mock(return_value=None))
-        add_to_redis(Mock(), Mock(), [])
+        self.assertEqual(self.r.zrange(PRECACHE_KEYS_KEY, 0, -1, withscores=True), [(b"eggs", 123), (b"spam", 123)])
+
+    def test_does_not_add_twice(self, mock_time):
+        add_to_redis(Mock(id=2), Mock(id=2), ["spam"])
+        mock_time.return_value = 456.456
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=2), ["spam", "eggs"]), 1)
+        self.assertEqual(self.r.zrange("spam", 0, -1, withscores=True), [(b"2", 123)])
+        self.assertEqual(self.r.zrange("eggs", 0, -1, withscores=True), [(b"2", 456)])
+
+    def test_does_not_store_through_of_content_itself(self, mock_time):
+        add_to_redis(Mock(id=2), Mock(id=2), ["spam"])
+        self.assertEqual(self.r.zrange("spam", 0, -1), [b"2"])
+        self.assertFalse(self.r.exists("spam:throughs"))
+
+    def test_updates_through_if_already_added(self, mock_time):
+        add_to_redis(Mock(id=2), Mock(id=2), ["spam"])
+        add_to_redis(Mock(id=2), Mock(id=3), ["spam"])
+        self.assertEqual(self.r.zrange("spam", 0, -1, withscores=True), [(b"2", 123)])
+        self.assertEqual(self.r.hgetall("spam:throughs"), {b"2": b"3"})
+        self.assertTrue(self.r.ttl("spam:throughs") > 0)
+
+    @patch("socialhome.streams.streams.REDIS_BATCH_SIZE", new=1)
+    def test_writes_in_batches(self, mock_time):
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=1), ["spam", "eggs"]), 2)
+        self.assertEqual(self.r.zrange("eggs", 0, -1), [b"2"])
+
+    @patch("socialhome.streams.streams.get_redis_connection")
+    def test_returns_on_no_keys(self, mock_get, mock_time):
+        self.assertEqual(add_to_redis(Mock(), Mock(), []), 0)
+        self.assertFalse(mock_get.called)
 
 
 class TestAddToStreamForUsers(SocialhomeTestCase):
@@ -58,23 +98,23 @@ class TestAddToStreamForUsers(SocialhomeTestCase):
         stream = FollowedStream(user=self.user)
         mock_add.assert_called_once_with(self.content, self.content, [stream.key])
 
-    @patch("socialhome.streams.streams.check_and_add_to_keys", autospec=True)
-    def test_calls_check_and_add_to_keys_for_each_user(self, mock_check):
+    @patch("socialhome.streams.streams.check_and_add_to_keys_for_users", autospec=True)
+    def test_calls_check_and_add_to_keys_for_users(self, mock_check):
         add_to_stream_for_users(self.content.id, self.content.id, "FollowedStream", self.content.author.id)
         mock_check.assert_called_once_with(
-            FollowedStream, self.user, self.content, [], self.content.author, set(), False,
+            FollowedStream, [self.user], self.content, [], self.content.author, set(), False,
         )
 
-    @patch("socialhome.streams.streams.check_and_add_to_keys", autospec=True)
+    @patch("socialhome.streams.streams.check_and_add_to_keys_for_users", autospec=True)
     @override_settings(SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS=2)
     @freeze_time('2018-02-01')
-    def test_calls_check_and_add_to_keys_for_each_user__skipping_inactives(self, mock_check):
+    def test_calls_check_and_add_to_keys_for_users__skipping_inactives(self, mock_check):
         with freeze_time('2018-01-25'):
             PublicUserFactory()
         add_to_stream_for_users(self.content.id, self.content.id, "ProfileAllStream", self.content.author.id)
-        # Would be called twice if inactives were not filtered out
+        # Would contain two users if inactives were not filtered out
         mock_check.assert_called_once_with(
-            ProfileAllStream, self.user, self.content, [], self.content.author, set(), False,
+            ProfileAllStream, [self.user], self.content, [], self.content.author, set(), False,
         )
 
     @patch("socialhome.streams.streams.Content.objects.filter")
@@ -132,6 +172,84 @@ class TestCheckAndAddToKeys(SocialhomeTestCase):
         )
 
 
+class TestCheckAndAddToKeysForUsers(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_local_and_remote_user()
+        cls.user2 = PublicUserFactory()
+        cls.user3 = PublicUserFactory()
+        cls.profile.following.add(cls.remote_profile)
+        cls.user2.profile.following.add(cls.remote_profile)
+        cls.remote_content = PublicContentFactory(author=cls.remote_profile, text="#spam")
+        cls.limited_content = LimitedContentFactory(author=cls.remote_profile)
+        cls.limited_content.limited_visibilities.add(cls.user2.profile)
+        cls.user3.profile.followed_tags.add(Tag.objects.get(name="spam"))
+        cls.users = [cls.user, cls.user2, cls.user3]
+
+    def test_adds_for_eligible_users(self):
+        keys = []
+        check_and_add_to_keys_for_users(
+            FollowedStream, self.users, self.remote_content, keys, self.remote_profile, set(), False,
+        )
+        self.assertEqual(
+            set(keys),
+            {"sh:streams:followed:%s" % self.user.id, "sh:streams:followed:%s" % self.user2.id},
+        )
+        keys = []
+        check_and_add_to_keys_for_users(
+            TagsStream, self.users, self.remote_content, keys, self.remote_profile, set(), False,
+        )
+        self.assertEqual(keys, ["sh:streams:tags:%s" % self.user3.id])
+
+    def test_adds_for_limited_content_recipients_only(self):
+        keys = []
+        check_and_add_to_keys_for_users(
+            FollowedStream, self.users, self.limited_content, keys, self.remote_profile, set(), False,
+        )
+        self.assertEqual(keys, ["sh:streams:followed:%s" % self.user2.id])
+
+    def test_matches_check_and_add_to_keys(self):
+        for stream_cls in (FollowedStream, ProfileAllStream, TagsStream):
+            for content in (self.remote_content, self.limited_content):
+                bulk_keys, keys = [], []
+                check_and_add_to_keys_for_users(
+                    stream_cls, self.users, content, bulk_keys, self.remote_profile, set(), False,
+                )
+                for user in self.users:
+                    check_and_add_to_keys(stream_cls, user, content, keys, self.remote_profile, set(), False)
+                self.assertEqual(set(bulk_keys), set(keys))
+
+    def test_query_count_does_not_depend_on_user_count(self):
+        with self.assertNumQueries(2):
+            check_and_add_to_keys_for_users(
+                FollowedStream, self.users, self.remote_content, [], self.remote_profile, set(), False,
+            )
+        users = self.users + [PublicUserFactory() for _i in range(5)]
+        with self.assertNumQueries(2):
+            check_and_add_to_keys_for_users(
+                FollowedStream, users, self.remote_content, [], self.remote_profile, set(), False,
+            )
+
+    @patch("socialhome.streams.streams.filter_recently_active_user_ids")
+    def test_notify_keys_only_for_recently_active_users(self, mock_active):
+        mock_active.return_value = {self.user2.id}
+        notify_keys = set()
+        check_and_add_to_keys_for_users(
+            FollowedStream, self.users, self.remote_content, [], self.remote_profile, notify_keys, False,
+        )
+        self.assertEqual(notify_keys, {"streams_followed__%s" % self.user2.id})
+
+    @patch("socialhome.streams.streams.filter_recently_active_user_ids", return_value=set())
+    def test_non_cached_streams_skip_inactive_users(self, mock_active):
+        keys = []
+        with self.assertNumQueries(0):
+            check_and_add_to_keys_for_users(
+                PublicStream, self.users, self.remote_content, keys, self.remote_profile, set(), False,
+            )
+        self.assertEqual(keys, [])
+
+
 class TestUpdateStreamsWithContent(SocialhomeTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -151,6 +269,296 @@ class TestUpdateStreamsWithContent(SocialhomeTestCase):
         mock_add.assert_called_once_with(self.content, self.content, ["sh:streams:public:%s" % self.user.id])
 
 
+class TestSharedTimelines(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory()
+        cls.public_content = PublicContentFactory(author=cls.user.profile, text="#foobar")
+        cls.site_content = SiteContentFactory(author=cls.user.profile, text="#foobar")
+        cls.limited_content = LimitedContentFactory(author=cls.user.profile, text="#foobar")
+        cls.tag = Tag.objects.get(name="foobar")
+        # A minute apart, oldest first
+        for minutes, content in enumerate((cls.public_content, cls.site_content, cls.limited_content)):
+            content.created = now() - datetime.timedelta(minutes=10 - minutes)
+            Content.objects.filter(id=content.id).update(created=content.created)
+
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+
+    def test_add_to_shared_timelines(self):
+        for content in (self.public_content, self.site_content, self.limited_content):
+            add_to_shared_timelines(content)
+        timelines = {
+            key.decode("utf-8"): {int(id) for id in self.r.zrange(key, 0, -1)} for key in self.r.keys("sh:timelines:*")
+        }
+        self.assertEqual(timelines, {
+            "sh:timelines:public:anonymous": {self.public_content.id},
+            "sh:timelines:local:anonymous": {self.public_content.id},
+            "sh:timelines:local:site": {self.public_content.id, self.site_content.id},
+            "sh:timelines:tag:%s:anonymous" % self.tag.id: {self.public_content.id},
+            "sh:timelines:tag:%s:site" % self.tag.id: {self.public_content.id, self.site_content.id},
+        })
+        self.assertEqual(
+            self.r.zscore("sh:timelines:public:anonymous", self.public_content.id),
+            int(self.public_content.created.timestamp()),
+        )
+
+    @override_settings(SOCIALHOME_STREAMS_SHARED_TIMELINE_SIZE=1)
+    def test_add_to_shared_timelines__trims(self):
+        add_to_shared_timelines(self.public_content)
+        add_to_shared_timelines(self.site_content)
+        self.assertEqual(self.r.zrange("sh:timelines:local:site", 0, -1), [str(self.site_content.id).encode("utf-8")])
+
+    def test_update_shared_timelines__visibility_changed(self):
+        add_to_shared_timelines(self.public_content)
+        self.public_content.visibility = Visibility.LIMITED
+        update_shared_timelines(self.public_content)
+        self.assertEqual(self.r.keys("sh:timelines:*"), [])
+
+    def test_stream_is_read_from_shared_timeline(self):
+        stream = PublicStream(user=AnonymousUser())
+        stream.paginate_by = 1
+        # Filled from the database on first read
+        self.assertEqual(
+            stream.get_content_ids(), ([self.public_content.id], {self.public_content.id: self.public_content.id}),
+        )
+        stream = PublicStream(user=self.user)
+        stream.paginate_by = 1
+        with self.assertNumQueries(0):
+            self.assertEqual(stream.get_content_ids()[0], [self.public_content.id])
+        self.assertEqual(stream.next_cursor.id, self.public_content.id)
+
+    def test_content_only_visible_to_user_is_merged(self):
+        stream = LocalStream(user=self.user)
+        stream.paginate_by = 2
+        ids, _throughs = stream.get_content_ids()
+        self.assertEqual(ids, [self.limited_content.id, self.site_content.id])
+        stream.cursor = stream.next_cursor
+        ids, _throughs = stream.get_content_ids()
+        self.assertEqual(ids, [self.public_content.id])
+        # Not for other users
+        stream = LocalStream(user=UserFactory())
+        self.assertEqual(stream.get_content_ids()[0], [self.site_content.id, self.public_content.id])
+
+    def test_content_no_longer_visible_is_not_returned(self):
+        stream = LocalStream(user=AnonymousUser())
+        self.assertEqual(stream.get_content()[0], [self.public_content])
+        Content.objects.filter(id=self.public_content.id).update(visibility=Visibility.SELF)
+        self.assertEqual(stream.get_content()[0], [])
+
+
+@override_settings(SOCIALHOME_STREAMS_FAN_OUT_ON_READ_FOLLOWERS=2)
+class TestFanOutOnRead(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory()
+        cls.other_user = UserFactory()
+        cls.author = PublicProfileFactory()
+        cls.author.followers.add(cls.user.profile, cls.other_user.profile)
+        cls.content = PublicContentFactory(author=cls.author)
+        cls.limited_content = LimitedContentFactory(author=cls.author)
+
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.r.delete(FollowedStream(user=self.user).key, FollowedStream(user=self.other_user).key)
+
+    def test_is_fan_out_on_read(self):
+        self.assertTrue(is_fan_out_on_read(self.content, self.author))
+        self.assertFalse(is_fan_out_on_read(self.limited_content, self.author))
+        with override_settings(SOCIALHOME_STREAMS_FAN_OUT_ON_READ_FOLLOWERS=3):
+            self.assertFalse(is_fan_out_on_read(self.content, self.author))
+        with override_settings(SOCIALHOME_STREAMS_FAN_OUT_ON_READ_FOLLOWERS=0):
+            self.assertFalse(is_fan_out_on_read(self.content, self.author))
+
+    @patch("socialhome.streams.streams.add_to_redis")
+    def test_add_to_stream_for_users__adds_to_author_timeline(self, mock_add):
+        add_to_stream_for_users(self.content.id, self.content.id, "FollowedStream", self.author.id)
+        self.assertFalse(mock_add.called)
+        self.assertEqual(self.r.zrange(get_author_timeline_key(self.author.id), 0, -1), [str(self.content.id).encode()])
+        # Other streams are added to as usual
+        add_to_stream_for_users(self.content.id, self.content.id, "ProfileAllStream", self.author.id)
+        self.assertTrue(mock_add.called)
+
+    @override_settings(SOCIALHOME_STREAMS_PRECACHE_SIZE=2)
+    @patch("socialhome.streams.streams.time.time")
+    def test_add_to_author_timeline__trims_with_throughs(self, mock_time):
+        key = get_author_timeline_key(self.author.id)
+        for score, id in ((100, 1), (200, 2), (300, 3)):
+            mock_time.return_value = score
+            add_to_author_timeline(Mock(id=id), Mock(id=id + 10), self.author)
+        self.assertEqual(self.r.zrange(key, 0, -1), [b"2", b"3"])
+        self.assertEqual(self.r.hgetall(BaseStream.get_throughs_key(key)), {b"2": b"12", b"3": b"13"})
+
+    @patch("socialhome.streams.streams.time.time")
+    def test_followed_stream_merges_author_timelines(self, mock_time):
+        stream = FollowedStream(user=self.user)
+        self.r.zadd(stream.key, {"1": 100, "2": 300, "3": 500})
+        for score, id in ((200, 4), (400, 5), (500, 3)):
+            mock_time.return_value = score
+            add_to_author_timeline(Mock(id=id), Mock(id=id + 10), self.author)
+        # Not followed
+        add_to_author_timeline(Mock(id=6), Mock(id=6), PublicProfileFactory())
+        mock_time.return_value = 500
+        stream.paginate_by = 3
+        ids, throughs = stream.get_cached_range_by_cursor()
+        self.assertEqual(ids, [3, 5, 2])
+        self.assertEqual(throughs, {3: 3, 5: 15, 2: 2})
+        stream.cursor = stream.next_cursor
+        ids, throughs = stream.get_cached_range_by_cursor()
+        self.assertEqual(ids, [4, 1])
+        self.assertEqual(throughs, {4: 14, 1: 1})
+
+    @patch("socialhome.streams.streams.time.time")
+    def test_followed_stream_merges_author_timelines__last_id(self, mock_time):
+        self.r.zadd(FollowedStream(user=self.user).key, {"1": 100, "2": 300, "3": 500})
+        for score, id in ((200, 4), (400, 5)):
+            mock_time.return_value = score
+            add_to_author_timeline(Mock(id=id), Mock(id=id + 10), self.author)
+        mock_time.return_value = 500
+        stream = FollowedStream(user=self.user, last_id=3)
+        stream.paginate_by = 2
+        self.assertEqual(stream.get_cached_content_ids(), ([5, 2], {5: 15, 2: 2}))
+        stream = FollowedStream(user=self.user, last_id=5)
+        stream.paginate_by = 2
+        self.assertEqual(stream.get_cached_content_ids(), ([2, 4], {2: 2, 4: 14}))
+        stream = FollowedStream(user=self.user, last_id=999)
+        self.assertEqual(stream.get_cached_content_ids(), ([], {}))
+
+    def test_followed_stream_without_author_timelines(self):
+        stream = FollowedStream(user=self.user)
+        self.r.zadd(stream.key, {"1": 100})
+        with self.assertNumQueries(0):
+            self.assertEqual(stream.get_cached_range_by_cursor(), ([1], {1: 1}))
+
+
+class TestStreamCursor(SocialhomeTestCase):
+    def test_encode_decode(self):
+        cursor = StreamCursor(True, 1234, 5)
+        self.assertEqual(StreamCursor.decode(cursor.encode()), cursor)
+        cursor = StreamCursor(False, "2018-01-01T00:00:00+00:00", 5)
+        self.assertEqual(StreamCursor.decode(cursor.encode()), cursor)
+
+        cursor = StreamCursor(False, 3, 5)
+        self.assertEqual(StreamCursor.decode(cursor.encode()), cursor)
+
+    def test_decode__raises_on_invalid_cursor(self):
+        for value in ("foobar", "", "WzFd", "eyJmb28iOiAiYmFyIn0="):
+            with self.assertRaises(ValueError):
+                StreamCursor.decode(value)
+
+    def test_decode__raises_on_invalid_values(self):
+        for cached, value, id in (
+            (True, "2018-01-01T00:00:00+00:00", 5),
+            (True, 1.5, 5),
+            (True, True, 5),
+            (False, "foobar", 5),
+            (False, "2018-13-01T00:00:00+00:00", 5),
+            (False, None, 5),
+            (True, 1234, "5"),
+            (True, 1234, False),
+        ):
+            with self.assertRaises(ValueError):
+                StreamCursor.decode(StreamCursor(cached, value, id).encode())
+
+
+@skipUnless(os.environ.get("SOCIALHOME_BENCHMARKS"), "Set SOCIALHOME_BENCHMARKS=1 to run benchmarks")
+class TestGetContentOrderingBenchmark(SocialhomeTestCase):
+    """Compare ordering the stream page with a Case/When expression to ordering it in Python."""
+    page_sizes = (15, 100, 500)
+    rounds = 20
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        content = PublicContentFactory()
+        PublicContentFactory.create_batch(max(cls.page_sizes) - 1, author=content.author)
+        cls.ids = list(Content.objects.values_list("id", flat=True))
+
+    @staticmethod
+    def get_content_case_when(ids):
+        preserved = Case(*[When(id=id, then=pos) for pos, id in enumerate(ids)])
+        qs = (
+            Content.objects.filter(id__in=ids)
+            .select_related("author__user", "share_of")
+            .prefetch_related("tags")
+            .order_by(preserved)
+        )
+        return list(qs)
+
+    def timeit(self, func, ids):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            for _i in range(self.rounds):
+                result = func(ids)
+            duration = (time.perf_counter() - start) / self.rounds
+        return result, duration, len(context.captured_queries) // self.rounds
+
+    def test_benchmark(self):
+        for page_size in self.page_sizes:
+            ids = random.sample(self.ids, page_size)
+            case_when, case_when_duration, case_when_queries = self.timeit(self.get_content_case_when, ids)
+            python, python_duration, python_queries = self.timeit(BaseStream.get_content_by_ids, ids)
+            self.assertEqual([item.id for item in case_when], ids)
+            self.assertEqual([item.id for item in python], ids)
+            self.assertEqual(case_when_queries, python_queries)
+            logger.info(
+                "Page size %s: Case/When %.2f ms, in Python %.2f ms (%s queries)", page_size,
+                case_when_duration * 1000, python_duration * 1000, python_queries,
+            )
+
+
+@skipUnless(os.environ.get("SOCIALHOME_BENCHMARKS"), "Set SOCIALHOME_BENCHMARKS=1 to run benchmarks")
+class TestStreamFanOutBenchmark(SocialhomeTestCase):
+    """Compare the per user stream checks to the batched fan-out for each stream class."""
+    users = 1000
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.author = PublicProfileFactory()
+        users = UserFactory.create_batch(cls.users)
+        cls.author.followers.add(*[user.profile for user in users])
+        content = PublicContentFactory(author=cls.author, text="Benchmark #benchmark")
+        tag = content.tags.get()
+        for user in users[::2]:
+            user.profile.followed_tags.add(tag)
+        # Fetch like the stream jobs do
+        cls.content = Content.objects.select_related("author").prefetch_related("tags").get(id=content.id)
+
+    def timeit(self, func):
+        keys = []
+        users = list(get_precache_users_qs(self.author))
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            func(users, keys)
+            duration = time.perf_counter() - start
+        return keys, duration, len(context.captured_queries)
+
+    def test_benchmark(self):
+        for stream_cls in ALL_STREAMS:
+            per_user_keys, per_user_duration, per_user_queries = self.timeit(
+                lambda users, keys: [
+                    check_and_add_to_keys(stream_cls, user, self.content, keys, self.author, set(), False)
+                    for user in users
+                ],
+            )
+            batched_keys, batched_duration, batched_queries = self.timeit(
+                lambda users, keys: check_and_add_to_keys_for_users(
+                    stream_cls, users, self.content, keys, self.author, set(), False,
+                ),
+            )
+            self.assertEqual(set(batched_keys), set(per_user_keys))
+            logger.info(
+                "%s: per user %s queries in %.1f ms, batched %s queries in %.1f ms, %s keys", stream_cls.__name__,
+                per_user_queries, per_user_duration * 1000, batched_queries, batched_duration * 1000,
+                len(batched_keys),
+            )
+
+
 @patch("socialhome.streams.streams.BaseStream.get_queryset", return_value=Content.objects.all())
 class TestBaseStream(SocialhomeTestCase):
     @classmethod
@@ -167,23 +575,46 @@ class TestBaseStream(SocialhomeTestCase):
     def test___str__(self, mock_queryset):
         self.assertEqual(str(self.stream), "BaseStream (%s)" % str(self.user))
 
-    @patch("socialhome.streams.streams.get_redis_connection")
-    def test_get_cached_content_ids__calls(self, mock_get, mock_queryset):
-        mock_redis = Mock(zrevrange=Mock(return_value=[]))
-        mock_get.return_value = mock_redis
+    def test_get_cached_content_ids__calls(self, mock_queryset):
         self.stream.stream_type = StreamType.PUBLIC
-        self.stream.get_cached_content_ids()
-        # Skips zrevrank if not last_id
-        self.assertFalse(mock_redis.zrevrank.called)
-        # Calls zrevrange with correct parameters
-        mock_redis.zrevrange.assert_called_once_with(self.stream.key, 0, self.stream.paginate_by)
-        mock_redis.reset_mock()
-        # Calls zrevrank with last_id
+        # Uses cursor based range if no last_id
+        with patch.object(self.stream, "get_cached_range_by_cursor", return_value=([], {})) as mock_range:
+            self.stream.get_cached_content_ids()
+            mock_range.assert_called_once_with()
+        # Looks up the index of last_id
         self.stream.last_id = self.content2.id
-        mock_redis.zrevrank.return_value = 3
-        self.stream.get_cached_content_ids()
-        mock_redis.zrevrank.assert_called_once_with(self.stream.key, self.content2.id)
-        mock_redis.zrevrange.assert_called_once_with(self.stream.key, 4, 4 + self.stream.paginate_by)
+        with patch.object(self.stream, "get_cached_range", return_value=([], {})) as mock_range, \
+                patch.object(get_redis_connection(), "zrevrank", return_value=3) as mock_zrevrank:
+            self.stream.get_cached_content_ids()
+        mock_zrevrank.assert_called_once_with(self.stream.key, self.content2.id)
+        mock_range.assert_called_once_with(4)
+
+    def test_get_cached_range_by_cursor(self, mock_queryset):
+        self.stream.stream_type = StreamType.PUBLIC
+        self.stream.paginate_by = 2
+        r = get_redis_connection()
+        r.delete(self.stream.key, self.stream.get_throughs_key(self.stream.key))
+        # Same score for a few, which need to be ordered by member
+        r.zadd(self.stream.key, {"10": 100, "11": 100, "9": 100, "5": 50, "4": 40})
+        r.hset(self.stream.get_throughs_key(self.stream.key), mapping={"10": 10, "11": 12, "9": 9, "5": 5, "4": 4})
+        ids, throughs = self.stream.get_cached_range_by_cursor()
+        self.assertEqual(ids, [9, 11])
+        self.assertEqual(throughs, {9: 9, 11: 12})
+        self.assertEqual(self.stream.next_cursor, StreamCursor(True, 100, 11))
+        # New content arriving between page loads doesn't shift pages
+        r.zadd(self.stream.key, {"12": 200})
+        self.stream.cursor = self.stream.next_cursor
+        ids, throughs = self.stream.get_cached_range_by_cursor()
+        self.assertEqual(ids, [10, 5])
+        self.assertEqual(self.stream.next_cursor, StreamCursor(True, 50, 5))
+        self.stream.cursor = self.stream.next_cursor
+        ids, throughs = self.stream.get_cached_range_by_cursor()
+        self.assertEqual(ids, [4])
+        self.stream.cursor = self.stream.next_cursor
+        self.assertEqual(self.stream.get_cached_range_by_cursor(), ([], {}))
+        # Database cursor is past the cache
+        self.stream.cursor = StreamCursor(False, "2018-01-01T00:00:00+00:00", 4)
+        self.assertEqual(self.stream.get_cached_range_by_cursor(), ([], {}))
 
     @patch("socialhome.streams.streams.get_redis_connection")
     def test_get_cached_content_ids__returns_empty_list_if_outside_cached_ids(self, mock_get, mock_queryset):
@@ -194,25 +625,24 @@ class TestBaseStream(SocialhomeTestCase):
         self.assertEqual(self.stream.get_cached_content_ids(), ([], {}))
         self.assertFalse(mock_redis.zrevrange.called)
 
-    @patch("socialhome.streams.streams.get_redis_connection")
-    def test_get_cached_range(self, mock_get, mock_queryset):
+    def test_get_cached_range(self, mock_queryset):
         self.stream.stream_type = StreamType.PUBLIC
-        mock_zrevrange = Mock(return_value=[str(self.content2.id), str(self.content1.id)])
-        mock_hmget = Mock(return_value=[str(self.content2.id), str(self.content1.id)])
-        mock_redis = Mock(zrevrange=mock_zrevrange, hmget=mock_hmget)
-        mock_get.return_value = mock_redis
-        ids, throughs = self.stream.get_cached_range(0)
-        self.assertEqual(ids, [self.content2.id, self.content1.id])
-        self.assertEqual(throughs, {self.content2.id: self.content2.id, self.content1.id: self.content1.id})
-        mock_zrevrange.assert_called_once_with(self.stream.key, 0, 0 + self.stream.paginate_by)
-        mock_hmget.assert_called_once_with(BaseStream.get_throughs_key(self.stream.key), keys=[
-            self.content2.id, self.content1.id,
-        ])
-
+        self.stream.paginate_by = 2
+        r = get_redis_connection()
+        r.delete(self.stream.key, self.stream.get_throughs_key(self.stream.key))
+        r.zadd(self.stream.key, {"10": 100, "11": 110, "9": 90, "5": 50})
+        # Only throughs of shares are stored
+        r.hset(self.stream.get_throughs_key(self.stream.key), "11", 12)
+        with patch.object(r, "hmget") as mock_hmget:
+            ids, throughs = self.stream.get_cached_range(0)
+        self.assertFalse(mock_hmget.called)
+        self.assertEqual(ids, [11, 10, 9])
+        self.assertEqual(throughs, {11: 12, 10: 10, 9: 9})
         # Non-zero index
-        mock_zrevrange.reset_mock()
-        self.stream.get_cached_range(5)
-        mock_zrevrange.assert_called_once_with(self.stream.key, 5, 5 + self.stream.paginate_by)
+        ids, throughs = self.stream.get_cached_range(2)
+        self.assertEqual(ids, [9, 5])
+        self.assertEqual(throughs, {9: 9, 5: 5})
+        self.assertEqual(self.stream.get_cached_range(4), ([], {}))
 
     def test_get_content(self, mock_queryset):
         qs, throughs = self.stream.get_content()
@@ -229,6 +659,15 @@ class TestBaseStream(SocialhomeTestCase):
         self.assertFalse(qs)
         self.assertFalse(throughs)
 
+    def test_get_content_by_ids(self, mock_queryset):
+        ids = [self.content2.id, self.content1.id]
+        self.assertEqual(self.stream.get_content_by_ids(ids), [self.content2, self.content1])
+        self.assertEqual(self.stream.get_content_by_ids(list(reversed(ids))), [self.content1, self.content2])
+        # Missing ones are skipped
+        self.assertEqual(self.stream.get_content_by_ids([self.content1.id, 9999999]), [self.content1])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.stream.get_content_by_ids([]), [])
+
     def test_get_content_ids__returns_right_ids_according_to_last_id_and_ordering(self, mock_queryset):
         ids, throughs = self.stream.get_content_ids()
         self.assertEqual(ids, [self.content2.id, self.content1.id])
@@ -257,6 +696,34 @@ class TestBaseStream(SocialhomeTestCase):
         self.assertFalse(ids)
         self.assertFalse(throughs)
 
+    def test_get_content_ids__with_cursor(self, mock_queryset):
+        self.stream.paginate_by = 1
+        ids, throughs = self.stream.get_content_ids()
+        self.assertEqual(ids, [self.content2.id])
+        self.assertEqual(
+            self.stream.next_cursor, StreamCursor(False, self.content2.created.isoformat(), self.content2.id),
+        )
+
+        self.stream.cursor = self.stream.next_cursor
+        ids, throughs = self.stream.get_content_ids()
+        self.assertEqual(ids, [self.content1.id])
+        self.assertEqual(throughs, {self.content1.id: self.content1.id})
+
+        self.stream.cursor = self.stream.next_cursor
+        self.stream.next_cursor = None
+        ids, throughs = self.stream.get_content_ids()
+        self.assertFalse(ids)
+        self.assertIsNone(self.stream.next_cursor)
+
+    def test_get_content_ids__with_cursor__same_ordering_value(self, mock_queryset):
+        Content.objects.filter(id=self.content1.id).update(created=self.content2.created)
+        self.stream.paginate_by = 1
+        ids, _throughs = self.stream.get_content_ids()
+        self.assertEqual(ids, [max(self.content1.id, self.content2.id)])
+        self.stream.cursor = self.stream.next_cursor
+        ids, _throughs = self.stream.get_content_ids()
+        self.assertEqual(ids, [min(self.content1.id, self.content2.id)])
+
     def test_get_content_ids__limits_by_paginate_by(self, mock_queryset):
         self.stream.paginate_by = 1
         ids, throughs = self.stream.get_content_ids()
@@ -1,10 +1,14 @@
+import time
 from datetime import timedelta
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from django.test.utils import override_settings
 from django.utils.timezone import now
 
-from socialhome.streams.tasks import streams_tasks, groom_redis_precaches, delete_redis_keys
+from socialhome.streams.streams import PRECACHE_KEYS_KEY
+from socialhome.streams.tasks import (
+    streams_tasks, groom_redis_precaches, delete_redis_keys, PRECACHE_GROOM_KEY, compact_stream_throughs,
+)
 from socialhome.tests.utils import SocialhomeTestCase
 from socialhome.users.models import User
 from socialhome.users.tests.factories import UserFactory
@@ -20,6 +24,65 @@ def test_streams_tasks():
     assert kwargs["func"] == groom_redis_precaches
 
 
+class TestDeleteRedisKeys(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        for x in range(5):
+            self.r.set("sh:tests:delete:%s" % x, x)
+        self.r.set("sh:tests:delete:expiring", 1, ex=60)
+        self.r.set("sh:tests:keep", 1)
+
+    def tearDown(self):
+        super().tearDown()
+        self.r.delete(*self.r.keys("sh:tests:*"))
+
+    def test_deletes_keys_without_expiry(self):
+        self.assertEqual(delete_redis_keys("sh:tests:delete:*"), {"examined": 6, "deleted": 5})
+        self.assertEqual(sorted(self.r.keys("sh:tests:*")), [b"sh:tests:delete:expiring", b"sh:tests:keep"])
+
+    def test_deletes_all_keys(self):
+        self.assertEqual(
+            delete_redis_keys("sh:tests:delete:*", only_without_expiry=False), {"examined": 6, "deleted": 6},
+        )
+        self.assertEqual(self.r.keys("sh:tests:*"), [b"sh:tests:keep"])
+
+    @patch("socialhome.streams.tasks.DELETE_BATCH_SIZE", new=2)
+    def test_deletes_in_batches(self):
+        self.assertEqual(delete_redis_keys("sh:tests:delete:*"), {"examined": 6, "deleted": 5})
+        self.assertEqual(sorted(self.r.keys("sh:tests:*")), [b"sh:tests:delete:expiring", b"sh:tests:keep"])
+
+    @patch("socialhome.streams.tasks.time.sleep")
+    @patch("socialhome.streams.tasks.DELETE_BATCH_SIZE", new=2)
+    def test_throttles_operations(self, mock_sleep):
+        delete_redis_keys("sh:tests:delete:*", ops_per_second=1)
+        self.assertTrue(mock_sleep.called)
+        mock_sleep.reset_mock()
+        delete_redis_keys("sh:tests:delete:*", ops_per_second=0)
+        self.assertFalse(mock_sleep.called)
+
+
+class TestCompactStreamThroughs(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.r.hset("sh:streams:spamandeggs:1:throughs", mapping={"1": 1, "2": 3, "4": 4})
+        self.r.hset("sh:streams:spamandeggs:2:throughs", mapping={"1": 1})
+
+    def tearDown(self):
+        super().tearDown()
+        self.r.delete("sh:streams:spamandeggs:1:throughs", "sh:streams:spamandeggs:2:throughs")
+
+    @patch("socialhome.streams.tasks.DELETE_BATCH_SIZE", new=1)
+    def test_removes_throughs_of_content_itself(self):
+        counts = compact_stream_throughs()
+        # Other tests may leave streams behind
+        self.assertGreaterEqual(counts["examined"], 2)
+        self.assertGreaterEqual(counts["removed"], 3)
+        self.assertEqual(self.r.hgetall("sh:streams:spamandeggs:1:throughs"), {b"2": b"3"})
+        self.assertFalse(self.r.exists("sh:streams:spamandeggs:2:throughs"))
+
+
 @override_settings(
     SOCIALHOME_STREAMS_PRECACHE_SIZE=4, SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE=2,
     SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS=10,
@@ -95,3 +158,48 @@ class TestGroomRedisPrecaches(SocialhomeTestCase):
         )
         with self.assertNumQueries(1):
             groom_redis_precaches()
+
+    def test_existing_keys_are_registered_once(self):
+        key = "sh:streams:spamandeggs:736353:%s" % self.user.id
+        groom_redis_precaches()
+        self.assertEqual(self.r.zrange(PRECACHE_KEYS_KEY, 0, -1), [key.encode("utf-8")])
+        self.r.zadd("sh:streams:spamandeggs:736354:%s" % self.user.id, {"1": 1})
+        groom_redis_precaches()
+        self.assertEqual(self.r.zrange(PRECACHE_KEYS_KEY, 0, -1), [key.encode("utf-8")])
+
+    def test_keys_of_deleted_users_are_removed(self):
+        self.r.zadd("sh:streams:spamandeggs:736353:9999999", {"1": 1})
+        self.r.hset("sh:streams:spamandeggs:736353:9999999:throughs", "1", "1")
+        groom_redis_precaches()
+        self.assertFalse(self.r.exists("sh:streams:spamandeggs:736353:9999999"))
+        self.assertFalse(self.r.exists("sh:streams:spamandeggs:736353:9999999:throughs"))
+        self.assertIsNone(self.r.zscore(PRECACHE_KEYS_KEY, "sh:streams:spamandeggs:736353:9999999"))
+
+    def test_expired_keys_are_forgotten(self):
+        groom_redis_precaches()
+        for x in range(10):
+            self.r.zadd("sh:streams:spamandeggs:736353:anonymous", {str(x): x})
+        # Written to last long enough ago that it has expired already, unlike this one
+        self.r.zadd(PRECACHE_KEYS_KEY, {"sh:streams:spamandeggs:736353:anonymous": 1})
+        groom_redis_precaches()
+        self.assertIsNone(self.r.zscore(PRECACHE_KEYS_KEY, "sh:streams:spamandeggs:736353:anonymous"))
+        self.assertEqual(self.r.zcard("sh:streams:spamandeggs:736353:anonymous"), 10)
+        self.r.delete("sh:streams:spamandeggs:736353:anonymous")
+
+    @patch("socialhome.streams.tasks.GROOM_BATCH_SIZE", new=50)
+    def test_grooms_in_slices(self):
+        key = "sh:streams:spamandeggs:736353:%s" % self.user.id
+        # Keys that have expired since they were written to
+        self.r.zadd(PRECACHE_KEYS_KEY, {"sh:streams:spamandeggs:%s:anonymous" % x: time.time() for x in range(300)})
+        self.r.hset(PRECACHE_GROOM_KEY, "registered", 1)
+        self.r.zadd(PRECACHE_KEYS_KEY, {key: time.time()})
+        groomed = groom_redis_precaches(max_keys=100)
+        self.assertTrue(100 <= groomed < 301)
+        self.assertNotEqual(self.r.hget(PRECACHE_GROOM_KEY, "cursor"), b"0")
+        runs = 1
+        while self.r.hget(PRECACHE_GROOM_KEY, "cursor") != b"0" and runs < 10:
+            groom_redis_precaches(max_keys=100)
+            runs += 1
+        self.assertTrue(runs > 1)
+        self.assertEqual(self.r.zrange(PRECACHE_KEYS_KEY, 0, -1), [key.encode("utf-8")])
+        self.assertEqual(self.r.zcard(key), 4)
@@ -1,6 +1,8 @@
 from unittest.mock import patch
 
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from socialhome.content.models import Tag
@@ -27,6 +29,23 @@ class TestFollowedStreamAPIView(SocialhomeAPITestCase):
         self.assertEqual(len(self.last_response.data), 1)
         self.assertEqual(self.last_response.data[0]["id"], self.content.id)
 
+    def test_query_count_is_constant_per_page(self):
+        def get_query_count():
+            with CaptureQueriesContext(connection) as context:
+                self.get("api-streams:followed")
+            return len(context.captured_queries)
+
+        with self.login(self.user):
+            self.get("api-streams:followed")
+            query_count = get_query_count()
+            for _i in range(4):
+                content = PublicContentFactory(author=self.remote_profile)
+                content.share(self.profile)
+            self.assertEqual(get_query_count(), query_count)
+            self.assertEqual(len(self.last_response.data), 5)
+            self.assertTrue(all(item["user_has_shared"] for item in self.last_response.data[:4]))
+            self.assertFalse(self.last_response.data[4]["user_has_shared"])
+
     def test_login_required(self):
         self.get("api-streams:followed")
         self.response_403()
@@ -43,7 +62,7 @@ class TestFollowedStreamAPIView(SocialhomeAPITestCase):
         mock_stream.return_value = MockStream()
         with self.login(self.user):
             self.get("api-streams:followed")
-        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None)
+        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None, cursor=None)
 
 
 class TestLimitedStreamAPIView(SocialhomeAPITestCase):
@@ -73,7 +92,7 @@ class TestLimitedStreamAPIView(SocialhomeAPITestCase):
         mock_stream.return_value = MockStream()
         with self.login(self.user):
             self.get("api-streams:limited")
-        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None)
+        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None, cursor=None)
 
 
 class TestLocalStreamAPIView(SocialhomeAPITestCase):
@@ -111,7 +130,7 @@ class TestLocalStreamAPIView(SocialhomeAPITestCase):
         mock_stream.return_value = MockStream()
         with self.login(self.user):
             self.get("api-streams:local")
-        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None)
+        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None, cursor=None)
 
 
 class TestProfileAllStreamAPIView(SocialhomeAPITestCase):
@@ -136,7 +155,9 @@ class TestProfileAllStreamAPIView(SocialhomeAPITestCase):
         mock_stream.return_value = MockStream()
         with self.login(self.user):
             self.get("api-streams:profile-all", uuid=self.content.author.uuid)
-        mock_stream.assert_called_once_with(last_id=None, profile=self.content.author, user=self.user, accept_ids=None)
+        mock_stream.assert_called_once_with(
+            last_id=None, profile=self.content.author, user=self.user, accept_ids=None, cursor=None,
+        )
 
 
 class TestProfilePinnedStreamAPIView(SocialhomeAPITestCase):
@@ -160,7 +181,9 @@ class TestProfilePinnedStreamAPIView(SocialhomeAPITestCase):
         mock_stream.return_value = MockStream()
         with self.login(self.user):
             self.get("api-streams:profile-pinned", uuid=self.content.author.uuid)
-        mock_stream.assert_called_once_with(last_id=None, profile=self.content.author, user=self.user, accept_ids=None)
+        mock_stream.assert_called_once_with(
+            last_id=None, profile=self.content.author, user=self.user, accept_ids=None, cursor=None,
+        )
 
 
 class TestPublicStreamAPIView(SocialhomeAPITestCase):
@@ -184,11 +207,27 @@ class TestPublicStreamAPIView(SocialhomeAPITestCase):
         self.assertEqual(len(self.last_response.data), 1)
         self.assertEqual(self.last_response.data[0]["id"], self.content.id)
 
+    @patch("socialhome.streams.streams.PublicStream.paginate_by", new=1)
+    def test_cursor_is_respected(self):
+        self.get("api-streams:public")
+        self.assertEqual(len(self.last_response.data), 1)
+        self.assertEqual(self.last_response.data[0]["id"], self.content2.id)
+        self.get("%s?cursor=%s" % (reverse("api-streams:public"), self.last_response["X-Next-Cursor"]))
+        self.assertEqual(len(self.last_response.data), 1)
+        self.assertEqual(self.last_response.data[0]["id"], self.content.id)
+        self.get("%s?cursor=%s" % (reverse("api-streams:public"), self.last_response["X-Next-Cursor"]))
+        self.assertEqual(len(self.last_response.data), 0)
+        self.assertFalse(self.last_response.has_header("X-Next-Cursor"))
+
+    def test_invalid_cursor(self):
+        self.get("%s?cursor=foobar" % reverse("api-streams:public"))
+        self.response_400()
+
     @patch("socialhome.streams.viewsets.PublicStream")
     def test_users_correct_stream_class(self, mock_stream):
         mock_stream.return_value = MockStream()
         self.get("api-streams:public")
-        mock_stream.assert_called_once_with(last_id=None, accept_ids=None)
+        mock_stream.assert_called_once_with(last_id=None, accept_ids=None, cursor=None)
 
 
 class TestTagStreamAPIView(SocialhomeAPITestCase):
@@ -212,7 +251,7 @@ class TestTagStreamAPIView(SocialhomeAPITestCase):
         with self.login(self.user):
             self.get("api-streams:tag", name="foobar")
         mock_stream.assert_called_once_with(
-            last_id=None, tag=self.content.tags.first(), user=self.user, accept_ids=None,
+            last_id=None, tag=self.content.tags.first(), user=self.user, accept_ids=None, cursor=None,
         )
 
 
@@ -243,4 +282,4 @@ class TestTagsStreamAPIView(SocialhomeAPITestCase):
         mock_stream.return_value = MockStream()
         with self.login(self.user):
             self.get("api-streams:tags")
-        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None)
+        mock_stream.assert_called_once_with(last_id=None, user=self.user, accept_ids=None, cursor=None)
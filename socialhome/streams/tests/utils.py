@@ -2,5 +2,7 @@ from unittest.mock import Mock
 
 
 class MockStream(Mock):
+    next_cursor = None
+
     def get_content(self, *args, **kwargs):
         return [], {}
@@ -1,3 +1,5 @@
+from django.http import Http404
+from rest_framework.exceptions import ParseError
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -7,11 +9,21 @@ from socialhome.content.models import Tag
 from socialhome.content.serializers import ContentSerializer
 from socialhome.streams.streams import (
     PublicStream, FollowedStream, TagStream, ProfileAllStream, ProfilePinnedStream, LimitedStream, LocalStream,
-    TagsStream)
+    TagsStream, StreamCursor)
 from socialhome.users.models import Profile
 
 
 class StreamsAPIBaseView(APIView):
+    """Base view for stream API views.
+
+    Pagination is done either with the opaque ``cursor`` parameter, which is returned for the next page in the
+    ``X-Next-Cursor`` response header, or with the legacy ``last_id`` parameter.
+    """
+    accept_ids = None
+    cursor = None
+    last_id = None
+    stream = None
+
     def dispatch(self, request, *args, **kwargs):
         self.last_id = request.GET.get("last_id")
         self.accept_ids = request.GET.get("accept_ids", None)
@@ -20,9 +32,19 @@ class StreamsAPIBaseView(APIView):
         return super().dispatch(request, *args, **kwargs)
 
     def get(self, request, **kwargs):
+        if request.GET.get("cursor"):
+            try:
+                self.cursor = StreamCursor.decode(request.GET["cursor"])
+            except ValueError:
+                raise ParseError("Invalid cursor.")
         qs, throughs = self.get_content()
-        serializer = ContentSerializer(qs, many=True, context={"throughs": throughs, "request": request})
-        return Response(serializer.data)
+        serializer = ContentSerializer(
+            qs, many=True, context={"cache_fragments": True, "throughs": throughs, "request": request},
+        )
+        response = Response(serializer.data)
+        if self.stream and self.stream.next_cursor:
+            response["X-Next-Cursor"] = self.stream.next_cursor.encode()
+        return response
 
     def get_content(self):
         return [], {}
@@ -32,22 +54,28 @@ class FollowedStreamAPIView(StreamsAPIBaseView):
     permission_classes = (IsAuthenticated,)
 
     def get_content(self):
-        stream = FollowedStream(last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids)
-        return stream.get_content()
+        self.stream = FollowedStream(
+            last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids, cursor=self.cursor,
+        )
+        return self.stream.get_content()
 
 
 class LimitedStreamAPIView(StreamsAPIBaseView):
     permission_classes = (IsAuthenticated,)
 
     def get_content(self):
-        stream = LimitedStream(last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids)
-        return stream.get_content()
+        self.stream = LimitedStream(
+            last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids, cursor=self.cursor,
+        )
+        return self.stream.get_content()
 
 
 class LocalStreamAPIView(StreamsAPIBaseView):
     def get_content(self):
-        stream = LocalStream(last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids)
-        return stream.get_content()
+        self.stream = LocalStream(
+            last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids, cursor=self.cursor,
+        )
+        return self.stream.get_content()
 
 
 class ProfileAllStreamAPIView(StreamsAPIBaseView):
@@ -56,10 +84,11 @@ class ProfileAllStreamAPIView(StreamsAPIBaseView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_content(self):
-        stream = ProfileAllStream(
+        self.stream = ProfileAllStream(
             last_id=self.last_id, profile=self.profile, user=self.request.user, accept_ids=self.accept_ids,
+            cursor=self.cursor,
         )
-        return stream.get_content()
+        return self.stream.get_content()
 
 
 class ProfilePinnedStreamAPIView(StreamsAPIBaseView):
@@ -68,16 +97,17 @@ class ProfilePinnedStreamAPIView(StreamsAPIBaseView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_content(self):
-        stream = ProfilePinnedStream(
+        self.stream = ProfilePinnedStream(
             last_id=self.last_id, profile=self.profile, user=self.request.user, accept_ids=self.accept_ids,
+            cursor=self.cursor,
         )
-        return stream.get_content()
+        return self.stream.get_content()
 
 
 class PublicStreamAPIView(StreamsAPIBaseView):
     def get_content(self):
-        stream = PublicStream(last_id=self.last_id, accept_ids=self.accept_ids)
-        return stream.get_content()
+        self.stream = PublicStream(last_id=self.last_id, accept_ids=self.accept_ids, cursor=self.cursor)
+        return self.stream.get_content()
 
 
 class TagStreamAPIView(StreamsAPIBaseView):
@@ -92,13 +122,17 @@ class TagStreamAPIView(StreamsAPIBaseView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_content(self):
-        stream = TagStream(last_id=self.last_id, tag=self.tag, user=self.request.user, accept_ids=self.accept_ids)
-        return stream.get_content()
+        self.stream = TagStream(
+            last_id=self.last_id, tag=self.tag, user=self.request.user, accept_ids=self.accept_ids, cursor=self.cursor,
+        )
+        return self.stream.get_content()
 
 
 class TagsStreamAPIView(StreamsAPIBaseView):
     permission_classes = (IsAuthenticated,)
 
     def get_content(self):
-        stream = TagsStream(last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids)
-        return stream.get_content()
+        self.stream = TagsStream(
+            last_id=self.last_id, user=self.request.user, accept_ids=self.accept_ids, cursor=self.cursor,
+        )
+        return self.stream.get_content()
@@ -3,6 +3,10 @@ import sys
 import django_rq
 from django.apps import AppConfig
 
+from socialhome.content.tasks import content_tasks
+from socialhome.federate.delivery import delivery_tasks
+from socialhome.federate.nodeinfo import nodeinfo_tasks
+from socialhome.federate.replies import replies_tasks
 from socialhome.streams.tasks import streams_tasks
 
 
@@ -22,4 +26,8 @@ class TasksConfig(AppConfig):
             job.delete()
 
         # Queue tasks
+        content_tasks(scheduler)
+        delivery_tasks(scheduler)
+        nodeinfo_tasks(scheduler)
+        replies_tasks(scheduler)
         streams_tasks(scheduler)
@@ -12,6 +12,8 @@ import socialhome.tests.environment  # Set some environment tweaks
 from socialhome.content.tests.factories import (
     PublicContentFactory, SiteContentFactory, SelfContentFactory, LimitedContentFactory)
 from socialhome.users.tests.factories import PublicProfileFactory, PublicUserFactory
+from socialhome.users.utils import get_sender_cache_key, sender_public_keys
+from socialhome.utils import get_redis_connection
 
 
 class CreateDataMixin:
@@ -42,6 +44,19 @@ class CreateDataMixin:
 class SocialhomeTestBase(CreateDataMixin):
     maxDiff = None
 
+    def setUp(self):
+        super().setUp()
+        # Don't leak cached remote senders, seen payloads, tracked replies, NodeInfo documents, the precache
+        # registry or shared stream timelines between tests
+        sender_public_keys.clear()
+        r = get_redis_connection()
+        keys = []
+        for pattern in (get_sender_cache_key("*"), "sh:inbound:seen:*", "sh:replies:*", "sh:federate:nodeinfo:*",
+                        "sh:precache:*", "sh:timelines:*", "sh:content:pipeline:*"):
+            keys.extend(r.keys(pattern))
+        if keys:
+            r.delete(*keys)
+
     @classmethod
     def create_local_and_remote_user(cls):
         CreateDataMixin.create_local_and_remote_user(cls)
@@ -1,5 +1,10 @@
+import logging
+import sys
+
 from django.apps import AppConfig
 
+logger = logging.getLogger("socialhome")
+
 
 class UsersConfig(AppConfig):
     name = "socialhome.users"
@@ -8,3 +13,11 @@ class UsersConfig(AppConfig):
     def ready(self):
         # Import our signals
         import socialhome.users.signals
+
+        # The RQ worker forks a work horse for each job, so import the private keys used for deliveries before that
+        if "rqworker" in sys.argv:
+            from socialhome.users.utils import warm_private_keys
+            try:
+                warm_private_keys()
+            except Exception as ex:
+                logger.warning("UsersConfig.ready - failed to import private keys: %s", ex)
@@ -28,7 +28,9 @@ from socialhome.activities.models import Activity
 from socialhome.content.utils import safe_text
 from socialhome.enums import Visibility
 from socialhome.users.querysets import ProfileQuerySet
-from socialhome.users.utils import get_pony_urls, generate_rsa_private_key
+from socialhome.users.utils import (
+    get_pony_urls, generate_rsa_private_key, get_private_key, invalidate_private_keys, cache_sender,
+)
 from socialhome.utils import get_full_media_url, get_redis_connection
 
 logger = logging.getLogger("socialhome")
@@ -61,7 +63,11 @@ class User(AbstractUser):
 
     @property
     def activity_key(self) -> str:
-        return f"sh:users:activity:{self.id}"
+        return self.get_activity_key(self.id)
+
+    @staticmethod
+    def get_activity_key(user_id: int) -> str:
+        return f"sh:users:activity:{user_id}"
 
     @property
     def url(self):
@@ -346,6 +352,9 @@ class Profile(TimeStampedModel):
         self.rsa_public_key = key.publickey().exportKey()
         self.rsa_private_key = key.exportKey()
         self.save(update_fields=("rsa_private_key", "rsa_public_key"))
+        invalidate_private_keys(self.id, self.fid)
+        self.__dict__.pop("private_key", None)
+        self.__dict__.pop("key", None)
 
     @cached_property
     def private_key(self):
@@ -353,8 +362,7 @@ class Profile(TimeStampedModel):
 
         Corresponds to private key.
         """
-        if self.rsa_private_key:
-            return RSA.importKey(self.rsa_private_key)
+        return get_private_key(self.id, self.rsa_private_key)
 
     @cached_property
     def key(self):
@@ -486,4 +494,5 @@ class Profile(TimeStampedModel):
             extra_lookups = {}
         profile, created = Profile.objects.fed_update_or_create(fid, values, extra_lookups)
         logger.info("from_remote_profile - created %s, profile %s", created, profile)
+        cache_sender(profile)
         return profile
@@ -1,4 +1,4 @@
-from typing import Dict, Tuple, TYPE_CHECKING, Any
+from typing import Dict, Tuple, TYPE_CHECKING, Any, Iterable
 
 from django.db.models import QuerySet, Q, ObjectDoesNotExist
 
@@ -26,6 +26,15 @@ class ProfileQuerySet(QuerySet):
             Q(fid=value) | Q(guid=value) | Q(handle=value)
         ).filter(**params)
 
+    def fed_in(self, values: Iterable[str], **params) -> QuerySet:
+        """
+        Get Profiles by many federated IDs.
+        """
+        values = list(values)
+        return self.filter(
+            Q(fid__in=values) | Q(guid__in=values) | Q(handle__in=values)
+        ).filter(**params)
+
     def fed_update_or_create(
         self, fid: str, values: Dict[str, Any], extra_lookups: Dict = None
     ) -> Tuple['Profile', bool]:
@@ -114,6 +114,16 @@ class TestProfile(SocialhomeTestCase):
         assert profile.rsa_private_key !=  current_rsa_key
         assert profile.rsa_public_key != current_public_key
 
+    def test_generate_new_rsa_key_replaces_imported_keys(self):
+        profile = ProfileFactory()
+        profile.generate_new_rsa_key(bits=1024)
+        private_key = profile.private_key
+        public_key = profile.key
+        profile.generate_new_rsa_key(bits=1024)
+        assert profile.private_key.exportKey() == profile.rsa_private_key.encode("utf-8")
+        assert profile.private_key != private_key
+        assert profile.key != public_key
+
     def test_get_absolute_url(self):
         self.assertEqual(self.profile.get_absolute_url(), f"/p/{self.profile.uuid}/")
 
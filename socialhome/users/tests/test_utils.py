@@ -0,0 +1,119 @@
+from unittest.mock import patch
+
+from federation.tests.fixtures.keys import get_dummy_private_key
+from federation.types import UserType
+
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.users.models import Profile
+from socialhome.users.tests.factories import ProfileFactory, UserFactory
+from socialhome.utils import get_redis_connection
+from socialhome.users.utils import (
+    LRUCache, get_private_key, invalidate_private_keys, private_keys, with_private_key, cache_sender,
+    get_cached_sender, sender_public_keys, warm_private_keys,
+)
+
+
+class TestLRUCache(SocialhomeTestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("foo", 1)
+        cache.set("bar", 2)
+        cache.get("foo")
+        cache.set("baz", 3)
+        self.assertEqual(cache.get("foo"), 1)
+        self.assertIsNone(cache.get("bar"))
+        self.assertEqual(cache.get("baz"), 3)
+
+    @patch("socialhome.users.utils.time.monotonic", return_value=100)
+    def test_expired_items_are_not_returned(self, mock_monotonic):
+        cache = LRUCache(maxsize=2, ttl=10)
+        cache.set("foo", 1)
+        mock_monotonic.return_value = 110
+        self.assertEqual(cache.get("foo"), 1)
+        mock_monotonic.return_value = 111
+        self.assertIsNone(cache.get("foo"))
+
+    def test_delete_matching(self):
+        cache = LRUCache(maxsize=3)
+        cache.set(("foo", 1), 1)
+        cache.set(("bar", 1), 2)
+        cache.delete_matching(lambda key: key[0] == "foo")
+        self.assertIsNone(cache.get(("foo", 1)))
+        self.assertEqual(cache.get(("bar", 1)), 2)
+
+
+class TestGetPrivateKey(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.pem = get_dummy_private_key().exportKey().decode("utf-8")
+
+    def setUp(self):
+        super().setUp()
+        private_keys.clear()
+
+    def test_imported_key_is_reused(self):
+        key = get_private_key(1, self.pem)
+        self.assertEqual(key.exportKey().decode("utf-8"), self.pem)
+        with patch("socialhome.users.utils.RSA.importKey") as mock_import:
+            self.assertIs(get_private_key(1, self.pem.encode("utf-8")), key)
+        self.assertFalse(mock_import.called)
+
+    def test_empty_key(self):
+        self.assertIsNone(get_private_key(1, None))
+        self.assertIsNone(get_private_key(1, ""))
+
+    def test_invalidate_private_keys(self):
+        key = get_private_key(1, self.pem)
+        get_private_key(2, self.pem)
+        invalidate_private_keys(1)
+        self.assertIsNot(get_private_key(1, self.pem), key)
+        self.assertEqual(len(private_keys.items), 2)
+
+    def test_with_private_key(self):
+        user = with_private_key(UserType(id="https://example.com/u/foo/", private_key=self.pem))
+        self.assertIs(user.private_key, get_private_key("https://example.com/u/foo/", self.pem))
+        self.assertIs(user.rsa_private_key, user.private_key)
+        user = UserType(id="https://example.com/u/foo/")
+        self.assertIs(with_private_key(user), user)
+
+    def test_warm_private_keys(self):
+        active, inactive = UserFactory(), UserFactory()
+        Profile.objects.filter(user__in=[active, inactive]).update(rsa_private_key=self.pem)
+        r = get_redis_connection()
+        keys = r.keys("sh:users:activity:*")
+        if keys:
+            r.delete(*keys)
+        active.mark_recently_active()
+        self.assertEqual(warm_private_keys(), 1)
+        self.assertEqual(len(private_keys.items), 2)
+        profile = Profile.objects.get(user=active)
+        with patch("socialhome.users.utils.RSA.importKey") as mock_import:
+            key = get_private_key(profile.id, self.pem)
+            self.assertIs(with_private_key(profile.federable).private_key, key)
+        self.assertFalse(mock_import.called)
+        r.delete(active.activity_key)
+
+
+class TestCacheSender(SocialhomeTestCase):
+    def test_remote_profile_is_cached_by_each_identifier(self):
+        profile = ProfileFactory(handle="foo@example.com", guid="1234")
+        cache_sender(profile)
+        for identifier in (profile.fid, "foo@example.com", "1234"):
+            self.assertEqual(get_cached_sender(identifier), {"id": profile.id, "public_key": profile.rsa_public_key})
+
+    def test_process_cached_public_keys_are_replaced(self):
+        profile = ProfileFactory()
+        sender_public_keys.set(profile.fid, "old key")
+        cache_sender(profile)
+        self.assertIsNone(sender_public_keys.get(profile.fid))
+
+    def test_local_profile_is_not_cached(self):
+        profile = UserFactory().profile
+        cache_sender(profile)
+        self.assertIsNone(get_cached_sender(profile.fid))
+
+    def test_profile_without_public_key_is_not_cached(self):
+        profile = ProfileFactory(rsa_public_key="")
+        cache_sender(profile)
+        self.assertIsNone(get_cached_sender(profile.fid))
@@ -1,8 +1,17 @@
-from typing import List
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Iterable, Optional, Set, Union
 
+import attr
 from Crypto import Random
 from Crypto.PublicKey import RSA
+from Crypto.PublicKey.RSA import RsaKey
 from django.conf import settings
+from federation.types import UserType
+from federation.utils.text import decode_if_bytes
 
 from socialhome.utils import get_redis_connection
 
@@ -30,3 +39,157 @@ def get_recently_active_user_ids() -> List[int]:
     r = get_redis_connection()
     keys = r.keys(r"sh:users:activity:*")
     return [int(key.decode("utf-8").rsplit(":", 1)[1]) for key in keys]
+
+
+def filter_recently_active_user_ids(user_ids: Iterable[int]) -> Set[int]:
+    """
+    Return the subset of given User ID's that have been recently active.
+
+    Checks all the activity keys in one pipelined Redis round-trip.
+    """
+    from socialhome.users.models import User  # Circulars
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    r = get_redis_connection()
+    pipeline = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipeline.exists(User.get_activity_key(user_id))
+    return {user_id for user_id, exists in zip(user_ids, pipeline.execute()) if exists}
+
+
+class LRUCache:
+    """Thread safe least recently used cache local to the process, with an optional expiry in seconds."""
+    def __init__(self, maxsize: int, ttl: int = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            if key not in self.items:
+                return None
+            value, expires = self.items[key]
+            if expires and expires < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.items[key] = (value, expires)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete_matching(self, predicate: Callable[[Hashable], bool]):
+        with self.lock:
+            for key in [key for key in self.items if predicate(key)]:
+                del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+# Imported private keys of local profiles, by owner and key fingerprint
+private_keys = LRUCache(maxsize=1000)
+# Public keys of remote senders by fid, handle or guid. Expire so that changed keys are picked up from other processes.
+sender_public_keys = LRUCache(maxsize=10000, ttl=300)
+
+
+def get_key_fingerprint(pem: str) -> str:
+    return hashlib.sha256(pem.encode("utf-8")).hexdigest()
+
+
+def get_private_key(owner: Union[int, str], pem: Union[str, bytes]) -> Optional[RsaKey]:
+    """Import a private key, reusing keys already imported in this process.
+
+    :param owner: Profile id, or the fid of the profile for federation users
+    :param pem: Private key in PEM format
+    """
+    if not pem:
+        return None
+    pem = decode_if_bytes(pem)
+    key = (owner, get_key_fingerprint(pem))
+    private_key = private_keys.get(key)
+    if private_key is None:
+        private_key = RSA.importKey(pem)
+        private_keys.set(key, private_key)
+    return private_key
+
+
+def invalidate_private_keys(*owners: Union[int, str]):
+    private_keys.delete_matching(lambda key: key[0] in owners)
+
+
+def warm_private_keys() -> int:
+    """Import the private keys of recently active local profiles.
+
+    Called in the RQ worker before it forks a work horse for each job. The caches in this module are local to
+    the process, so keys imported by a work horse are thrown away with it, while keys imported here are
+    inherited by every job.
+
+    :returns: Number of keys imported
+    """
+    from socialhome.users.models import Profile  # Circulars
+    profiles = Profile.objects.filter(
+        user_id__in=get_recently_active_user_ids(), rsa_private_key__isnull=False,
+    ).only("id", "fid", "handle", "rsa_private_key")
+    # Each key is cached both by profile id and by the federation user id
+    imported = 0
+    for profile in profiles[:private_keys.maxsize // 2]:
+        private_key = get_private_key(profile.id, profile.rsa_private_key)
+        private_keys.set((profile.fid or profile.handle, get_key_fingerprint(profile.rsa_private_key)), private_key)
+        imported += 1
+    return imported
+
+
+def with_private_key(user: UserType) -> UserType:
+    """Get the federation user with an imported private key.
+
+    The federation library imports a private key given as text every time it is used, for example for every
+    recipient of an ActivityPub send. The key can't be imported before queueing jobs as keys can't be pickled.
+    """
+    if not isinstance(user.private_key, str):
+        return user
+    return attr.evolve(user, private_key=get_private_key(user.id, user.private_key))
+
+
+# Seconds to cache the profile id and public key of a remote sender
+SENDER_CACHE_TTL = 60 * 60
+
+
+def get_sender_cache_key(identifier: str) -> str:
+    return f"sh:users:sender:{identifier}"
+
+
+def get_profile_identifiers(profile) -> Set[str]:
+    return {identifier for identifier in (profile.fid, profile.guid, profile.handle) if identifier}
+
+
+def cache_sender(profile) -> None:
+    """Cache the id and public key of a remote profile by each of its federated identifiers.
+
+    Replaces the public keys cached in this process for the profile.
+    """
+    identifiers = get_profile_identifiers(profile)
+    sender_public_keys.delete_matching(lambda key: key in identifiers)
+    if profile.user_id or not profile.rsa_public_key:
+        return
+    value = json.dumps({"id": profile.id, "public_key": profile.rsa_public_key})
+    r = get_redis_connection()
+    pipeline = r.pipeline(transaction=False)
+    for identifier in identifiers:
+        pipeline.set(get_sender_cache_key(identifier), value, ex=SENDER_CACHE_TTL)
+    pipeline.execute()
+
+
+def get_cached_sender(identifier: str) -> Optional[Dict]:
+    """Get the cached id and public key of a remote sender by fid, guid or handle."""
+    value = get_redis_connection().get(get_sender_cache_key(identifier))
+    if value:
+        return json.loads(value)
@@ -1,6 +1,7 @@
 import logging
 
 from django.contrib.auth.mixins import LoginRequiredMixin, AccessMixin
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse
@@ -155,6 +156,7 @@ class OrganizeContentProfileDetailView(LoginRequiredMixin, ListView):
             card_id = int(card_ids[i])
             if card_id in qs_ids:
                 Content.objects.filter(id=card_id).update(order=i)
+                cache.delete(Content.get_serialized_cache_key(card_id))
 
     def get_success_url(self):
         return reverse("users:detail", kwargs={"username": self.request.user.username})